@@ -0,0 +1,185 @@
+"""Бенчмарк хранилища заметок: задержка одной команды при росте общего числа заметок.
+
+    python bench_notes.py store --max 1000000
+    python bench_notes.py find --max 50000
+    python bench_notes.py stats --ops 20000
+Работает во временном каталоге, notes.json и notes.db не трогает.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import notes_db
+
+NOTES_PER_USER = 50
+
+
+def _fresh_db():
+    tmp = tempfile.mkdtemp(prefix="notes-bench-")
+    notes_db.DB_FILE = os.path.join(tmp, "notes.db")
+    notes_db.NOTES_FILE = os.path.join(tmp, "notes.json")
+    notes_db.init_db()
+    return tmp
+
+
+def _seed(total, start=0):
+    # Заполняем напрямую пачками: NOTES_PER_USER заметок на пользователя
+    conn = notes_db._connect()
+    rows = ((n // NOTES_PER_USER, n % NOTES_PER_USER + 1, f"заметка номер {n}") for n in range(start, total))
+    with conn:
+        conn.executemany("INSERT INTO notes (user_id, id, text) VALUES (?, ?, ?)", rows)
+
+
+def _measure(fn, repeat=200):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    return (time.perf_counter() - start) * 1e6 / repeat
+
+
+def _commands(user_id):
+    def add(i):
+        notes_db.add_note(user_id, f"новая {i}")
+
+    def edit(i):
+        notes_db.edit_note(user_id, 1 + i % NOTES_PER_USER, f"правка {i}")
+
+    def listing(i):
+        notes_db.get_notes(user_id)
+
+    return {"add": add, "edit": edit, "list": listing}
+
+
+def _json_commands(path, user_id):
+    # Старая схема: каждая команда читает и переписывает весь notes.json
+    def load():
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save(data):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def add(i):
+        data = load()
+        notes = data.setdefault(str(user_id), [])
+        notes.append({"id": len(notes) + 1, "text": f"новая {i}"})
+        save(data)
+
+    def listing(i):
+        load().get(str(user_id), [])
+
+    return {"add": add, "list": listing}
+
+
+def bench_store(args):
+    tmp = _fresh_db()
+    sizes = [s for s in (1000, 10000, 100000, 1000000, 10000000) if s <= args.max]
+    seeded = 0
+    print(f"{'заметок всего':>14} | " + " | ".join(f"{c:>10}" for c in ("add", "edit", "list")) + "   (мкс на команду)")
+    for size in sizes:
+        _seed(size, seeded)
+        seeded = size
+        user_id = size // NOTES_PER_USER // 2
+        timings = {name: _measure(fn) for name, fn in _commands(user_id).items()}
+        print(f"{size:>14,} | " + " | ".join(f"{timings[c]:>10.1f}" for c in ("add", "edit", "list")))
+
+    print("\nСтарое хранилище notes.json:")
+    path = os.path.join(tmp, "old.json")
+    for size in [s for s in sizes if s <= args.max_json]:
+        data = {}
+        for n in range(size):
+            data.setdefault(str(n // NOTES_PER_USER), []).append({"id": n % NOTES_PER_USER + 1, "text": f"заметка номер {n}"})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        commands = _json_commands(path, 0)
+        timings = {name: _measure(fn, repeat=20) for name, fn in commands.items()}
+        print(f"{size:>14,} | add {timings['add']:>12.1f} | list {timings['list']:>12.1f}")
+
+
+WORDS = ("купить молоко хлеб музыка репетиция концерт гитара встреча отчёт проект "
+         "звонок врач поездка билеты подарок книга фильм идея список задача").split()
+
+
+def bench_find(args):
+    import random
+    _fresh_db()
+    rnd = random.Random(1)
+    notes = [{"id": i + 1, "text": " ".join(rnd.choices(WORDS, k=8))} for i in range(args.max)]
+    conn = notes_db._connect()
+    with conn:
+        conn.executemany("INSERT INTO notes (user_id, id, text) VALUES (1, ?, ?)",
+                         [(n["id"], n["text"]) for n in notes])
+    queries = ["музыка", "концерт гитара", "отчёт", "билет", "врач звонок"]
+    print(f"Заметок у пользователя: {args.max:,}")
+
+    def scan(i):
+        # Как раньше: перебор всех заметок пользователя (уже без чтения JSON)
+        q = queries[i % len(queries)].lower()
+        [n for n in notes if q in n["text"].lower()]
+
+    def fts(i):
+        notes_db.find_notes(1, queries[i % len(queries)])
+
+    print(f"линейный поиск подстроки {_measure(scan, 20):>12.1f} мкс/запрос")
+    print(f"FTS5, первая страница    {_measure(fts, 200):>12.1f} мкс/запрос")
+
+
+def bench_stats(args):
+    """Случайные добавления, правки и удаления; после каждой пачки агрегаты
+    сверяются с пересчётом по самим заметкам."""
+    import random
+    _fresh_db()
+    rnd = random.Random(7)
+    users = range(1, 6)
+    for step in range(args.ops):
+        user_id = rnd.choice(users)
+        op = rnd.random()
+        text = "x" * rnd.randint(1, 300) + rnd.choice(WORDS)
+        if op < 0.5:
+            notes_db.add_note(user_id, text)
+        elif op < 0.75:
+            notes_db.edit_note(user_id, rnd.randint(1, step // 5 + 1), text)
+        else:
+            notes_db.delete_note(user_id, rnd.randint(1, step // 5 + 1))
+        if step % 500 == 0 or step == args.ops - 1:
+            for u in users:
+                notes = notes_db.get_notes(u)
+                expected = (len(notes), sum(len(n["text"]) for n in notes))
+                assert notes_db.get_stats(u) == expected, (u, notes_db.get_stats(u), expected)
+                longest = max(notes, key=lambda n: len(n["text"])) if notes else None
+                assert notes_db.longest_note(u) == longest, (u, notes_db.longest_note(u), longest)
+    print(f"{args.ops:,} случайных изменений: агрегаты совпадают с пересчётом")
+
+    # Скорость запросов при большом числе заметок у одного пользователя
+    user_id = 0
+    conn = notes_db._connect()
+    with conn:
+        conn.executemany("INSERT INTO notes (user_id, id, text) VALUES (?, ?, ?)",
+                         ((user_id, i + 1, "x" * (i % 997)) for i in range(args.max)))
+    print(f"Заметок у пользователя: {args.max:,}")
+    print(f"get_stats     {_measure(lambda i: notes_db.get_stats(user_id)):>8.1f} мкс")
+    print(f"longest_note  {_measure(lambda i: notes_db.longest_note(user_id)):>8.1f} мкс")
+
+
+BENCHMARKS = {
+    "store": bench_store,
+    "find": bench_find,
+    "stats": bench_stats,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--max", type=int, default=1000000, help="до скольких заметок наращивать базу")
+    parser.add_argument("--ops", type=int, default=20000, help="число случайных изменений")
+    parser.add_argument("--max-json", type=int, default=100000, help="предел для старого JSON-хранилища")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == "__main__":
+    main()
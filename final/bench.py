@@ -0,0 +1,1288 @@
+"""Микробенчмарки BandFinderBot.
+
+Запуск из каталога final/:
+    python bench.py db
+    python bench.py match --rows 1000000
+    python bench.py webhook --ops 5000 --concurrency 50
+    python bench.py accept --ops 20000 --concurrency 32
+    python bench.py classify --ops 100000
+    python bench.py remote
+    python bench.py reverse --rows 100000
+    python bench.py search --rows 100000
+    python bench.py cache --ops 200000
+    python bench.py updates --ops 2000 --handler-ms 2
+    python bench.py broadcast --api-rps 10 --flood-rate 0.05
+    python bench.py cluster --ops 2000 --handler-ms 20
+    python bench.py metrics --ops 1000000
+    python bench.py logging --ops 20000
+    python bench.py bulk --rows 200000
+    python bench.py vectors --rows 1000000
+    python bench.py writes --ops 20000 --workers 8 --handler-ms 0
+    python bench.py startup --ops 10
+    python bench.py maintenance --ops 200000 --rows 50000
+Каждый бенчмарк работает на временной базе и не трогает bandfinder.db.
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import threading
+import sqlite3
+import tempfile
+import time
+
+import db
+
+
+def _fresh_db():
+    """Переключает db на чистую временную базу."""
+    db.close_all()
+    tmp = tempfile.mkdtemp(prefix="bandfinder-bench-")
+    db.DB_FILE = os.path.join(tmp, "bench.db")
+    db.clear_cache()
+    db.init_db()
+    return db.DB_FILE
+
+
+def _report(name, ops, elapsed):
+    print(f"{name:<40} {ops / elapsed:>12,.0f} ops/s  ({elapsed * 1e6 / ops:.1f} мкс/оп)")
+
+
+# ===== DB: соединение на каждый вызов против пула =====
+def _connect_per_call():
+    # Так работал db._connect() до пула: новое соединение на каждый вызов
+    conn = sqlite3.connect(db.DB_FILE)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def bench_db(args):
+    _fresh_db()
+    for tid in range(1000):
+        db.register_musician(tid, "guitar", tid % 20, "рок", "Москва", "о себе")
+
+    n = args.ops
+    start = time.perf_counter()
+    for i in range(n):
+        with _connect_per_call() as conn:
+            conn.execute("SELECT * FROM musicians WHERE telegram_id=?", (i % 1000,)).fetchone()
+        conn.close()
+    _report("get_musician_profile (connect per call)", n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(n):
+        db._load_musician(i % 1000)  # мимо кэша чтений — меряем именно пул
+    _report("get_musician_profile (pooled)", n, time.perf_counter() - start)
+
+    n_writes = max(1, n // 10)
+    start = time.perf_counter()
+    for i in range(n_writes):
+        with _connect_per_call() as conn:
+            conn.execute("UPDATE musicians SET experience=? WHERE telegram_id=?", (i % 30, i % 1000))
+            conn.commit()
+        conn.close()
+    _report("update_musician (connect per call)", n_writes, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(n_writes):
+        db.update_musician(i % 1000, "experience", i % 30)
+    _report("update_musician (pooled, WAL)", n_writes, time.perf_counter() - start)
+
+
+# ===== MATCH: подбор музыкантов на большой таблице =====
+CITIES = ["Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Екатеринбург",
+          "Нижний Новгород", "Самара", "Омск", "Ростов-на-Дону", "Уфа",
+          "Химки", "Мытищи", "Подольск", "Тула", "Калуга"]
+GENRES = ["рок", "джаз", "поп", "метал", "блюз", "фанк", "инди", "панк"]
+INSTRUMENT_KEYS = ["vocal", "guitar", "bass", "drums", "keys", "other"]
+
+
+def _seed_musicians(rows, batch=50000):
+    rnd = random.Random(42)
+    conn = db._connect()
+    for start in range(0, rows, batch):
+        data = []
+        for tid in range(start, min(rows, start + batch)):
+            city = rnd.choice(CITIES)
+            data.append((
+                tid, rnd.choice(INSTRUMENT_KEYS), rnd.randint(0, 30),
+                ", ".join(rnd.sample(GENRES, 2)), f"{city}, ул. {tid % 100}", "о себе",
+                *db._location_columns(city),
+            ))
+        with conn:
+            conn.executemany("""
+                INSERT INTO musicians
+                (telegram_id, instrument, experience, genres, location_text, about, location_key, lat, lon)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, data)
+    conn.execute("ANALYZE")
+
+
+def bench_match(args):
+    _fresh_db()
+    start = time.perf_counter()
+    _seed_musicians(args.rows)
+    print(f"Сгенерировано {args.rows:,} музыкантов за {time.perf_counter() - start:.1f} с")
+
+    conn = db._connect()
+    queries = [(rnd_instr, city, exp) for rnd_instr, city, exp in zip(
+        INSTRUMENT_KEYS * 20, CITIES * 12, range(0, 120))]
+    n = len(queries)
+
+    start = time.perf_counter()
+    for instrument, city, exp in queries[:10]:
+        conn.execute("SELECT * FROM musicians WHERE instrument LIKE ? AND experience >= ?",
+                     (f"%{instrument}%", exp % 30)).fetchall()
+    _report("LIKE full scan (старый запрос)", 10, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for instrument, city, exp in queries:
+        db.find_musicians_by_text_location(instrument, city, exp % 30, "рок", radius_km=0)
+    _report("find_musicians_by_text_location, город", n, time.perf_counter() - start)
+
+    for radius in (50, 200):
+        start = time.perf_counter()
+        for instrument, city, exp in queries:
+            db.find_musicians_by_text_location(instrument, city, exp % 30, "рок", radius_km=radius)
+        _report(f"find_musicians_by_text_location, {radius} км", n, time.perf_counter() - start)
+
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM musicians WHERE instrument=? AND location_key=? "
+        "AND experience>=? ORDER BY experience DESC LIMIT 100", ("guitar", "москва", 5)
+    ).fetchall()
+    print("План запроса:", "; ".join(r["detail"] for r in plan))
+
+
+# ===== WEBHOOK: нагрузка синтетическими обновлениями на localhost =====
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float("nan")
+
+
+def bench_webhook(args):
+    import telebot
+    import webhook
+
+    bot = telebot.TeleBot("1:bench", threaded=False)
+    sent_at, done_at = {}, {}
+
+    @bot.message_handler(func=lambda m: True)
+    def handler(message):
+        time.sleep(args.handler_ms / 1000)  # имитация работы обработчика
+        done_at[int(message.text)] = time.perf_counter()
+
+    server = webhook.WebhookServer(bot, "/hook", secret="s3cret", workers=args.workers)
+    loop = asyncio.new_event_loop()
+    port = loop.run_until_complete(server.start("127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def client(ids, statuses):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for i in ids:
+            body = json.dumps({"update_id": i, "message": {
+                "message_id": i, "date": 0, "text": str(i),
+                "chat": {"id": i % 1000, "type": "private"},
+                "from": {"id": i % 1000, "is_bot": False, "first_name": "bench"}}}).encode()
+            sent_at[i] = time.perf_counter()
+            writer.write(b"POST /hook HTTP/1.1\r\nHost: localhost\r\n"
+                         b"X-Telegram-Bot-Api-Secret-Token: s3cret\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            statuses.append(status)
+        writer.close()
+
+    async def load():
+        statuses = []
+        ids = list(range(args.ops))
+        await asyncio.gather(*(client(ids[k::args.concurrency], statuses) for k in range(args.concurrency)))
+        return statuses
+
+    start = time.perf_counter()
+    statuses = asyncio.run(load())
+    while len(done_at) < statuses.count(200) and time.perf_counter() - start < 60:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+
+    latencies = [(done_at[i] - sent_at[i]) * 1000 for i in done_at]
+    print(f"обновлений: {args.ops}, принято: {statuses.count(200)}, 503: {statuses.count(503)}")
+    print(f"пропускная способность: {len(done_at) / elapsed:,.0f} обновлений/с")
+    print(f"задержка обработчика: p50 {_percentile(latencies, 50):.1f} мс, p99 {_percentile(latencies, 99):.1f} мс")
+
+
+# ===== ACCEPT: одновременные отклики на одну заявку =====
+def bench_accept(args):
+    """Из пула потоков шлём множество откликов на каждую заявку
+    и проверяем, что у каждой заявки ровно один победитель."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    _fresh_db()
+    per_request = 500
+    requests = max(1, args.ops // per_request)
+    req_ids = [db.create_band_request(1, "guitar", "Рок", "bench", "Москва", 0) for _ in range(requests)]
+    attempts = [(req_id, musician) for req_id in req_ids for musician in range(per_request)]
+    random.Random(3).shuffle(attempts)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda a: (a, db.assign_musician(*a)), attempts))
+    elapsed = time.perf_counter() - start
+
+    winners = {}
+    for (req_id, musician), req in results:
+        if req:
+            assert req["accepted_by"] == musician
+            winners.setdefault(req_id, []).append(musician)
+    assert all(len(winners.get(r, [])) == 1 for r in req_ids), "у заявки не один победитель"
+    for req_id in req_ids:
+        assert db.get_band_request(req_id)["accepted_by"] == winners[req_id][0]
+    print(f"{requests} заявок x {per_request} откликов, {args.concurrency} потоков: у каждой ровно один победитель")
+    _report("assign_musician (конкурентно)", len(attempts), elapsed)
+
+
+# ===== CLASSIFY: локальное определение жанра =====
+def bench_classify(args):
+    import openrouter
+
+    rnd = random.Random(5)
+    words = ("ищем барабанщика играем хард рок и немного джаз фанк репетиции по выходным "
+             "каверы и свои песни поп метал концерты в клубах опыт от трёх лет").split()
+    texts = [" ".join(rnd.choices(words, k=rnd.randint(8, 40))) for _ in range(2000)]
+
+    def chain(description):
+        # Прежняя цепочка проверок in
+        description = description.lower()
+        for needle, genre in (("рок", "Рок"), ("джаз", "Джаз"), ("поп", "Поп"), ("метал", "Метал")):
+            if needle in description:
+                return genre
+        return "Разное"
+
+    # Тексты без единого жанра — худший случай: проверяются все слова
+    texts += [" ".join(w for w in t.split() if w not in ("рок", "джаз", "поп", "метал")) for t in texts]
+    local = openrouter.KeywordClassifier()
+    for t in texts:
+        assert local.classify(t.lower()) == chain(t), f"{t!r}: жанр не совпал с прежней цепочкой"
+        assert openrouter.analyze_band_description(t)["genre"] == chain(t)
+
+    n = args.ops
+    for name, fn in (("цепочка in (старый код)", chain),
+                     ("KeywordClassifier", lambda t: local.classify(t.lower())),
+                     ("analyze_band_description", openrouter.analyze_band_description)):
+        start = time.perf_counter()
+        for i in range(n):
+            fn(texts[i % len(texts)])
+        _report(name, n, time.perf_counter() - start)
+    print("жанры совпадают с прежней цепочкой на", len(texts), "текстах")
+
+
+# ===== GENRE REMOTE: удалённый классификатор против локальной заглушки API =====
+def _stub_openrouter(timeout):
+    """Локальный OpenAI-совместимый /chat/completions. Ответ зависит от текста:
+    «медленно» — дольше таймаута, «мусор» — слово не из списка жанров,
+    «сломано» — не JSON; иначе «Джаз». Возвращает (сервер, список запросов)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            text = body["messages"][-1]["content"]
+            seen.append(text)
+            if "медленно" in text:
+                time.sleep(timeout * 2)
+            payload = b"not json" if "сломано" in text else json.dumps({
+                "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "мусор" if "мусор" in text else "Джаз."}}],
+            }).encode()
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            except OSError:
+                pass   # клиент уже ушёл по таймауту
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, seen
+
+
+def bench_remote(args):
+    """RemoteClassifier против заглушки OPENROUTER_BASE_URL: ответ модели используется,
+    таймаут и мусорный ответ уходят в KeywordClassifier, попадание в кэш не ходит в сеть,
+    а асинхронный путь не держит поток обработчика."""
+    import openrouter
+
+    timeout = 0.3
+    server, seen = _stub_openrouter(timeout)
+    saved = openrouter.classifier
+    openrouter.classifier = openrouter.RemoteClassifier(
+        "stub-key", fallback=openrouter.KeywordClassifier(),
+        base_url=f"http://127.0.0.1:{server.server_port}", timeout=timeout)
+    openrouter._cache.clear()
+    try:
+        start = time.perf_counter()
+        assert openrouter.analyze_band_description("играем рок")["genre"] == "Джаз", "ответ модели не использован"
+        print(f"ответ модели: {(time.perf_counter() - start) * 1000:.1f} мс")
+
+        for text in ("медленно играем рок", "мусор играем рок", "сломано играем рок"):
+            start = time.perf_counter()
+            genre = openrouter.analyze_band_description(text)["genre"]
+            elapsed = time.perf_counter() - start
+            assert genre == "Рок", f"{text!r}: {genre}, а не жанр KeywordClassifier"
+            assert elapsed < timeout + 0.5, f"{text!r}: {elapsed:.2f} с — таймаут не сработал"
+            print(f"{text.split()[0]:<10} → fallback {genre}, {elapsed * 1000:.0f} мс")
+
+        calls = len(seen)
+        assert openrouter.analyze_band_description("Играем   РОК")["genre"] == "Джаз"
+        assert len(seen) == calls, "попадание в кэш ушло в сеть"
+        assert openrouter.analyze_band_description_async("играем рок").done(), "кэш не вернул готовый Future"
+
+        start = time.perf_counter()
+        future = openrouter.analyze_band_description_async("медленно играем джаз")
+        submitted = time.perf_counter() - start
+        assert submitted < timeout / 2, f"асинхронный вызов ждал модель {submitted:.2f} с"
+        assert future.result()["genre"] == "Джаз"
+        print(f"асинхронно: поток обработчика занят {submitted * 1000:.2f} мс, запросов к заглушке {len(seen)}")
+    finally:
+        openrouter.classifier = saved
+        openrouter._cache.clear()
+        server.shutdown()
+    print("удалённый классификатор: ответ, fallback и кэш в порядке")
+
+
+# ===== REVERSE: новый профиль против открытых заявок =====
+def bench_reverse(args):
+    _fresh_db()
+    rnd = random.Random(11)
+    conn = db._connect()
+    with conn:
+        conn.executemany("""
+            INSERT INTO band_requests
+            (band_id, instrument, genre, description, location_text, min_experience, location_key, accepted_by)
+            VALUES (?, ?, 'Рок', 'bench', ?, ?, ?, ?)
+        """, (
+            (rnd.randint(1, 10**6), rnd.choice(INSTRUMENT_KEYS), city, rnd.randint(0, 15),
+             db.normalize_location(city), None if rnd.random() < 0.8 else 1)
+            for city in (rnd.choice(CITIES) for _ in range(args.rows))
+        ))
+    conn.execute("ANALYZE")
+    open_count = conn.execute("SELECT COUNT(*) FROM band_requests WHERE accepted_by IS NULL").fetchone()[0]
+    print(f"Заявок: {args.rows:,}, открытых: {open_count:,}")
+
+    profiles = [{"telegram_id": 10**7 + i, "instrument": rnd.choice(INSTRUMENT_KEYS),
+                 "experience": rnd.randint(0, 20), "location_key": db.normalize_location(rnd.choice(CITIES))}
+                for i in range(2000)]
+
+    start = time.perf_counter()
+    for p in profiles[:5]:
+        conn.execute("SELECT * FROM band_requests WHERE instrument=? AND min_experience<=? AND accepted_by IS NULL",
+                     (p["instrument"], p["experience"])).fetchall()
+    _report("полный перебор заявок", 5, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    matched = 0
+    for p in profiles:
+        requests = db.find_open_requests_for_musician(p)
+        matched += len(db.record_alerts((r["id"], p["telegram_id"]) for r in requests))
+    _report("find_open_requests + record_alerts", len(profiles), time.perf_counter() - start)
+    print(f"в среднем заявок на профиль: {matched / len(profiles):.1f} (предел {db.REVERSE_MATCH_LIMIT})")
+
+
+# ===== SEARCH: постраничный поиск по большому числу совпадений =====
+def bench_search(args):
+    """Листание поиска keyset-курсорами по --rows гитаристам со стажем 0–3 (много равных
+    experience): каждая строка ровно один раз в порядке (experience, telegram_id) по убыванию,
+    а обратное листание с последней страницы повторяет прямое в обратном порядке."""
+    import tracemalloc
+
+    _fresh_db()
+    rnd = random.Random(13)
+    conn = db._connect()
+    experience = {tid: rnd.randint(0, 3) for tid in range(args.rows)}
+    with conn:
+        conn.executemany(
+            "INSERT INTO musicians (telegram_id, instrument, experience, genres, location_text, about, location_key) "
+            "VALUES (?, 'guitar', ?, 'рок', 'Москва', 'о себе', 'москва')",
+            experience.items()
+        )
+    conn.execute("ANALYZE")
+    expected = sorted(((exp, tid) for tid, exp in experience.items()), reverse=True)
+    print(f"Гитаристов: {args.rows:,}")
+
+    # Листаем вперёд до конца, замеряя каждую страницу и пик памяти
+    tracemalloc.start()
+    timings, forward, after = [], [], None
+    while True:
+        start = time.perf_counter()
+        page, more = db.search_musicians_page("guitar", 0, after=after)
+        timings.append((time.perf_counter() - start) * 1e6)
+        forward.append([(m["experience"], m["telegram_id"]) for m in page])
+        if not more:
+            break
+        after = forward[-1][-1]
+    current, peak = tracemalloc.get_traced_memory()   # current — собранные для проверки ключи
+    tracemalloc.stop()
+    print(f"страниц вперёд: {len(forward):,}, пик памяти сверх собранных ключей: {(peak - current) / 1024:.0f} КБ")
+    for label, chunk in (("первые 100", timings[:100]), ("середина", timings[len(timings) // 2:][:100]),
+                         ("последние 100", timings[-100:])):
+        print(f"  {label:<14} p50 {_percentile(chunk, 50):7.1f} мкс, p99 {_percentile(chunk, 99):7.1f} мкс")
+    rows = list(itertools.chain(*forward))
+    assert len(rows) == len(set(rows)) == args.rows, f"строк {len(rows):,}, разных {len(set(rows)):,}"
+    assert rows == expected, "порядок (experience, telegram_id) DESC нарушен"
+    assert all(len(p) == db.SEARCH_PAGE_SIZE for p in forward[:-1]), "неполная страница в середине"
+
+    # И назад с последней страницы: те же страницы в обратном порядке
+    start = time.perf_counter()
+    backward, before = [], forward[-1][0]
+    while True:
+        page, more = db.search_musicians_page("guitar", 0, before=before)
+        backward.append([(m["experience"], m["telegram_id"]) for m in page])
+        if not more:
+            break
+        before = backward[-1][0]
+    _report("страница назад", len(backward), time.perf_counter() - start)
+    assert backward[::-1] == forward[:-1], "обратное листание не повторяет прямое"
+    print("прямое и обратное листание: все строки по одному разу, порядок верный")
+
+
+# ===== CACHE: повторные чтения профилей и заявок =====
+def bench_cache(args):
+    _fresh_db()
+    users, bands = 1000, 200
+    for tid in range(users):
+        db.register_musician(tid, "guitar", tid % 20, "рок", "Москва", "о себе")
+    req_ids = [db.create_band_request(100000 + i % bands, "guitar", "Рок", "описание", "Москва", 0)
+               for i in range(bands * 5)]
+
+    # Как в боте: одни и те же профили и заявки читаются снова и снова
+    rnd = random.Random(14)
+    reads = [(rnd.randrange(3), rnd.randrange(users)) for _ in range(args.ops)]
+
+    def run(profile, request, requests):
+        start = time.perf_counter()
+        for kind, i in reads:
+            if kind == 0:
+                profile(i)
+            elif kind == 1:
+                request(req_ids[i % len(req_ids)])
+            else:
+                requests(100000 + i % bands)
+        return time.perf_counter() - start
+
+    _report("чтения без кэша", args.ops, run(db._load_musician, db._load_band_request, db._load_band_requests))
+    db.clear_cache()
+    _report("чтения через кэш", args.ops, run(db.get_musician_profile, db.get_band_request, db.get_band_requests))
+    print(f"кэш: {db.cache_stats()}")
+
+    # Согласованность: случайные записи вперемешку с чтениями, кэш сверяется с базой
+    checks = max(1, args.ops // 10)
+    for step in range(checks):
+        tid, band = rnd.randrange(users), 100000 + rnd.randrange(bands)
+        req_id = rnd.choice(req_ids)
+        op = rnd.randrange(5)
+        if op == 0:
+            db.update_musician(tid, "experience", rnd.randint(0, 30))
+        elif op == 1:
+            db.register_musician(tid, "bass", rnd.randint(0, 30), "джаз", "Казань", "заново")
+        elif op == 2:
+            req_ids.append(db.create_band_request(band, "drums", "Джаз", "ещё", "Тула", 1))
+        elif op == 3:
+            db.assign_musician(req_id, tid)
+        else:
+            db.cancel_band_request(req_id, band)
+        assert db.get_musician_profile(tid) == db._load_musician(tid), tid
+        assert db.get_band_request(req_id) == db._load_band_request(req_id), req_id
+        assert db.get_band_requests(band) == db._load_band_requests(band), band
+    print(f"{checks:,} случайных изменений: кэш совпадает с базой")
+
+    # Запись между промахом и сохранением: прочитанное до неё в кэш не попадает
+    tid = 0
+    db._invalidate(f"musician:{tid}")
+
+    def load_then_write():
+        stale = db._load_musician(tid)
+        db.update_musician(tid, "experience", stale["experience"] + 1)
+        return stale
+
+    db._cached(f"musician:{tid}", load_then_write)
+    assert db.get_musician_profile(tid) == db._load_musician(tid), "в кэше профиль до записи"
+
+    # Перезапись заявки с другим владельцем: устаревает и список прежнего
+    req_id, old_band, new_band = req_ids[0], 100000, 100001
+    db.import_band_requests([(req_id, old_band, "guitar", "Рок", "описание", "Москва", 0, None)])
+    assert any(r["id"] == req_id for r in db.get_band_requests(old_band))
+    db.import_band_requests([(req_id, new_band, "guitar", "Рок", "описание", "Москва", 0, None)])
+    assert db.get_band_requests(old_band) == db._load_band_requests(old_band), "список прежнего владельца устарел"
+    assert db.get_band_requests(new_band) == db._load_band_requests(new_band)
+    print("запись во время промаха и смена владельца при импорте: кэш совпадает с базой")
+
+
+# ===== UPDATES: порядок внутри чата и масштабирование по шардам =====
+def bench_updates(args):
+    import telebot
+    from telebot import types
+    import updates
+
+    chats = 200
+    stream = [types.Update.de_json({"update_id": i, "message": {
+        "message_id": i, "date": 0, "text": str(i // chats),
+        "chat": {"id": i % chats, "type": "private"},
+        "from": {"id": i % chats, "is_bot": False, "first_name": "bench"}}})
+        for i in range(args.ops)]
+    print(f"обновлений: {args.ops:,}, чатов: {chats}, обработчик {args.handler_ms} мс")
+
+    for workers in (1, 2, 4, 8, 16, 32):
+        bot = telebot.TeleBot("1:bench")
+        seen = {}
+
+        @bot.message_handler(func=lambda m: True)
+        def handler(message):
+            time.sleep(args.handler_ms / 1000)
+            seen.setdefault(message.chat.id, []).append(int(message.text))
+
+        dispatcher = updates.install(bot, workers=workers, queue_size=50)
+        start = time.perf_counter()
+        for k in range(0, len(stream), 100):
+            bot.process_new_updates(stream[k:k + 100])   # как пачка из getUpdates
+        dispatcher.join()
+        elapsed = time.perf_counter() - start
+        dispatcher.stop()
+
+        for chat, seqs in seen.items():
+            assert seqs == sorted(seqs) and len(seqs) == len(set(seqs)), f"порядок нарушен в чате {chat}"
+        assert sum(map(len, seen.values())) == args.ops
+        stats = dispatcher.stats()
+        print(f"шардов {workers:>3}: {args.ops / elapsed:>8,.0f} обновлений/с, "
+              f"макс. очередь {max(s['max_depth'] for s in stats):>3}, "
+              f"ожидание места {sum(s['blocked_s'] for s in stats):.2f} с, порядок соблюдён")
+
+
+# ===== BROADCAST: диспетчер рассылки против локального Bot API =====
+def _run_dispatcher(chats, per_chat, **fake):
+    """Ставит per_chat сообщений в каждый из chats чатов и ждёт, пока Dispatcher
+    разберёт очередь через loadtest.FakeTelegram. Возвращает (api.sent, секунд)."""
+    import telebot
+    from telebot import apihelper
+
+    import broadcast
+    import loadtest
+
+    _fresh_db()
+    api = loadtest.FakeTelegram(**fake)
+    saved, apihelper.API_URL = apihelper.API_URL, api.url
+    db.enqueue_messages((chat_id, f"сообщение {i}", None)
+                        for i in range(per_chat) for chat_id in range(1, chats + 1))
+    dispatcher = broadcast.Dispatcher(telebot.TeleBot("1:bench", threaded=False))
+    start = time.perf_counter()
+    dispatcher.start()
+    try:
+        deadline = start + 120
+        while db.count_pending_messages() and time.perf_counter() < deadline:
+            time.sleep(0.02)
+    finally:
+        dispatcher.stop(5)
+        api.close()
+        apihelper.API_URL = saved
+    assert db.count_pending_messages() == 0, "очередь не разобрана за 120 с"
+    delivered = {}
+    for _, chat_id, status in api.sent:
+        if status == 200:
+            delivered[chat_id] = delivered.get(chat_id, 0) + 1
+    assert delivered == {c: per_chat for c in range(1, chats + 1)}, "сообщение потеряно или отправлено дважды"
+    return api.sent, time.perf_counter() - start
+
+
+def _per_chat_gaps(sent):
+    last, gaps = {}, []
+    for t, chat_id, status in sent:
+        if status == 200:
+            if chat_id in last:
+                gaps.append(t - last[chat_id])
+            last[chat_id] = t
+    return gaps
+
+
+def bench_broadcast(args):
+    """broadcast.Dispatcher против loadtest.FakeTelegram. Без 429 запросы sendMessage
+    укладываются в корзину GLOBAL_RATE (запас + GLOBAL_RATE в секунду в любом окне),
+    в один чат — не чаще PER_CHAT_INTERVAL. С --api-rps и --flood-rate сервер отвечает 429:
+    после каждого ответа рассылка молчит retry_after секунд. В обоих прогонах каждое
+    сообщение доставлено ровно один раз."""
+    import broadcast
+    import loadtest
+
+    rate, slack = broadcast.GLOBAL_RATE, 0.01
+    chats, per_chat = 4 * rate, 2
+    sent, elapsed = _run_dispatcher(chats, per_chat)
+    times = sorted(t for t, _, _ in sent)
+    for window in (1.0, 2.0):
+        peak = max(bisect.bisect_left(times, t + window) - i for i, t in enumerate(times))
+        assert peak <= rate + rate * window + 1, f"{peak} запросов за {window} с при лимите {rate}/с"
+        print(f"окно {window:.0f} с: не больше {peak} запросов (запас {rate} + {rate}/с)")
+    steady = (len(times) - rate) / (times[-1] - times[0])
+    print(f"{len(times)} сообщений в {chats} чатов за {elapsed:.1f} с: после запаса {steady:.1f}/с "
+          f"(лимит {rate}/с)")
+
+    # Мало чатов и много сообщений: упирается уже лимит чата, а не общий
+    sent, elapsed = _run_dispatcher(3, 4)
+    gaps = _per_chat_gaps(sent)
+    assert min(gaps) >= broadcast.PER_CHAT_INTERVAL - slack, f"в чат через {min(gaps):.3f} с"
+    print(f"3 чата по 4 сообщения за {elapsed:.1f} с: интервал в чат от {min(gaps):.2f} с "
+          f"(лимит {broadcast.PER_CHAT_INTERVAL} с)")
+
+    api_rps, flood_rate = args.api_rps, args.flood_rate
+    sent, elapsed = _run_dispatcher(chats // 4, per_chat, rps=api_rps, flood_rate=flood_rate)
+    throttled = [i for i, (_, _, status) in enumerate(sent) if status == 429]
+    assert throttled, "сервер ни разу не ответил 429 — проверять нечего"
+    pauses = [sent[i + 1][0] - sent[i][0] for i in throttled if i + 1 < len(sent)]
+    assert min(pauses) >= loadtest.RETRY_AFTER - slack, f"после 429 отправка через {min(pauses):.3f} с"
+    print(f"Bot API {api_rps}/с, доля 429 {flood_rate:.0%}: {len(sent) - len(throttled)} сообщений "
+          f"за {elapsed:.1f} с, 429 — {len(throttled)}, пауза после 429 от {min(pauses):.2f} с "
+          f"(retry_after {loadtest.RETRY_AFTER} с)")
+    print("лимиты рассылки соблюдены, каждое сообщение доставлено один раз")
+
+
+# ===== CLUSTER: приёмник + рабочие процессы против фейкового Bot API =====
+def _run_cluster(workers, stream, args, kill_after=None):
+    import signal
+    from telebot import apihelper
+    import cluster
+    import loadtest
+
+    _fresh_db()
+    api = loadtest.FakeTelegram(latency=args.handler_ms / 1000)
+    for update in stream:
+        api.post_update(update)
+    os.environ.update(TOKEN="1:bench", DB_FILE=db.DB_FILE, TELEGRAM_API_URL=api.url)
+    apihelper.API_URL = api.url
+    ingress = cluster.Ingress(workers).start()
+    poller = threading.Thread(target=ingress.poll_forever, args=("1:bench",), daemon=True)
+    poller.start()
+
+    killed = False
+    deadline = time.perf_counter() + 120
+    while time.perf_counter() < deadline:
+        done = len(api.sent)
+        if kill_after and not killed and done >= kill_after:
+            os.kill(ingress.procs[0].pid, signal.SIGKILL)
+            killed = True
+        if done >= len(stream) and db.count_spooled() == 0:
+            break
+        time.sleep(0.01)
+    ingress.stop()
+    api.close()
+    sent = [(t, chat_id) for t, chat_id, status in api.sent if status == 200]
+    times = [t for t, _ in sent]
+    return sent, (max(times) - min(times)) if times else 0.0, ingress.restarts
+
+
+def bench_cluster(args):
+    chats = 500
+    stream = [{"update_id": i + 1, "message": {
+        "message_id": i + 1, "date": 0, "text": "ℹ️ О боте",
+        "chat": {"id": i % chats, "type": "private"},
+        "from": {"id": i % chats, "is_bot": False, "first_name": "bench"}}}
+        for i in range(args.ops)]
+    print(f"обновлений: {args.ops:,}, чатов: {chats}, ответ Bot API {args.handler_ms} мс, "
+          f"ядер: {os.cpu_count()}")
+
+    for workers in (1, 2, 4, 8):
+        sent, elapsed, _ = _run_cluster(workers, stream, args)
+        assert len(sent) >= len(stream), (len(sent), len(stream))
+        print(f"рабочих процессов {workers}: {len(stream) / elapsed:>8,.0f} обновлений/с")
+
+    # Падение рабочего посреди потока: необработанное дочитывается после перезапуска
+    sent, _, restarts = _run_cluster(2, stream, args, kill_after=len(stream) // 3)
+    per_chat = {}
+    for _, chat_id in sent:
+        per_chat[chat_id] = per_chat.get(chat_id, 0) + 1
+    expected = {c: len(range(c, len(stream), chats)) for c in range(chats)}
+    assert all(per_chat.get(c, 0) >= n for c, n in expected.items()), "потеряны обновления"
+    print(f"SIGKILL рабочего: перезапусков {restarts}, потерь нет, "
+          f"повторно обработано {len(sent) - len(stream)}")
+
+
+# ===== METRICS: накладные расходы инструментирования =====
+def bench_metrics(args):
+    import urllib.request
+    import metrics
+
+    n = args.ops
+    hist = metrics.histogram("bench_seconds", "bench", ["op"]).labels("x")
+    count = metrics.counter("bench_total", "bench", ["op"]).labels("x")
+
+    def plain():
+        pass
+
+    wrapped = metrics.timed(metrics.histogram("bench_call_seconds", "bench", ["fn"]))(plain)
+
+    def loop(fn):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - start) * 1e6 / n
+
+    base = loop(plain)
+    print(f"{'пустой вызов':<34} {base:6.2f} мкс")
+    print(f"{'counter.inc()':<34} {loop(count.inc):6.2f} мкс")
+    print(f"{'histogram.observe()':<34} {loop(lambda: hist.observe(0.003)) - base:6.2f} мкс сверх вызова")
+    print(f"{'with histogram.time()':<34} {loop(lambda: hist.time().__enter__().__exit__()) - base:6.2f} мкс сверх вызова")
+    print(f"{'@timed':<34} {loop(wrapped) - base:6.2f} мкс сверх вызова")
+
+    # Запрос к базе с метрикой и без — та же функция до и после декоратора
+    _fresh_db()
+    db.register_musician(1, "guitar", 5, "рок", "Москва", "о себе")
+    load = db._load_musician
+    raw = load.__wrapped__
+    m = max(1, n // 20)
+    start = time.perf_counter()
+    for _ in range(m):
+        raw(1)
+    t_raw = (time.perf_counter() - start) * 1e6 / m
+    start = time.perf_counter()
+    for _ in range(m):
+        load(1)
+    t_timed = (time.perf_counter() - start) * 1e6 / m
+    print(f"{'get_musician_profile из базы':<34} {t_raw:6.2f} мкс, с метрикой {t_timed:6.2f} мкс")
+
+    # Выборочный профилировщик на работающем цикле
+    metrics.profiler.start()
+    during = loop(wrapped) - base
+    metrics.profiler.stop()
+    print(f"{'@timed при включённом профайлере':<34} {during:6.2f} мкс, выборок {metrics.profiler.samples}")
+
+    server = metrics.serve(0)
+    start = time.perf_counter()
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+        text = response.read().decode()
+    print(f"GET /metrics: {len(text.splitlines())} строк за {(time.perf_counter() - start) * 1000:.1f} мс")
+    server.shutdown()
+
+
+# ===== LOGGING: задержка обработчика с логированием и без =====
+def bench_logging(args):
+    import logging
+    import queue
+    from logging.handlers import QueueListener
+    import telebot
+    from telebot import types
+    import logging_config
+    import metrics
+    import updates
+
+    tmp = tempfile.mkdtemp(prefix="bandfinder-log-")
+    stream = [types.Update.de_json({"update_id": i, "message": {
+        "message_id": i, "date": 0, "text": str(i),
+        "chat": {"id": i % 200, "type": "private"},
+        "from": {"id": i % 200, "is_bot": False, "first_name": "bench"}}})
+        for i in range(args.ops)]
+    root = logging.getLogger()
+    log = logging.getLogger("bandfinder.bench")
+
+    class SlowDisk:
+        # Каждая запись на «диск» стоит disk_ms (fsync, сетевой диск, загруженный том)
+        def __init__(self, output):
+            self.output = output
+            self.emit = output.emit
+            output.emit = self.slow_emit
+
+        def slow_emit(self, record):
+            time.sleep(args.disk_ms / 1000)
+            self.emit(record)
+
+    def configure(mode):
+        root.handlers[:] = []
+        root.setLevel(logging.INFO)
+        if mode == "выключено":
+            root.setLevel(logging.CRITICAL)
+            return None
+        path = os.path.join(tmp, mode.replace(" ", "_") + ".log")
+        if mode == "синхронно в файл":
+            # Как раньше: запись на диск прямо из потока обработчика
+            output = logging.FileHandler(path, encoding="utf-8")
+            output.setFormatter(logging.Formatter(logging_config.TEXT_FORMAT))
+            SlowDisk(output)
+            root.addHandler(output)
+            return None
+        output = logging_config.CompressingRotatingFileHandler(path, max_bytes=1024 * 1024)
+        output.setFormatter(logging_config.JsonFormatter())
+        SlowDisk(output)
+        handler = logging_config._QueueHandler(queue.Queue(logging_config.QUEUE_SIZE))
+        handler.addFilter(logging_config.ContextFilter())
+        root.addHandler(handler)
+        listener = QueueListener(handler.queue, output)
+        listener.start()
+        return listener
+
+    print(f"обновлений: {args.ops:,}, шардов: {args.workers}, 3 записи лога на обработчик, "
+          f"запись на диск {args.disk_ms} мс")
+    for mode in ("выключено", "синхронно в файл", "очередь + JSON + ротация"):
+        listener = configure(mode)
+        bot = telebot.TeleBot("1:bench")
+        durations = []
+
+        @bot.message_handler(func=lambda m: True)
+        @metrics.handler
+        def handler(message):
+            start = time.perf_counter()
+            log.info("получено сообщение %s", message.text)
+            sum(range(200))   # немного работы
+            log.info("обработано")
+            log.warning("предупреждение для чата %s", message.chat.id)
+            durations.append((time.perf_counter() - start) * 1e6)
+
+        bot.process_new_updates = logging_config.update_context(bot.process_new_updates)
+        dispatcher = updates.install(bot, workers=args.workers)
+        start = time.perf_counter()
+        bot.process_new_updates(stream)
+        dispatcher.join()
+        elapsed = time.perf_counter() - start
+        dispatcher.stop()
+        dropped_before = logging_config.dropped_records()
+        if listener:
+            listener.stop()
+        print(f"{mode:<26} {args.ops / elapsed:>9,.0f} обновлений/с, обработчик "
+              f"p50 {_percentile(durations, 50):7.1f} мкс, p99 {_percentile(durations, 99):8.1f} мкс")
+    print(f"отброшено записей при переполненной очереди: {dropped_before}")
+    root.handlers[:] = []
+    sample = open(os.path.join(tmp, "очередь_+_JSON_+_ротация.log"), encoding="utf-8").readline()
+    print(f"пример записи: {sample.strip()}")
+
+
+# ===== BULK: импорт и экспорт файлами против register_musician по строке =====
+def bench_bulk(args):
+    import csv
+    import tracemalloc
+
+    import bulk
+
+    _fresh_db()
+    tmp = os.path.dirname(db.DB_FILE)
+    rnd = random.Random(20)
+    source = os.path.join(tmp, "musicians.csv")
+    labels = ["гитара", "Бас 🎵", "drums", "Клавиши", "вокал", "укулеле"]   # последний не пройдёт проверку
+    with open(source, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(db.MUSICIAN_COLUMNS)
+        for tid in range(1, args.rows + 1):
+            writer.writerow((tid, rnd.choice(labels), rnd.randint(0, 30), ", ".join(rnd.sample(GENRES, 2)),
+                             f"{rnd.choice(CITIES)}, ул. {tid % 100}", "о себе"))
+
+    # Как раньше: тот же файл, register_musician на каждую строку, свой коммит на каждую
+    rows = 0
+    start = time.perf_counter()
+    with open(source, encoding="utf-8", newline="") as f:
+        for _, row in itertools.islice(bulk.read_rows(f, "csv"), min(args.rows, 20000)):
+            try:
+                db.register_musician(*bulk.validate_musician(row))
+                rows += 1
+            except ValueError:
+                pass
+    per_row = rows / (time.perf_counter() - start)
+    print(f"{'register_musician по строке':<34} {per_row:>10,.0f} строк/с")
+
+    _fresh_db()
+    result = bulk.import_file("musicians", source)
+    rate = result["imported"] / result["seconds"]
+    print(f"{'bulk.import_file (CSV)':<34} {rate:>10,.0f} строк/с  (x{rate / per_row:.1f})")
+    print(f"  загружено {result['imported']:,}, отклонено {result['rejected']:,}")
+
+    # Память — отдельным прогоном: под tracemalloc всё медленнее в разы
+    _fresh_db()
+    tracemalloc.start()
+    bulk.import_file("musicians", source)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  пик памяти при загрузке: {peak / 2 ** 20:.1f} МБ")
+
+    exported = os.path.join(tmp, "musicians.jsonl")
+    start = time.perf_counter()
+    count = bulk.export_file("musicians", exported)
+    print(f"{'bulk.export_file (JSONL)':<34} {count / (time.perf_counter() - start):>10,.0f} строк/с")
+
+    # Круговая проверка: выгрузка, загрузка в чистую базу и снова выгрузка — то же самое.
+    # Строки не-объекты и битый JSON отклоняются по одной, не прерывая загрузку
+    before = list(db.iter_table("musicians"))
+    with open(exported, "a", encoding="utf-8") as f:
+        f.write('123\n[1, 2]\nnull\n{"telegram_id": \n')
+    _fresh_db()
+    result = bulk.import_file("musicians", exported)
+    assert result["rejected"] == 4, result
+    assert list(db.iter_table("musicians")) == before
+    assert db.find_musicians_by_text_location("guitar", "Москва", 0)
+    print(f"экспорт -> импорт: {len(before):,} строк совпадают")
+
+
+# ===== VECTORS: ранжирование по описанию и поиск ближайших на N профилях =====
+def bench_vectors(args):
+    import numpy as np
+
+    import vectors
+
+    rnd = random.Random(21)
+    styles = ["блюзовые импровизации", "джазовый свинг", "тяжёлые риффы", "каверы на поп-хиты",
+              "инди с синтезаторами", "панк три аккорда", "фанковый грув", "классическое образование"]
+    texts = [vectors.musician_text(", ".join(rnd.sample(GENRES, 2)),
+                                   f"{rnd.choice(styles)}, {rnd.choice(styles)}, опыт {rnd.randint(1, 30)} лет")
+             for _ in range(20000)]
+    start = time.perf_counter()
+    pool = np.array([vectors.embed(t) for t in texts])
+    _report("embed", len(texts), time.perf_counter() - start)
+
+    # Матрица на --rows профилей: тексты из пула с небольшим шумом
+    tmp = tempfile.mkdtemp(prefix="bandfinder-bench-")
+    store = vectors.VectorStore(os.path.join(tmp, "bench.vec"))
+    nrnd = np.random.default_rng(21)
+    start = time.perf_counter()
+    for lo in range(0, args.rows, 100000):
+        n = min(100000, args.rows - lo)
+        chunk = pool[nrnd.integers(0, len(pool), n)] + nrnd.normal(0, 0.05, (n, vectors.DIM)).astype(np.float32)
+        store.write(np.arange(lo, lo + n), chunk / np.linalg.norm(chunk, axis=1, keepdims=True))
+    store.flush()
+    print(f"матрица: {args.rows:,} x {vectors.DIM} int8 = {args.rows * vectors.DIM / 2 ** 20:.0f} МБ, "
+          f"запись {time.perf_counter() - start:.1f} с")
+
+    queries = [vectors.embed(vectors.request_text(rnd.choice(GENRES), rnd.choice(styles))) for _ in range(200)]
+
+    def timed(fn, runs):
+        durations = []
+        for q in queries[:runs]:
+            start = time.perf_counter()
+            fn(q)
+            durations.append((time.perf_counter() - start) * 1000)
+        return durations
+
+    def show(label, durations):
+        print(f"{label:<36} p50 {_percentile(durations, 50):7.2f} мс, p99 {_percentile(durations, 99):7.2f} мс")
+
+    candidates = [nrnd.integers(0, args.rows, db.VECTOR_CANDIDATES).tolist() for _ in range(len(queries))]
+    it = iter(candidates)
+    show(f"ранжирование {db.VECTOR_CANDIDATES} кандидатов", timed(lambda q: store.score(next(it), q), 200))
+    exact = {}
+    show("top-10 полным перебором", timed(lambda q: exact.setdefault(id(q), store.top_k(q, 10, args.rows, exact=True)), 20))
+
+    start = time.perf_counter()
+    index = store.build_index(args.rows)
+    print(f"индекс IVF: {len(index.centroids)} кластеров, сборка {time.perf_counter() - start:.1f} с")
+    for nprobe in (8, 16, 32):
+        show(f"top-10 IVF, nprobe={nprobe}", timed(lambda q: store.top_k(q, 10, args.rows, nprobe=nprobe), 200))
+        recall = [len(set(store.top_k(q, 10, args.rows, nprobe=nprobe)[0]) & set(exact[id(q)][0])) / 10
+                  for q in queries[:20]]
+        print(f"  recall@10 против перебора: {sum(recall) / len(recall):.2f}")
+
+    # Весь подбор через db на min(--rows, 200000) профилях
+    rows = min(args.rows, 200000)
+    _fresh_db()
+    _seed_musicians(rows)
+    start = time.perf_counter()
+    db.init_db()   # досчитывает векторы профилей, вставленных в обход register_musician
+    print(f"векторы {rows:,} профилей из базы: {time.perf_counter() - start:.1f} с")
+    for label, description in (("подбор по жанрам", None), ("подбор по описанию", "блюзовые импровизации")):
+        durations = []
+        for i in range(200):
+            start = time.perf_counter()
+            db.find_musicians_by_text_location(INSTRUMENT_KEYS[i % 6], CITIES[i % len(CITIES)], 0, "рок",
+                                               description=description)
+            durations.append((time.perf_counter() - start) * 1000)
+        show(label, durations)
+
+
+# ===== WRITES: группировка записей в общие транзакции =====
+def _write_op(rnd, i):
+    """Смесь записей обработчиков: шаги диалогов, правка профиля, заявка, отклик."""
+    r = rnd.random()
+    if r < 0.6:
+        db.set_session(rnd.randrange(10000), "musician_genres", '{"exp": 5}', time.time())
+    elif r < 0.8:
+        db.update_musician(rnd.randrange(1000), "experience", i % 30)
+    elif r < 0.9:
+        db.create_band_request(rnd.randrange(1000), "guitar", "рок", "bench", "Москва", 0)
+    else:
+        db.assign_musician(rnd.randrange(1, 1000), rnd.randrange(1000))
+
+
+def bench_writes(args):
+    """Потоки обработчиков пишут в базу; сравниваем коммит на каждую запись
+    и группировку (groupcommit.py) при synchronous=NORMAL и FULL."""
+    modes = [
+        ("коммит на запись, NORMAL", False, 0, "NORMAL"),
+        ("коммит на запись, FULL", False, 0, "FULL"),
+        ("группировка 0 мс, NORMAL", True, 0, "NORMAL"),
+        ("группировка 0 мс, FULL", True, 0, "FULL"),
+        ("группировка 2 мс, FULL", True, 2, "FULL"),
+    ]
+    saved = db.WRITE_COALESCE, db.WRITE_DELAY, db.SYNCHRONOUS
+    per_worker = max(1, args.ops // args.workers)
+    print(f"{args.workers} потоков x {per_worker} записей, между записями {args.handler_ms} мс работы обработчика")
+    print(f"{'режим':<28} {'записей/с':>10} {'коммитов/с':>11} {'p50, мс':>8} {'p99, мс':>8}")
+    try:
+        for label, coalesce, delay_ms, sync in modes:
+            db.WRITE_COALESCE, db.WRITE_DELAY, db.SYNCHRONOUS = coalesce, delay_ms / 1000, sync
+            _fresh_db()
+            db.import_musicians([(tid, "guitar", 5, "рок", "Москва", "о себе") for tid in range(1000)])
+            for _ in range(1000):
+                db.create_band_request(1, "guitar", "рок", "bench", "Москва", 0)
+            db.close_all()   # счётчики потока записи — с нуля
+            latencies = [[] for _ in range(args.workers)]
+
+            def worker(n):
+                rnd = random.Random(n)
+                for i in range(per_worker):
+                    time.sleep(args.handler_ms / 1000 * rnd.random() * 2)
+                    start = time.perf_counter()
+                    _write_op(rnd, i)
+                    latencies[n].append((time.perf_counter() - start) * 1000)
+
+            threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.workers)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            durations = sorted(itertools.chain(*latencies))
+            stats = db.write_stats()
+            commits = stats["commits"] if stats else len(durations)
+            print(f"{label:<28} {len(durations) / elapsed:>10,.0f} {commits / elapsed:>11,.0f} "
+                  f"{_percentile(durations, 50):>8.2f} {_percentile(durations, 99):>8.2f}")
+    finally:
+        db.close_all()
+        db.WRITE_COALESCE, db.WRITE_DELAY, db.SYNCHRONOUS = saved
+
+
+# ===== STARTUP: запуск процесса бота =====
+STARTUP_BUDGET_MS = 200    # до первого ответа при перезапуске; больше — регрессия
+
+
+def _start_bot_once(tmp, importtime=None):
+    """Запускает main.py против локального Bot API: (до первого getUpdates, до ответа на /start), с."""
+    import subprocess
+    import sys
+    import loadtest
+
+    api = loadtest.FakeTelegram()
+    env = dict(os.environ, TOKEN="1:bench", TELEGRAM_API_URL=api.url, DB_FILE=os.path.join(tmp, "bandfinder.db"),
+               BOT_MODE="polling", GENRE_BACKEND="local", LOG_FILE="", METRICS_PORT="")
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + \
+        [os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")]
+    stderr = open(importtime, "w") if importtime else subprocess.DEVNULL
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=stderr)
+    try:
+        if not api.ready.wait(30):
+            raise RuntimeError(f"бот не начал опрос (код {proc.poll()})")
+        ready = time.perf_counter() - start
+        user = loadtest.VirtualUser(api, loadtest.Stats(), 1000)
+        if not user.send("/start", "start"):
+            raise RuntimeError("бот не ответил на /start")
+        return ready, time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+        api.close()
+        if importtime:
+            stderr.close()
+
+
+def _import_report(path, top=8):
+    """Импорты верхнего уровня из вывода -X importtime: [(модуль, мс)] по убыванию."""
+    modules = []
+    with open(path) as f:
+        for line in f:
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line.split("|")
+            if not name[1:].startswith(" "):   # вложенные импорты сдвинуты вправо
+                modules.append((name.strip(), int(cumulative) / 1000))
+    return sum(ms for _, ms in modules), sorted(modules, key=lambda m: -m[1])[:top]
+
+
+def bench_startup(args):
+    """Время от запуска процесса до ответа на первое обновление: первый запуск
+    на пустой базе и перезапуски на готовой (как при выкладке), плюс -X importtime."""
+    runs = max(3, min(args.ops, 20))
+    ready, first = _start_bot_once(tempfile.mkdtemp(prefix="bandfinder-bench-"))
+    print(f"первый запуск (пустая база):        до опроса {ready * 1000:6.0f} мс, до ответа {first * 1000:6.0f} мс")
+
+    # Перезапуск — на базе с профилями и векторами, как в работе
+    tmp = tempfile.mkdtemp(prefix="bandfinder-bench-")
+    db.close_all()
+    db.DB_FILE = os.path.join(tmp, "bandfinder.db")   # имя, которое откроет main.py
+    db.init_db()
+    _seed_musicians(args.rows)
+    db.rebuild_vectors()
+    db.close_all()
+    restarts = [_start_bot_once(tmp) for _ in range(runs)]
+    ready = _percentile([r for r, _ in restarts], 50) * 1000
+    first = _percentile([f for _, f in restarts], 50) * 1000
+    print(f"перезапуск ({args.rows:,} профилей), медиана из {runs}: "
+          f"до опроса {ready:6.0f} мс, до ответа {first:6.0f} мс")
+
+    trace = os.path.join(tmp, "importtime.txt")
+    _start_bot_once(tmp, importtime=trace)
+    total, modules = _import_report(trace)
+    print(f"импорты верхнего уровня (-X importtime): {total:.0f} мс")
+    for name, ms in modules:
+        print(f"  {name:<30} {ms:6.1f} мс")
+
+    if first > STARTUP_BUDGET_MS:
+        raise SystemExit(f"перезапуск до первого ответа {first:.0f} мс > бюджета {STARTUP_BUDGET_MS} мс")
+    print(f"в бюджете {STARTUP_BUDGET_MS} мс")
+
+
+# ===== MAINTENANCE: год работы со сроком жизни заявок =====
+def _hot_table_check(job, now):
+    """Нарушения: открытые заявки старше срока и закрытые старше срока показа."""
+    with db._connect() as conn:
+        return conn.execute("""
+            SELECT (SELECT COUNT(*) FROM band_requests WHERE accepted_by IS NULL AND created_at < ?),
+                   (SELECT COUNT(*) FROM band_requests WHERE accepted_by IS NOT NULL AND closed_at < ?)
+        """, (now - job.request_ttl, now - job.closed_keep)).fetchone()
+
+
+def bench_maintenance(args):
+    """Год трафика на подменённых часах: --ops заявок за год, каждый день часть открытых
+    получает отклик, раз в сутки проходит обслуживание (maintenance.py). Рабочая таблица
+    не должна выходить за окно «срок заявки + показ закрытых», каждая просроченная —
+    получить уведомление. Затем обслуживание разбирает накопившиеся --rows просроченных
+    заявок, а поток обработчика пишет в базу: задержка его записей — во время прохода."""
+    from unittest import mock
+
+    import maintenance
+
+    days, day = 365, maintenance.DAY
+    per_day = max(1, args.ops // days)
+    accept_rate = 0.03   # доля открытых заявок, получающих отклик за сутки
+    job = maintenance.Maintenance()
+    bound = per_day * ((job.request_ttl + job.closed_keep) / day + 1)
+    rnd = random.Random(1)
+    clock = [time.time()]
+    _fresh_db()
+    open_ids, expired, peak, run_ms = [], 0, 0, []
+    print(f"{per_day} заявок в сутки, отклик {accept_rate:.0%} открытых в сутки, "
+          f"срок {job.request_ttl / day:.0f} дн., закрытые {job.closed_keep / day:.0f} дн.")
+    print(f"{'день':>5} {'открытых':>9} {'закрытых':>9} {'в архиве':>9} {'проход, мс':>11}")
+    with mock.patch("time.time", lambda: clock[0]):
+        start = clock[0]
+        for d in range(days):
+            for i in range(per_day):
+                clock[0] = start + d * day + i * day / per_day
+                open_ids.append((d, db.create_band_request(rnd.randrange(per_day * 10), rnd.choice(INSTRUMENT_KEYS),
+                                                           rnd.choice(GENRES), "bench", rnd.choice(CITIES), 0)))
+            # Истёкшие заявки уже в архиве; отклик на них получил бы «Заявка уже закрыта»
+            open_ids = [(created, i) for created, i in open_ids if (d - created) * day < job.request_ttl]
+            rnd.shuffle(open_ids)
+            accepted = int(len(open_ids) * accept_rate)
+            for _, req_id in open_ids[:accepted]:
+                db.assign_musician(req_id, rnd.randrange(10 ** 6))
+            open_ids = open_ids[accepted:]
+            clock[0] = start + (d + 1) * day
+            t = time.perf_counter()
+            expired += job.run_once()["expired"]
+            run_ms.append((time.perf_counter() - t) * 1000)
+            counts = db.count_band_requests()
+            peak = max(peak, counts["open"] + counts["closed"])
+            if (d + 1) % 30 == 0 or d == days - 1:
+                print(f"{d + 1:>5} {counts['open']:>9,} {counts['closed']:>9,} {counts['archived']:>9,} "
+                      f"{run_ms[-1]:>11.1f}")
+
+        stale = tuple(_hot_table_check(job, clock[0]))
+        print(f"пик рабочей таблицы {peak:,} строк (окно {bound:,.0f}), проход p50 {_percentile(sorted(run_ms), 50):.1f} мс, "
+              f"p99 {_percentile(sorted(run_ms), 99):.1f} мс; истекло {expired:,}; "
+              f"файл {os.path.getsize(db.DB_FILE) / 2 ** 20:.1f} МБ")
+
+        # Накопившийся хвост (бот долго работал без обслуживания): записи обработчика во время прохода
+        clock[0] -= job.request_ttl + day
+        for offset in range(0, args.rows, 5000):
+            db.import_band_requests([(None, 1, "guitar", "рок", "bench", "Москва", 0, None)
+                                     for _ in range(min(5000, args.rows - offset))])
+        clock[0] += job.request_ttl + 2 * day
+        latencies, done = [], threading.Event()
+
+        def handler():
+            rnd = random.Random(2)
+            while not done.is_set():
+                t = time.perf_counter()
+                db.set_session(rnd.randrange(10000), "band_description", "{}", clock[0])
+                latencies.append((time.perf_counter() - t) * 1000)
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=handler)
+        thread.start()
+        try:
+            time.sleep(0.2)
+            before = len(latencies)
+            t = time.perf_counter()
+            backlog = job.run_once()
+            elapsed = time.perf_counter() - t
+        finally:
+            done.set()
+            thread.join()
+        expired += backlog["expired"]
+        notices = db.count_pending_messages()
+        idle, during = sorted(latencies[:before]), sorted(latencies[before:])
+        print(f"хвост {backlog['expired']:,} просроченных за {elapsed:.2f} с ({backlog['freed_pages']} стр. возвращено); "
+              f"запись обработчика p50/p99/max: без обслуживания {_percentile(idle, 50):.2f}/"
+              f"{_percentile(idle, 99):.2f} мс, во время {_percentile(during, 50):.2f}/{_percentile(during, 99):.2f}/"
+              f"{during[-1]:.2f} мс")
+
+    db.close_all()
+    if peak > bound or any(stale) or notices != expired:
+        raise SystemExit(f"рабочая таблица {peak:,} (окно {bound:,.0f}), не перенесено в архив "
+                         f"открытых/закрытых {stale}, уведомлений {notices:,} из {expired:,}")
+    print("рабочая таблица в пределах окна, все просроченные уведомлены")
+
+
+BENCHMARKS = {
+    "db": bench_db,
+    "match": bench_match,
+    "webhook": bench_webhook,
+    "accept": bench_accept,
+    "classify": bench_classify,
+    "remote": bench_remote,
+    "reverse": bench_reverse,
+    "search": bench_search,
+    "cache": bench_cache,
+    "updates": bench_updates,
+    "broadcast": bench_broadcast,
+    "cluster": bench_cluster,
+    "metrics": bench_metrics,
+    "logging": bench_logging,
+    "bulk": bench_bulk,
+    "vectors": bench_vectors,
+    "writes": bench_writes,
+    "startup": bench_startup,
+    "maintenance": bench_maintenance,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--ops", type=int, default=20000, help="число операций")
+    parser.add_argument("--rows", type=int, default=200000, help="размер синтетической таблицы")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных клиентов")
+    parser.add_argument("--workers", type=int, default=8, help="потоков обработчиков")
+    parser.add_argument("--handler-ms", type=float, default=2.0, help="время работы обработчика, мс")
+    parser.add_argument("--disk-ms", type=float, default=0.1, help="время одной записи лога на диск, мс")
+    parser.add_argument("--api-rps", type=int, default=10, help="лимит sendMessage фейкового Bot API, сверх — 429")
+    parser.add_argument("--flood-rate", type=float, default=0.05, help="доля sendMessage, получающих 429")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == "__main__":
+    main()
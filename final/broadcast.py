@@ -0,0 +1,181 @@
+"""Рассылка уведомлений через постоянную очередь.
+
+Обработчики кладут сообщения в таблицу outbox (db.enqueue_messages) и сразу
+отвечают пользователю. Фоновый поток Dispatcher разбирает очередь с учётом
+лимитов Telegram: ~30 сообщений в секунду всего и 1 в секунду на чат.
+Очередь хранится в SQLite, поэтому неотправленное переживает перезапуск.
+"""
+import logging
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import db
+import metrics
+
+log = logging.getLogger(__name__)
+
+GLOBAL_RATE = 30          # сообщений в секунду на бота
+PER_CHAT_INTERVAL = 1.0   # секунд между сообщениями в один чат
+BATCH_SIZE = 100          # сколько сообщений берём из очереди за раз
+MAX_ATTEMPTS = 5
+IDLE_INTERVAL = 1.0       # как часто проверять очередь, если она пуста
+
+metrics.gauge("bandfinder_outbox_pending", "Сообщений в очереди рассылки",
+              lambda: {(): db.count_pending_messages()})
+
+# Ошибки, после которых повторять отправку бессмысленно (бот заблокирован, чат не найден)
+PERMANENT_ERRORS = (400, 403)
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд нужно подождать перед отправкой."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Dispatcher:
+    def __init__(self, bot, rate=GLOBAL_RATE, batch_size=BATCH_SIZE):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.paused_until = 0.0
+        self.chat_next = {}    # chat_id -> time.time(), раньше которого в чат не пишем
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    # ===== PUBLIC =====
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def notify(self):
+        """Будит диспетчер после постановки сообщений в очередь."""
+        self.wakeup.set()
+
+    # ===== LOOP =====
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                busy = self.drain_once()
+            except Exception:
+                log.exception("Ошибка в диспетчере рассылки")
+                busy = False
+            if not busy:
+                self.wakeup.wait(IDLE_INTERVAL)
+                self.wakeup.clear()
+
+    def drain_once(self):
+        """Отправляет одну пачку из очереди. Возвращает True, если что-то было отправлено."""
+        now = time.time()
+        if now < self.paused_until:
+            self.stopping.wait(self.paused_until - now)
+            return True
+        rows = db.fetch_due_messages(now, self.batch_size)
+        if not rows:
+            return False
+
+        sent, deferred, seen = [], [], set()
+        for row in rows:
+            chat_id = row["chat_id"]
+            # Справедливость: из пачки в чат уходит не больше одного сообщения,
+            # остальные откладываются до окончания его персонального лимита
+            next_at = self.chat_next.get(chat_id, 0.0)
+            if chat_id in seen or next_at > time.time():
+                deferred.append((max(next_at, time.time() + PER_CHAT_INTERVAL), row["attempts"], row["id"]))
+                continue
+            seen.add(chat_id)
+
+            if self.stopping.wait(self.bucket.reserve()):
+                break
+            result = self._send(row)
+            if result == "sent" or result == "dropped":
+                sent.append(row["id"])
+                self.chat_next[chat_id] = time.time() + PER_CHAT_INTERVAL
+            elif result == "retry":
+                deferred.append(self._backoff(row))
+            elif result == "throttled":
+                # 429: Telegram сам сказал, сколько ждать — останавливаем всю рассылку
+                deferred.append((self.paused_until, row["attempts"], row["id"]))
+                break
+
+        if sent:
+            db.delete_messages(sent)
+        if deferred:
+            db.reschedule_messages(deferred)
+        self._prune_chats()
+        return bool(sent)
+
+    def _send(self, row):
+        try:
+            self.bot.send_message(row["chat_id"], row["text"], reply_markup=row["reply_markup"])
+            return "sent"
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                self.paused_until = time.time() + retry_after
+                log.warning("Telegram 429, пауза рассылки на %s с", retry_after)
+                return "throttled"
+            if e.error_code in PERMANENT_ERRORS:
+                log.info("Сообщение в чат %s не доставлено: %s", row["chat_id"], e.description)
+                return "dropped"
+            log.warning("Ошибка отправки в чат %s: %s", row["chat_id"], e)
+        except Exception as e:
+            log.warning("Ошибка отправки в чат %s: %s", row["chat_id"], e)
+        if row["attempts"] + 1 >= MAX_ATTEMPTS:
+            log.error("Сообщение #%s в чат %s отброшено после %s попыток", row["id"], row["chat_id"], MAX_ATTEMPTS)
+            return "dropped"
+        return "retry"
+
+    def _backoff(self, row):
+        attempts = row["attempts"] + 1
+        return time.time() + 2 ** attempts, attempts, row["id"]
+
+    def _prune_chats(self):
+        # Не даём словарю лимитов расти бесконечно
+        if len(self.chat_next) > 10000:
+            now = time.time()
+            self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+
+
+_dispatcher = None
+
+
+def start(bot):
+    global _dispatcher
+    _dispatcher = Dispatcher(bot).start()
+    return _dispatcher
+
+
+def enqueue(messages):
+    """messages: список (chat_id, text, reply_markup). reply_markup — объект telebot или None."""
+    count = db.enqueue_messages(
+        (chat_id, text, markup.to_json() if markup is not None else None)
+        for chat_id, text, markup in messages
+    )
+    if _dispatcher:
+        _dispatcher.notify()
+    return count
@@ -0,0 +1,252 @@
+"""Массовый импорт и экспорт musicians и band_requests в CSV и JSONL.
+
+Файл читается потоком: строка проверяется, инструмент приводится к ключу
+INSTRUMENTS, и строки пачками по BATCH_SIZE уходят в базу одним executemany
+в одной транзакции. В памяти — только текущая пачка, сколько бы строк ни было
+в файле. Строки с ошибками пропускаются; с --errors они сохраняются в JSONL
+вместе с причиной, чтобы их можно было исправить и загрузить повторно.
+
+Запуск из каталога final/:
+    python bulk.py import musicians partners.csv
+    python bulk.py import band_requests requests.jsonl --errors rejected.jsonl
+    python bulk.py export musicians musicians.csv
+    python bulk.py export band_requests - --format jsonl > requests.jsonl
+
+Формат определяется по расширению (.csv, .jsonl, .ndjson), «-» — stdin/stdout.
+Столбцы — db.MUSICIAN_COLUMNS и db.BAND_REQUEST_COLUMNS; в CSV первая строка — заголовок.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import db
+from instruments import normalize_instrument
+
+BATCH_SIZE = 5000
+PROGRESS_INTERVAL = 1.0   # секунд между строками прогресса
+MAX_EXPERIENCE = 80
+
+COLUMNS = {"musicians": db.MUSICIAN_COLUMNS, "band_requests": db.BAND_REQUEST_COLUMNS}
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+# ===== VALIDATION =====
+def _text(row, name, required=False):
+    value = row.get(name)
+    if isinstance(value, list):   # жанры в JSONL бывают списком
+        value = ", ".join(str(v) for v in value)
+    value = "" if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f"{name}: пусто")
+    return value
+
+
+def _int(row, name, required=True, minimum=0, maximum=None):
+    value = row.get(name)
+    if value is None or value == "":
+        if required:
+            raise ValueError(f"{name}: пусто")
+        return None
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}: не число: {value!r}") from None
+    if number < minimum or (maximum is not None and number > maximum):
+        raise ValueError(f"{name}: вне диапазона: {number}")
+    return number
+
+
+def _instrument(row):
+    instrument = normalize_instrument(_text(row, "instrument", required=True), default=None)
+    if instrument is None:
+        raise ValueError(f"instrument: неизвестный инструмент: {row.get('instrument')!r}")
+    return instrument
+
+
+def validate_musician(row):
+    """Словарь из файла -> кортеж для db.import_musicians; ValueError, если строка неверна."""
+    return (
+        _int(row, "telegram_id", minimum=1),
+        _instrument(row),
+        _int(row, "experience", maximum=MAX_EXPERIENCE),
+        _text(row, "genres"),
+        _text(row, "location_text", required=True),
+        _text(row, "about"),
+    )
+
+
+def validate_band_request(row):
+    """Словарь из файла -> кортеж для db.import_band_requests; ValueError, если строка неверна."""
+    return (
+        _int(row, "id", required=False, minimum=1),
+        _int(row, "band_id", minimum=1),
+        _instrument(row),
+        _text(row, "genre"),
+        _text(row, "description"),
+        _text(row, "location_text", required=True),
+        _int(row, "min_experience", maximum=MAX_EXPERIENCE),
+        _int(row, "accepted_by", required=False, minimum=1),
+    )
+
+
+VALIDATORS = {"musicians": validate_musician, "band_requests": validate_band_request}
+IMPORTERS = {"musicians": db.import_musicians, "band_requests": db.import_band_requests}
+
+
+# ===== FILES =====
+def _format(path, fmt):
+    if fmt:
+        return fmt
+    fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+    if not fmt:
+        raise ValueError(f"Не удалось определить формат {path!r}, укажите --format")
+    return fmt
+
+
+def _open(path, mode):
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    # utf-8-sig: CSV из Excel начинается с BOM
+    return open(path, mode, encoding="utf-8-sig" if mode == "r" else "utf-8", newline="")
+
+
+def read_rows(f, fmt):
+    """(номер строки, словарь) по одной строке файла."""
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    yield number, {"_error": f"неверный JSON: {e}"}
+                    continue
+                if isinstance(row, dict):
+                    yield number, row
+                else:
+                    yield number, {"_error": f"ожидался объект JSON, а не {type(row).__name__}"}
+
+
+class Progress:
+    """Печатает в stderr число строк и скорость не чаще раза в PROGRESS_INTERVAL секунд."""
+
+    def __init__(self, label, stream=sys.stderr, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.stream = stream
+        self.interval = interval
+        self.start = self.shown = time.perf_counter()
+
+    def __call__(self, done, rejected=0, final=False):
+        now = time.perf_counter()
+        if not final and now - self.shown < self.interval:
+            return
+        self.shown = now
+        rate = done / (now - self.start) if now > self.start else 0
+        extra = f", отклонено {rejected:,}" if rejected else ""
+        print(f"{self.label}: {done:,} строк{extra}, {rate:,.0f} строк/с", file=self.stream)
+
+
+# ===== IMPORT / EXPORT =====
+def import_file(table, path, fmt=None, batch_size=BATCH_SIZE, errors=None, progress=None):
+    """Загружает файл в таблицу. errors — файл для отклонённых строк (JSONL),
+    progress(done, rejected) вызывается после каждой пачки."""
+    validate, load = VALIDATORS[table], IMPORTERS[table]
+    done = rejected = 0
+    start = time.perf_counter()
+    with _open(path, "r") as f:
+        rejected_out = open(errors, "w", encoding="utf-8") if errors else None
+        try:
+            def valid_rows():
+                nonlocal rejected
+                for number, row in read_rows(f, _format(path, fmt)):
+                    try:
+                        if "_error" in row:
+                            raise ValueError(row["_error"])
+                        yield validate(row)
+                    except ValueError as e:
+                        rejected += 1
+                        if rejected_out:
+                            rejected_out.write(json.dumps({"line": number, "error": str(e), "row": row},
+                                                          ensure_ascii=False) + "\n")
+
+            rows = valid_rows()
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                done += load(batch)
+                if progress:
+                    progress(done, rejected)
+        finally:
+            if rejected_out:
+                rejected_out.close()
+    if done:
+        db.optimize()
+    return {"table": table, "imported": done, "rejected": rejected,
+            "seconds": round(time.perf_counter() - start, 3)}
+
+
+def export_file(table, path, fmt=None, progress=None):
+    """Выгружает таблицу в файл; возвращает число строк."""
+    fmt = _format(path, fmt)
+    columns = COLUMNS[table]
+    done = 0
+    f = _open(path, "w")
+    try:
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            write = lambda row: writer.writerow([row[c] for c in columns])
+        else:
+            write = lambda row: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        for row in db.iter_table(table):
+            write(row)
+            done += 1
+            if progress and not done % BATCH_SIZE:
+                progress(done)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+        else:
+            f.flush()
+    return done
+
+
+# ===== CLI =====
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("table", choices=sorted(COLUMNS))
+    parser.add_argument("path", help="файл или «-»")
+    parser.add_argument("--format", choices=["csv", "jsonl"])
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="строк в одной транзакции")
+    parser.add_argument("--errors", help="куда сохранить отклонённые строки (JSONL)")
+    parser.add_argument("--quiet", action="store_true", help="без прогресса")
+    args = parser.parse_args()
+
+    db.init_db()
+    progress = None if args.quiet else Progress(f"{args.action} {args.table}")
+    try:
+        if args.action == "import":
+            result = import_file(args.table, args.path, args.format, args.batch, args.errors, progress)
+            if progress:
+                progress(result["imported"], result["rejected"], final=True)
+            print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+            return 1 if result["rejected"] else 0
+        done = export_file(args.table, args.path, args.format, progress)
+        if progress:
+            progress(done, final=True)
+    except ValueError as e:
+        parser.error(str(e))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей и счётчиками попаданий."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()   # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key, _MISSING)
+            if item is not _MISSING and item[0] > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not _MISSING:
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+
+class RedisCache:
+    """Тот же интерфейс поверх Redis: кэш общий для нескольких процессов бота.
+
+    Значения хранятся в JSON, срок жизни — штатным EX ключа, вытеснение —
+    политикой maxmemory самого Redis. Счётчики попаданий — локальные для процесса.
+    """
+
+    def __init__(self, url, ttl=300, prefix="cache:"):
+        import redis  # необязательная зависимость — только если выбран этот бэкенд
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        raw = self.client.get(self.prefix + key)
+        with self.lock:
+            if raw is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        with self.lock:
+            return {"size": None, "hits": self.hits, "misses": self.misses}
+
+
+def make_cache(maxsize, ttl, prefix):
+    """Кэш по переменным окружения: CACHE_BACKEND=memory (по умолчанию), redis или none.
+
+    Для redis нужен REDIS_URL; ключи разных кэшей разделяются префиксом.
+    """
+    backend = os.getenv("CACHE_BACKEND", "memory")
+    if backend == "none":
+        return None
+    if backend == "redis":
+        return RedisCache(os.getenv("REDIS_URL", "redis://localhost:6379/0"), ttl, prefix)
+    return TTLCache(maxsize, ttl)
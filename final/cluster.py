@@ -0,0 +1,239 @@
+"""Бот в несколько процессов: один процесс принимает обновления, N рабочих их обрабатывают.
+
+Приёмник (polling или webhook) пишет каждое обновление в таблицу update_spool
+и будит рабочий процесс его шарда. Шард — chat_id % N, поэтому обновления
+одного чата обрабатывает всегда один процесс и строго по порядку. Рабочий
+удаляет обновление из спула только после обработки: если процесс упал,
+приёмник перезапускает его, и необработанное читается заново (at-least-once).
+Обновление, на котором процесс падает MAX_ATTEMPTS раз подряд, отбрасывается.
+
+Общее состояние — в SQLite (DB_FILE): профили, заявки, шаги диалогов (fsm, SESSION_STORE=sqlite),
+очередь рассылки (её разбирает только приёмник). Кэш чтений в памяти процесса
+в рабочих выключается, общий кэш — CACHE_BACKEND=redis.
+
+    python cluster.py --workers 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import telebot
+from telebot import apihelper, types
+from dotenv import load_dotenv
+
+import broadcast
+import db
+import maintenance
+import metrics
+import webhook
+from logging_config import setup_logging
+from updates import chat_key
+
+log = logging.getLogger(__name__)
+
+WORKERS = 4
+BATCH_SIZE = 100          # сколько обновлений рабочий читает из спула за раз
+MAX_ATTEMPTS = 3          # сколько раз пробовать обновление, на котором падает процесс
+IDLE_INTERVAL = 1.0       # как часто рабочий проверяет спул без сигнала приёмника
+SUPERVISE_INTERVAL = 0.5  # как часто приёмник проверяет, живы ли рабочие
+POLL_TIMEOUT = 25
+
+
+def shard_for(chat_id, shards):
+    return chat_id % shards
+
+
+# ===== INGRESS =====
+class Ingress:
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        ctx = multiprocessing.get_context("spawn")   # без fork: у каждого процесса свои соединения
+        self.ctx = ctx
+        self.wakeups = [ctx.Event() for _ in range(workers)]
+        self.stopping = ctx.Event()
+        self.procs = [None] * workers
+        self.restarts = 0
+        self.supervisor = None
+
+    def start(self):
+        db.init_db()   # схема создаётся до старта рабочих, чтобы они не мигрировали наперегонки
+        moved = db.reshard_spool(self.workers)
+        if moved:
+            log.info("Перераспределено необработанных обновлений: %s", moved)
+        for index in range(self.workers):
+            self._spawn(index)
+        self.supervisor = threading.Thread(target=self._supervise, name="cluster-supervisor", daemon=True)
+        self.supervisor.start()
+        return self
+
+    def stop(self, timeout=10):
+        """Рабочие дорабатывают текущее обновление и выходят; остальное ждёт в спуле."""
+        self.stopping.set()
+        for event in self.wakeups:
+            event.set()
+        for proc in self.procs:
+            if proc is not None:
+                proc.join(timeout)
+                if proc.is_alive():
+                    proc.terminate()
+
+    def spool(self, items):
+        """items: (Update, JSON-текст обновления). Сохраняет в спул и будит нужные шарды."""
+        rows, shards = [], set()
+        for update, payload in items:
+            chat_id = chat_key(update)
+            shard = shard_for(chat_id, self.workers)
+            rows.append((update.update_id, chat_id, shard, payload))
+            shards.add(shard)
+        db.spool_updates(rows)
+        for shard in shards:
+            self.wakeups[shard].set()
+
+    def poll_forever(self, token):
+        """Long polling: забирает обновления пачками и складывает в спул."""
+        offset, delay = None, 1
+        while not self.stopping.is_set():
+            try:
+                raw = apihelper.get_updates(token, offset=offset, limit=100,
+                                            timeout=POLL_TIMEOUT, long_polling_timeout=POLL_TIMEOUT)
+                if raw:
+                    # Текст сохраняется до разбора: de_json может менять исходный словарь
+                    items = [(json.dumps(u, ensure_ascii=False), u) for u in raw]
+                    self.spool([(types.Update.de_json(u), payload) for payload, u in items])
+            except Exception as e:
+                # offset не сдвигается: пачка, не попавшая в спул, придёт из getUpdates снова
+                log.warning("Обновления не получены или не сохранены: %s, повтор через %s с", e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 1
+            if raw:
+                offset = raw[-1]["update_id"] + 1
+
+    # ===== SUPERVISOR =====
+    def _spawn(self, index):
+        proc = self.ctx.Process(target=worker_main, name=f"bot-worker-{index}",
+                                args=(index, self.workers, self.wakeups[index], self.stopping))
+        proc.start()
+        self.procs[index] = proc
+
+    def _supervise(self):
+        while not self.stopping.wait(SUPERVISE_INTERVAL):
+            for index, proc in enumerate(self.procs):
+                if not proc.is_alive() and not self.stopping.is_set():
+                    log.warning("Рабочий %s завершился с кодом %s, перезапуск", index, proc.exitcode)
+                    self.restarts += 1
+                    self._spawn(index)
+
+
+class SpoolWebhookServer(webhook.WebhookServer):
+    """Webhook-приёмник: обновление отвечается 200 только после записи в спул."""
+
+    def __init__(self, bot, ingress, path="/", secret=None):
+        super().__init__(bot, path, secret, workers=0)
+        self.ingress = ingress
+
+    async def deliver(self, update, body):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.ingress.spool, [(update, body.decode())])
+        except Exception:
+            log.exception("Не удалось сохранить обновление %s", update.update_id)
+            return 503
+        return 200
+
+
+# ===== WORKER =====
+def worker_main(index, workers, wakeup, stopping):
+    """Рабочий процесс: обработчики из main.py над своим шардом спула."""
+    if os.getenv("LOG_FILE"):
+        # Свой файл у каждого процесса: ротация одного файла из нескольких процессов небезопасна
+        base, ext = os.path.splitext(os.environ["LOG_FILE"])
+        os.environ["LOG_FILE"] = f"{base}.worker{index}{ext}"
+    if os.getenv("CACHE_BACKEND", "memory") == "memory":
+        # Кэш в памяти не узнал бы о записях соседних процессов
+        os.environ["CACHE_BACKEND"] = "none"
+    # Диалог чата должен пережить перезапуск рабочего и перераспределение шардов
+    os.environ["SESSION_STORE"] = "sqlite"
+    # Схему готовит приёмник до старта рабочих (Ingress.start): рабочие её не мигрируют
+    os.environ["BANDFINDER_ROLE"] = "worker"
+    import main   # регистрирует обработчики и создаёт bot
+
+    main.bot.threaded = False
+    if os.getenv("METRICS_PORT"):
+        # У каждого процесса свои метрики: приёмник на METRICS_PORT, рабочие — следом
+        metrics.serve(int(os.getenv("METRICS_PORT")) + 1 + index, os.getenv("METRICS_HOST", "127.0.0.1"))
+    log.info("Рабочий %s/%s запущен, pid %s", index, workers, os.getpid())
+    while not stopping.is_set():
+        rows = db.fetch_spooled(index, BATCH_SIZE)
+        if not rows:
+            wakeup.wait(IDLE_INTERVAL)
+            wakeup.clear()
+            continue
+        for row in rows:
+            if stopping.is_set():
+                return
+            _process_spooled(main.bot, row)
+
+
+def _process_spooled(bot, row):
+    if row["attempts"] >= MAX_ATTEMPTS:
+        log.error("Обновление %s пропущено после %s попыток", row["update_id"], row["attempts"])
+        db.delete_spooled(row["update_id"])
+        return
+    # Попытка отмечается до обработки: если процесс упадёт, счётчик это запомнит
+    db.mark_spooled_attempt(row["update_id"])
+    try:
+        bot.process_new_updates([types.Update.de_json(row["payload"])])
+    except Exception:
+        log.exception("Ошибка обработки обновления %s", row["update_id"])
+    db.delete_spooled(row["update_id"])
+
+
+# ===== ENTRY POINT =====
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BOT_WORKERS", WORKERS)))
+    args = parser.parse_args()
+
+    load_dotenv()
+    setup_logging()
+    token = os.getenv("TOKEN")
+    if not token:
+        raise RuntimeError("Нет TOKEN в .env")
+    if os.getenv("TELEGRAM_API_URL"):
+        apihelper.API_URL = os.getenv("TELEGRAM_API_URL")
+    # Рабочие открывают ту же базу, даже если их каталог окажется другим
+    os.environ["DB_FILE"] = db.DB_FILE = os.path.abspath(db.DB_FILE)
+
+    bot = telebot.TeleBot(token, threaded=False)
+    metrics.instrument_telegram()
+    if os.getenv("METRICS_PORT"):
+        metrics.serve(int(os.getenv("METRICS_PORT")), os.getenv("METRICS_HOST", "127.0.0.1"))
+    ingress = Ingress(args.workers).start()
+    broadcast.start(bot)   # очередь рассылки разбирает только приёмник
+    maintenance.start()   # и обслуживание базы — тоже
+    print(f"🎸 BandFinderBot запущен: приёмник + {args.workers} рабочих процессов")
+    try:
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            secret = os.getenv("WEBHOOK_SECRET")
+            bot.remove_webhook()
+            bot.set_webhook(url=os.environ["WEBHOOK_URL"], secret_token=secret,
+                            max_connections=webhook.MAX_CONNECTIONS)
+            server = SpoolWebhookServer(bot, ingress, os.getenv("WEBHOOK_PATH", "/"), secret)
+            asyncio.run(server.serve_forever(os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+                                             int(os.getenv("WEBHOOK_PORT", "8443"))))
+        else:
+            bot.remove_webhook()
+            ingress.poll_forever(token)
+    finally:
+        ingress.stop()
+
+
+if __name__ == "__main__":
+    run()
@@ -1,88 +1,990 @@
+import logging
+import os
 import sqlite3
-from contextlib import closing
+import threading
+import time
 
-DB_FILE = "bandfinder.db"
+import metrics
+import vectors
+from groupcommit import GroupCommit
+from migrations import Migrations
+from cache import make_cache
+from geo import PLACES, nearby, normalize_location
 
-def _connect():
-    conn = sqlite3.connect(DB_FILE)
+log = logging.getLogger(__name__)
+
+DB_FILE = os.getenv("DB_FILE", "bandfinder.db")
+
+# Настройки соединения: WAL позволяет читать параллельно с записью.
+# synchronous=FULL — коммит на диске до ответа пользователю; с группировкой
+# записей (WRITE_COALESCE) это один fsync на группу. NORMAL экономит fsync,
+# но последние коммиты могут пропасть при сбое питания
+SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL")
+PRAGMAS = (
+    # До WAL: на новой базе освободившиеся страницы возвращаются файлу по частям
+    # (maintenance.py); на старой действует только после полного VACUUM
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA cache_size=-16000",      # ~16 МБ страничного кэша на соединение
+    "PRAGMA mmap_size=268435456",    # 256 МБ memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+BUSY_TIMEOUT = 5.0
+STATEMENT_CACHE = 128
+
+# Пул соединений: у каждого потока обработчиков своё долгоживущее соединение
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool = []
+
+def _open(path=None):
+    conn = sqlite3.connect(path or DB_FILE, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row  # Чтобы возвращать словари
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    return conn
+
+def _connect():
+    """Соединение текущего потока. Открывается один раз и переиспользуется,
+    подготовленные выражения кэшируются самим sqlite3."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_FILE:
+        conn = _open()
+        _local.conn, _local.path = conn, DB_FILE
+        with _pool_lock:
+            _pool.append(conn)
     return conn
 
+def close_all():
+    """Фиксирует принятые записи и закрывает все соединения пула (при остановке бота или смене DB_FILE)."""
+    _close_writer()
+    with _pool_lock:
+        for conn in _pool:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass
+        _pool.clear()
+    _local.__dict__.clear()
+
+# ===== WRITES =====
+# Все записи идут через _write(work): work(conn) выполняется в транзакции,
+# результат возвращается после коммита. С группировкой (по умолчанию) записи
+# всех потоков собираются в общие транзакции потока записи (groupcommit.py):
+# один коммит на группу вместо коммита на каждое сообщение, и потоки не ждут
+# друг друга на блокировке записи SQLite.
+WRITE_COALESCE = os.getenv("WRITE_COALESCE", "1") != "0"
+WRITE_DELAY = float(os.getenv("WRITE_DELAY_MS", "0")) / 1000   # сколько ждать попутчиков
+WRITE_BATCH = int(os.getenv("WRITE_BATCH", "256"))
+_writer = None
+_writer_lock = threading.Lock()
+
+def _write(work):
+    if not WRITE_COALESCE:
+        with _connect() as conn:   # выход из with — коммит или откат
+            return work(conn)
+    return _group().submit(work)
+
+def _group():
+    global _writer
+    writer = _writer
+    if writer is None or writer.path != DB_FILE:
+        with _writer_lock:
+            if _writer is None or _writer.path != DB_FILE:
+                if _writer is not None:
+                    _writer.close()
+                path = DB_FILE
+                _writer = GroupCommit(lambda: _open(path), WRITE_DELAY, WRITE_BATCH)
+                _writer.path = path
+            writer = _writer
+    return writer
+
+def _close_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+
+def write_stats():
+    """{"writes", "commits", "queued"} потока записи или None без группировки."""
+    return _writer.stats() if _writer is not None else None
+
+# ===== READ CACHE =====
+# Профили и заявки читаются на каждое нажатие, а меняются редко. Чтения идут
+# через кэш, каждая запись удаляет ровно те ключи, которые она затронула.
+CACHE_SIZE = 10000
+CACHE_TTL = 60
+_cache = make_cache(CACHE_SIZE, CACHE_TTL, prefix="bandfinder:")
+_NOT_CACHED = object()
+
+# Поколения ключей: запись этого процесса между промахом и сохранением прочитанного меняет
+# поколение, и прочитанное до записи в кэш не попадает. Счётчики по хэшу ключа,
+# чтобы память не росла; совпадение хэшей лишь пропускает одно сохранение
+_GENERATIONS = 4096
+_generations = [0] * _GENERATIONS
+_generation_lock = threading.Lock()
+
+def _cached(key, load):
+    if _cache is None:
+        return load()
+    value = _cache.get(key, _NOT_CACHED)
+    if value is _NOT_CACHED:
+        slot = hash(key) % _GENERATIONS
+        generation = _generations[slot]
+        value = load()
+        with _generation_lock:
+            if _generations[slot] == generation:
+                _cache.set(key, value)
+    return value
+
+def _invalidate(*keys):
+    if _cache is not None:
+        with _generation_lock:
+            for key in keys:
+                _generations[hash(key) % _GENERATIONS] += 1
+                _cache.delete(key)
+
+def clear_cache():
+    if _cache is not None:
+        _cache.clear()
+
+def cache_stats():
+    """{"size", "hits", "misses"} кэша чтений или None, если кэш выключен."""
+    return _cache.stats() if _cache is not None else None
+
+metrics.gauge(
+    "bandfinder_read_cache_requests", "Обращения к кэшу чтений с начала работы процесса",
+    lambda: {(k,): v for k, v in (cache_stats() or {}).items() if k in ("hits", "misses")},
+    ["result"],
+)
+
+# Время каждой функции-запроса — в метрике bandfinder_db_query_seconds под её именем
+_timed = metrics.timed(metrics.DB_QUERY_SECONDS)
+
+# ===== SCHEMA =====
+# Миграции схемы по порядку номеров (см. migrations.py). Новая миграция — новая
+# функция со следующим номером; уже выпущенные не меняются
+SCHEMA = Migrations()
+
 def init_db():
+    """Применяет недостающие миграции. На готовой базе — одно чтение schema_migrations;
+    индексы online-миграций строятся в фоне после запуска (на новой базе — сразу)."""
     with _connect() as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS musicians (
-                telegram_id INTEGER PRIMARY KEY,
-                instrument TEXT,
-                experience INTEGER,
-                genres TEXT,
-                location_text TEXT,
-                about TEXT
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS band_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                band_id INTEGER,
-                instrument TEXT,
-                genre TEXT,
-                description TEXT,
-                location_text TEXT,
-                min_experience INTEGER,
-                accepted_by INTEGER
-            )
-        """)
-        conn.commit()
+        fresh = conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None
+        applied = SCHEMA.migrate(conn, online=fresh)
+        if not fresh and SCHEMA.pending(conn, online=True):
+            path = DB_FILE
+            SCHEMA.migrate_in_background(lambda: _open(path))
+    # Файла векторов нет (удалён или база перенесена без него) — пересчитать
+    if applied or (TEXT_MATCH == "vectors" and not os.path.exists(DB_FILE + ".vec")):
+        _backfill_vectors()
+
+@SCHEMA.register(1)
+def _baseline(conn):
+    """Схема до появления миграций. Идемпотентна: дополняет базы любой прежней версии."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS musicians (
+            telegram_id INTEGER PRIMARY KEY,
+            instrument TEXT,
+            experience INTEGER,
+            genres TEXT,
+            location_text TEXT,
+            about TEXT
+        )
+    """)
+    _ensure_column(conn, "musicians", "location_key", "TEXT")
+    geo_added = _ensure_column(conn, "musicians", "lat", "REAL")
+    _ensure_column(conn, "musicians", "lon", "REAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS band_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            band_id INTEGER,
+            instrument TEXT,
+            genre TEXT,
+            description TEXT,
+            location_text TEXT,
+            min_experience INTEGER,
+            accepted_by INTEGER
+        )
+    """)
+    if _ensure_column(conn, "band_requests", "location_key", "TEXT"):
+        rows = conn.execute("SELECT id, location_text FROM band_requests").fetchall()
+        conn.executemany(
+            "UPDATE band_requests SET location_key=? WHERE id=?",
+            [(normalize_location(r["location_text"]), r["id"]) for r in rows]
+        )
+    # Открытые заявки для обратного подбора: новый профиль ищет подходящие заявки
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_open
+        ON band_requests (instrument, location_key, min_experience)
+        WHERE accepted_by IS NULL
+    """)
+    # Кому уже отправлено уведомление о заявке, чтобы не слать повторно
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS request_alerts (
+            request_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            PRIMARY KEY (request_id, telegram_id)
+        ) WITHOUT ROWID
+    """)
+    # Заполняем нормализованную локацию и координаты у профилей, созданных до их появления
+    rows = conn.execute(
+        "SELECT telegram_id, location_text FROM musicians"
+        + ("" if geo_added else " WHERE location_key IS NULL")
+    ).fetchall()
+    conn.executemany(
+        "UPDATE musicians SET location_key=?, lat=?, lon=? WHERE telegram_id=?",
+        [(*_location_columns(r["location_text"]), r["telegram_id"]) for r in rows]
+    )
+    # Индексы под подбор музыкантов: инструмент + город + стаж и инструмент + стаж
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_musicians_match
+        ON musicians (instrument, location_key, experience)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_musicians_instrument_exp
+        ON musicians (instrument, experience)
+    """)
+    # Очередь исходящих сообщений для рассылки (см. broadcast.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (not_before, id)")
+    # Текущий шаг диалога пользователя (см. fsm.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            chat_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)")
+    # Принятые, но ещё не обработанные обновления для рабочих процессов (см. cluster.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS update_spool (
+            update_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            shard INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_update_spool_shard ON update_spool (shard, update_id)")
+    # Строка музыканта в файле векторов (см. vectors.py); переживает INSERT OR REPLACE профиля
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS musician_vectors (
+            telegram_id INTEGER PRIMARY KEY,
+            slot INTEGER NOT NULL UNIQUE
+        )
+    """)
+
+def _ensure_column(conn, table, column, decl):
+    columns = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+    return False
+
+@SCHEMA.register(2, online=True)
+def _requests_by_band(conn):
+    """«Мои заявки» и отмена заявки ищут по band_id."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_band ON band_requests (band_id)")
+
+@SCHEMA.register(3)
+def _request_lifetime(conn):
+    """Время создания и закрытия заявки для истечения по сроку и архив старых заявок.
+    У заявок, созданных до миграции, срок отсчитывается от неё."""
+    now = time.time()
+    _ensure_column(conn, "band_requests", "created_at", "REAL")
+    _ensure_column(conn, "band_requests", "closed_at", "REAL")
+    conn.execute("UPDATE band_requests SET created_at=? WHERE created_at IS NULL", (now,))
+    conn.execute("UPDATE band_requests SET closed_at=? WHERE accepted_by IS NOT NULL AND closed_at IS NULL", (now,))
+    # Закрытые и просроченные заявки (status: closed или expired); в рабочей таблице их нет
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS band_requests_archive (
+            id INTEGER PRIMARY KEY,
+            band_id INTEGER,
+            instrument TEXT,
+            genre TEXT,
+            description TEXT,
+            location_text TEXT,
+            min_experience INTEGER,
+            accepted_by INTEGER,
+            location_key TEXT,
+            created_at REAL,
+            closed_at REAL,
+            status TEXT NOT NULL,
+            archived_at REAL NOT NULL
+        )
+    """)
+
+@SCHEMA.register(4, online=True)
+def _requests_by_age(conn):
+    """Обслуживание выбирает самые старые открытые и закрытые заявки."""
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_expiry
+        ON band_requests (created_at) WHERE accepted_by IS NULL
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_requests_closed
+        ON band_requests (closed_at) WHERE accepted_by IS NOT NULL
+    """)
+
+# ===== NORMALIZATION =====
+def _location_columns(location_text):
+    """(location_key, lat, lon) для записи в таблицу; координаты None, если города нет в справочнике."""
+    key = normalize_location(location_text)   # один разбор текста и для ключа, и для координат
+    return (key, *PLACES.get(key, (None, None)))
+
+def _genre_tokens(genres):
+    return {g.strip().lower().replace("ё", "е") for g in (genres or "").split(",") if g.strip()}
+
+def _genre_overlap(wanted, genres):
+    # Подстрока, а не точное совпадение: «рок» засчитывается и для «поп-рок»
+    genres = (genres or "").lower().replace("ё", "е")
+    return sum(1 for g in wanted if g in genres)
 
 # ===== MUSICIAN =====
+MUSICIAN_FIELDS = ("instrument", "experience", "genres", "location_text", "about")
+
+MATCH_LIMIT = 50          # сколько музыкантов возвращает подбор
+MATCH_CANDIDATES = 100    # сколько кандидатов берём из индекса для ранжирования по жанрам
+MATCH_RADIUS_KM = 50      # радиус поиска вокруг города заявки
+REVERSE_MATCH_LIMIT = 20  # сколько открытых заявок предлагаем новому профилю за раз
+VECTOR_CANDIDATES = 2000  # сколько кандидатов ранжируем по сходству с описанием заявки
+
+@_timed
 def register_musician(tid, instrument, experience, genres, location_text, about):
-    with _connect() as conn:
+    row = (tid, instrument, experience, genres, location_text, about, *_location_columns(location_text))
+
+    def work(conn):
         conn.execute("""
             INSERT OR REPLACE INTO musicians
-            (telegram_id, instrument, experience, genres, location_text, about)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (tid, instrument, experience, genres, location_text, about))
-        conn.commit()
+            (telegram_id, instrument, experience, genres, location_text, about, location_key, lat, lon)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, row)
+        return _vector_slots(conn, [tid])
+
+    slots = _write(work)
+    _invalidate(f"musician:{tid}")
+    _write_vectors(slots, [vectors.musician_text(genres, about)])
+
+@_timed
+def update_musician(tid, field, value):
+    if field not in MUSICIAN_FIELDS:
+        raise ValueError(f"Unknown musician field: {field}")
+
+    def work(conn):
+        if field == "location_text":
+            cur = conn.execute(
+                "UPDATE musicians SET location_text=?, location_key=?, lat=?, lon=? WHERE telegram_id=?",
+                (value, *_location_columns(value), tid)
+            )
+        else:
+            cur = conn.execute(f"UPDATE musicians SET {field}=? WHERE telegram_id=?", (value, tid))
+        if not cur.rowcount or field not in VECTOR_FIELDS:
+            return cur.rowcount, None, None
+        row = conn.execute("SELECT genres, about FROM musicians WHERE telegram_id=?", (tid,)).fetchone()
+        return cur.rowcount, row, _vector_slots(conn, [tid])
+
+    updated, row, slots = _write(work)
+    _invalidate(f"musician:{tid}")
+    if row is not None:
+        _write_vectors(slots, [vectors.musician_text(row["genres"], row["about"])])
+    return updated > 0
 
 def get_musician_profile(tid):
+    profile = _cached(f"musician:{tid}", lambda: _load_musician(tid))
+    return dict(profile) if profile else None
+
+@metrics.timed(metrics.DB_QUERY_SECONDS, "get_musician_profile")
+def _load_musician(tid):
     with _connect() as conn:
         row = conn.execute("SELECT * FROM musicians WHERE telegram_id=?", (tid,)).fetchone()
         return dict(row) if row else None
 
-def find_musicians_by_text_location(instrument, location_text, min_exp=0):
+@_timed
+def find_musicians_by_text_location(instrument, location_text, min_exp=0, genre=None,
+                                    limit=MATCH_LIMIT, radius_km=MATCH_RADIUS_KM, description=None):
+    """Подбор музыкантов по ключу инструмента, локации и стажу.
+
+    Если город есть в справочнике geo, ищем в радиусе radius_km: города
+    обходятся от ближнего к дальнему, в каждом музыканты берутся по индексу
+    (самые опытные первыми), у результата есть поле distance_km. Иначе —
+    точное совпадение нормализованной локации. Внутри одного расстояния
+    кандидаты ранжируются по пересечению жанров с genre.
+    location_text «%» или пустой — любой город.
+
+    С description кандидатов берётся до VECTOR_CANDIDATES, и внутри одного
+    расстояния они ранжируются по сходству текста заявки (жанр и описание)
+    с жанрами и «о себе» музыканта (поле similarity, см. vectors.py).
+    """
+    location_key = normalize_location(location_text) if location_text != "%" else ""
+    places = nearby(location_key, radius_km) if location_key else []
+    if location_key and not places:
+        places = [(None, location_key)]
+    store = vector_store() if description else None
+    if store is not None:
+        return _rank_by_description(store, places, instrument, min_exp,
+                                    vectors.request_text(genre, description), limit)
+    musicians = []
     with _connect() as conn:
-        rows = conn.execute("""
-            SELECT * FROM musicians
-            WHERE instrument LIKE ? AND experience >= ?
-        """, (f"%{instrument}%", min_exp)).fetchall()
-        return [dict(r) for r in rows]
+        for distance, key in places:
+            rows = conn.execute("""
+                SELECT * FROM musicians
+                WHERE instrument = ? AND location_key = ? AND experience >= ?
+                ORDER BY experience DESC
+                LIMIT ?
+            """, (instrument, key, min_exp, MATCH_CANDIDATES - len(musicians))).fetchall()
+            for r in rows:
+                m = dict(r)
+                m["distance_km"] = round(distance) if distance is not None else None
+                musicians.append(m)
+            if len(musicians) >= MATCH_CANDIDATES:
+                break
+        if not location_key:
+            rows = conn.execute("""
+                SELECT * FROM musicians
+                WHERE instrument = ? AND experience >= ?
+                ORDER BY experience DESC
+                LIMIT ?
+            """, (instrument, min_exp, MATCH_CANDIDATES)).fetchall()
+            musicians = [dict(r) for r in rows]
+    wanted = _genre_tokens(genre)
+    if wanted:
+        # sort стабилен: при равных расстоянии и жанрах сохраняется порядок по стажу
+        musicians.sort(key=lambda m: (m.get("distance_km") or 0, -_genre_overlap(wanted, m["genres"])))
+    return musicians[:limit]
+
+def _rank_by_description(store, places, instrument, min_exp, query, limit):
+    candidates = []   # (расстояние, telegram_id, слот)
+    with _connect() as conn:
+        for distance, key in places or [(None, None)]:
+            rows = conn.execute(f"""
+                SELECT m.telegram_id, v.slot FROM musicians m
+                LEFT JOIN musician_vectors v ON v.telegram_id = m.telegram_id
+                WHERE m.instrument = ? {"AND m.location_key = ?" if key is not None else ""}
+                  AND m.experience >= ?
+                ORDER BY m.experience DESC
+                LIMIT ?
+            """, (instrument, *([key] if key is not None else []), min_exp,
+                  VECTOR_CANDIDATES - len(candidates))).fetchall()
+            candidates.extend((distance, r[0], r[1]) for r in rows)
+            if len(candidates) >= VECTOR_CANDIDATES:
+                break
+        if not candidates:
+            return []
+        scores = store.score([c[2] for c in candidates], vectors.embed(query))
+        # Сначала расстояние, внутри него — сходство, при равенстве — порядок по стажу
+        distances = vectors.np.array([c[0] or 0 for c in candidates], dtype=vectors.np.float32)
+        order = vectors.np.lexsort((-scores, distances), axis=0)[:limit].tolist()
+        ids = [candidates[i][1] for i in order]
+        rows = conn.execute(
+            f"SELECT * FROM musicians WHERE telegram_id IN ({', '.join('?' * len(ids))})", ids
+        ).fetchall()
+    by_id = {r["telegram_id"]: dict(r) for r in rows}
+    musicians = []
+    for i in order:
+        distance, tid, _ = candidates[i]
+        m = by_id[tid]
+        m["distance_km"] = round(distance) if distance is not None else None
+        m["similarity"] = round(float(scores[i]), 3)
+        musicians.append(m)
+    return musicians
+
+SEARCH_PAGE_SIZE = 10
+
+@_timed
+def search_musicians_page(instrument, min_exp, after=None, before=None, page_size=SEARCH_PAGE_SIZE):
+    """Одна страница поиска по инструменту и стажу, keyset-пагинация.
+
+    Порядок — (experience, telegram_id) по убыванию; after/before — ключ
+    (experience, telegram_id) последней/первой строки соседней страницы.
+    Берётся page_size + 1 строк, чтобы узнать, есть ли следующая страница.
+    Возвращает (строки страницы, есть ли ещё строки в направлении листания).
+    """
+    with _connect() as conn:
+        if before is not None:
+            # Ключ разбит на две части, чтобы обе шли поиском по индексу:
+            # сначала тот же стаж с большим id, затем больший стаж
+            rows = conn.execute("""
+                SELECT * FROM (
+                    SELECT * FROM musicians
+                    WHERE instrument = ? AND experience = ? AND experience >= ? AND telegram_id > ?
+                    ORDER BY telegram_id
+                    LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT * FROM musicians
+                    WHERE instrument = ? AND experience > ? AND experience >= ?
+                    ORDER BY experience, telegram_id
+                    LIMIT ?
+                )
+                LIMIT ?
+            """, (instrument, before[0], min_exp, before[1], page_size + 1,
+                  instrument, before[0], min_exp, page_size + 1, page_size + 1)).fetchall()
+            more = len(rows) > page_size
+            return [dict(r) for r in reversed(rows[:page_size])], more
+        if after is not None:
+            rows = conn.execute("""
+                SELECT * FROM (
+                    SELECT * FROM musicians
+                    WHERE instrument = ? AND experience = ? AND experience >= ? AND telegram_id < ?
+                    ORDER BY telegram_id DESC
+                    LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT * FROM musicians
+                    WHERE instrument = ? AND experience < ? AND experience >= ?
+                    ORDER BY experience DESC, telegram_id DESC
+                    LIMIT ?
+                )
+                LIMIT ?
+            """, (instrument, after[0], min_exp, after[1], page_size + 1,
+                  instrument, after[0], min_exp, page_size + 1, page_size + 1)).fetchall()
+        else:
+            rows = conn.execute("""
+                SELECT * FROM musicians
+                WHERE instrument = ? AND experience >= ?
+                ORDER BY experience DESC, telegram_id DESC
+                LIMIT ?
+            """, (instrument, min_exp, page_size + 1)).fetchall()
+        return [dict(r) for r in rows[:page_size]], len(rows) > page_size
 
 # ===== BAND REQUESTS =====
+@_timed
 def create_band_request(band_id, instrument, genre, description, location_text, min_exp):
-    with _connect() as conn:
-        cur = conn.execute("""
-            INSERT INTO band_requests
-            (band_id, instrument, genre, description, location_text, min_experience)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (band_id, instrument, genre, description, location_text, min_exp))
-        conn.commit()
-        return cur.lastrowid
+    row = (band_id, instrument, genre, description, location_text, min_exp,
+           normalize_location(location_text), time.time())
+    req_id = _write(lambda conn: conn.execute("""
+        INSERT INTO band_requests
+        (band_id, instrument, genre, description, location_text, min_experience, location_key, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, row).lastrowid)
+    _invalidate(f"band_requests:{band_id}")
+    return req_id
 
 def get_band_requests(band_id):
+    requests = _cached(f"band_requests:{band_id}", lambda: _load_band_requests(band_id))
+    return [dict(r) for r in requests]
+
+@metrics.timed(metrics.DB_QUERY_SECONDS, "get_band_requests")
+def _load_band_requests(band_id):
     with _connect() as conn:
         rows = conn.execute("SELECT * FROM band_requests WHERE band_id=?", (band_id,)).fetchall()
         return [dict(r) for r in rows]
 
 def get_band_request(req_id):
+    request = _cached(f"band_request:{req_id}", lambda: _load_band_request(req_id))
+    return dict(request) if request else None
+
+@metrics.timed(metrics.DB_QUERY_SECONDS, "get_band_request")
+def _load_band_request(req_id):
     with _connect() as conn:
         row = conn.execute("SELECT * FROM band_requests WHERE id=?", (req_id,)).fetchone()
         return dict(row) if row else None
 
+@_timed
 def assign_musician(req_id, musician_id):
+    """Закрепляет заявку за музыкантом, если она ещё свободна.
+
+    Проверка и запись — одно условное UPDATE: из одновременных откликов
+    выигрывает ровно один. Возвращает заявку победителю, остальным None.
+    """
+    rows = _write(lambda conn: conn.execute("""
+        UPDATE band_requests SET accepted_by=?, closed_at=?
+        WHERE id=? AND accepted_by IS NULL
+        RETURNING *
+    """, (musician_id, time.time(), req_id)).fetchall())
+    if not rows:
+        return None
+    req = dict(rows[0])
+    _invalidate(f"band_request:{req_id}", f"band_requests:{req['band_id']}")
+    return req
+
+@_timed
+def find_open_requests_for_musician(musician, limit=REVERSE_MATCH_LIMIT, radius_km=MATCH_RADIUS_KM):
+    """Открытые заявки, под которые подходит профиль: тот же инструмент,
+    достаточный стаж, город в радиусе radius_km. Не больше limit заявок,
+    ближайшие и самые свежие первыми — стоимость не зависит от числа заявок."""
+    location_key = musician["location_key"] or ""
+    places = nearby(location_key, radius_km) or [(None, location_key)]
+    found = []
     with _connect() as conn:
-        row = conn.execute("SELECT accepted_by FROM band_requests WHERE id=?", (req_id,)).fetchone()
-        if not row or row["accepted_by"]:
-            return False
-        conn.execute("UPDATE band_requests SET accepted_by=? WHERE id=?", (musician_id, req_id))
-        conn.commit()
-        return True
+        for _, key in places:
+            rows = conn.execute("""
+                SELECT * FROM band_requests
+                WHERE instrument = ? AND location_key = ? AND min_experience <= ?
+                  AND accepted_by IS NULL AND band_id != ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (musician["instrument"], key, musician["experience"],
+                  musician["telegram_id"], limit - len(found))).fetchall()
+            found.extend(dict(r) for r in rows)
+            if len(found) >= limit:
+                break
+    return found
+
+@_timed
+def record_alerts(pairs):
+    """pairs: (request_id, telegram_id). Возвращает только пары, о которых ещё не уведомляли."""
+    pairs = list(pairs)
+    return _write(lambda conn: [
+        pair for pair in pairs
+        if conn.execute("INSERT OR IGNORE INTO request_alerts VALUES (?, ?)", pair).rowcount
+    ])
+
+@_timed
+def cancel_band_request(req_id, band_id):
+    deleted = _write(lambda conn: conn.execute(
+        "DELETE FROM band_requests WHERE id=? AND band_id=?", (req_id, band_id)
+    ).rowcount)
+    if deleted:
+        _invalidate(f"band_request:{req_id}", f"band_requests:{band_id}")
+    return deleted > 0
+
+# ===== BULK =====
+# Массовая загрузка (bulk.py): пачка строк — один executemany и один коммит
+MUSICIAN_COLUMNS = ("telegram_id", "instrument", "experience", "genres", "location_text", "about")
+BAND_REQUEST_COLUMNS = ("id", "band_id", "instrument", "genre", "description",
+                        "location_text", "min_experience", "accepted_by")
+EXPORT_BATCH = 5000
+
+@_timed
+def import_musicians(rows):
+    """rows: кортежи в порядке MUSICIAN_COLUMNS. Существующие профили перезаписываются,
+    как в register_musician."""
+    rows = [(*row, *_location_columns(row[4])) for row in rows]
+
+    def work(conn):
+        conn.executemany("""
+            INSERT OR REPLACE INTO musicians
+            (telegram_id, instrument, experience, genres, location_text, about, location_key, lat, lon)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        return _vector_slots(conn, [row[0] for row in rows])
+
+    slots = _write(work)
+    _invalidate(*(f"musician:{row[0]}" for row in rows))
+    _write_vectors(slots, [vectors.musician_text(row[3], row[5]) for row in rows])
+    return len(rows)
+
+@_timed
+def import_band_requests(rows):
+    """rows: кортежи в порядке BAND_REQUEST_COLUMNS; id None — новая заявка, иначе перезапись.
+    Срок жизни загруженных заявок отсчитывается от загрузки."""
+    now = time.time()
+    rows = [(*row, normalize_location(row[5]), now, now if row[7] is not None else None) for row in rows]
+
+    def work(conn):
+        # Перезапись может сменить владельца: его прежний список заявок тоже устарел
+        replaced = [conn.execute("SELECT band_id FROM band_requests WHERE id=?", (row[0],)).fetchone()
+                    for row in rows if row[0] is not None]
+        conn.executemany("""
+            INSERT OR REPLACE INTO band_requests
+            (id, band_id, instrument, genre, description, location_text, min_experience, accepted_by, location_key,
+             created_at, closed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        return {r[0] for r in replaced if r is not None}
+
+    old_owners = _write(work)
+    _invalidate(*{f"band_requests:{band}" for band in old_owners | {row[1] for row in rows}},
+                *(f"band_request:{row[0]}" for row in rows if row[0] is not None))
+    return len(rows)
+
+def iter_table(table, batch=EXPORT_BATCH):
+    """Все строки musicians или band_requests (столбцы *_COLUMNS) по порядку ключа.
+    Читает пачками по ключу, поэтому память не зависит от размера таблицы."""
+    columns, key = {
+        "musicians": (MUSICIAN_COLUMNS, "telegram_id"),
+        "band_requests": (BAND_REQUEST_COLUMNS, "id"),
+    }[table]
+    sql = f"SELECT {', '.join(columns)} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?"
+    last = -2 ** 63
+    while True:
+        with _connect() as conn:
+            rows = conn.execute(sql, (last, batch)).fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < batch:
+            return
+        last = rows[-1][key]
+
+def optimize():
+    """Обновляет статистику планировщика после больших изменений. ANALYZE читает не больше
+    ANALYSIS_LIMIT строк каждого индекса, поэтому не зависит от размера таблиц.
+    Как и остальные записи, идёт через поток записи: блокировку ждёт он, а не читатели."""
+    def work(conn):
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}").fetchall()
+        conn.execute("PRAGMA optimize").fetchall()
+    _write(work)
+
+# ===== MAINTENANCE =====
+# Срок жизни заявок и возврат места файлу (maintenance.py). Заявки переносятся
+# в band_requests_archive пачками: одна пачка — одна короткая запись
+ANALYSIS_LIMIT = 1000
+ARCHIVE_COLUMNS = ("id", "band_id", "instrument", "genre", "description", "location_text",
+                   "min_experience", "accepted_by", "location_key", "created_at", "closed_at")
+
+@_timed
+def expire_band_requests(before, limit):
+    """Переносит в архив открытые заявки, созданные раньше before, самые старые первыми,
+    не больше limit. Возвращает перенесённые — их владельцам сообщают об истечении срока."""
+    return _archive_requests("accepted_by IS NULL AND created_at < ? ORDER BY created_at",
+                             before, limit, "expired")
+
+@_timed
+def archive_closed_requests(before, limit):
+    """Переносит в архив заявки, закрытые раньше before, не больше limit."""
+    return _archive_requests("accepted_by IS NOT NULL AND closed_at < ? ORDER BY closed_at",
+                             before, limit, "closed")
+
+def _archive_requests(where, before, limit, status):
+    columns = ", ".join(ARCHIVE_COLUMNS)
+    now = time.time()
+
+    def work(conn):
+        # Удаление и вставка в одной транзакции: заявку, которую закрыл отклик
+        # в той же группе записей, условие where уже не выберет
+        rows = conn.execute(f"""
+            DELETE FROM band_requests
+            WHERE id IN (SELECT id FROM band_requests WHERE {where} LIMIT ?)
+            RETURNING {columns}
+        """, (before, limit)).fetchall()
+        conn.executemany(f"""
+            INSERT OR REPLACE INTO band_requests_archive ({columns}, status, archived_at)
+            VALUES ({", ".join("?" * (len(ARCHIVE_COLUMNS) + 2))})
+        """, [(*r, status, now) for r in rows])
+        conn.executemany("DELETE FROM request_alerts WHERE request_id=?", [(r["id"],) for r in rows])
+        return [dict(r) for r in rows]
+
+    rows = _write(work)
+    _invalidate(*(f"band_request:{r['id']}" for r in rows), *(f"band_requests:{r['band_id']}" for r in rows))
+    return rows
+
+@_timed
+def count_band_requests():
+    """{"open", "closed", "archived"}: сколько заявок в рабочей таблице и в архиве."""
+    with _connect() as conn:
+        open_, closed = conn.execute(
+            "SELECT COUNT(*) - COUNT(accepted_by), COUNT(accepted_by) FROM band_requests"
+        ).fetchone()
+        archived = conn.execute("SELECT COUNT(*) FROM band_requests_archive").fetchone()[0]
+    return {"open": open_, "closed": closed, "archived": archived}
+
+def schema_ready():
+    """Применены ли все миграции, включая фоновые индексы."""
+    with _connect() as conn:
+        return not SCHEMA.pending(conn)
+
+def free_pages():
+    """(свободных страниц в файле, включён ли auto_vacuum=INCREMENTAL)."""
+    with _connect() as conn:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    return free, incremental
+
+def incremental_vacuum(pages):
+    """Возвращает файлу до pages свободных страниц. Шаг — обычная короткая запись,
+    обработчики ждут его не дольше, чем соседнюю запись в группе."""
+    _write(lambda conn: conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall())
+
+# ===== VECTORS =====
+# Векторы текстов профилей для ранжирования по описанию заявки (vectors.py).
+# Строка в файле выделяется в той же транзакции, что и запись профиля,
+# сам вектор пишется в файл после коммита.
+TEXT_MATCH = os.getenv("TEXT_MATCH", "vectors")   # или genres — только совпадение жанров
+VECTOR_FIELDS = ("genres", "about")
+VECTOR_BATCH = 5000
+_warned_numpy = False
+
+def vector_store():
+    """Файл векторов рядом с базой или None (TEXT_MATCH=genres или нет numpy)."""
+    global _warned_numpy
+    if TEXT_MATCH != "vectors":
+        return None
+    store = vectors.open_store(DB_FILE + ".vec")
+    if store is None and not _warned_numpy:
+        _warned_numpy = True
+        log.warning("numpy не установлен: подбор ранжирует только по жанрам")
+    return store
+
+def _vector_slots(conn, tids):
+    """Слоты векторов для telegram_id (новым выделяются следующие по порядку)."""
+    if vector_store() is None:
+        return []
+    conn.executemany("""
+        INSERT OR IGNORE INTO musician_vectors (telegram_id, slot)
+        VALUES (?, (SELECT COALESCE(MAX(slot) + 1, 0) FROM musician_vectors))
+    """, ((tid,) for tid in tids))
+    return [conn.execute("SELECT slot FROM musician_vectors WHERE telegram_id=?", (tid,)).fetchone()[0]
+            for tid in tids]
+
+def _write_vectors(slots, texts):
+    store = vector_store()
+    if store is not None and slots:
+        store.write(slots, [vectors.embed(text) for text in texts])
+
+def _backfill_vectors(rebuild=False):
+    """Векторы профилей, у которых их ещё нет; rebuild — пересчитать все.
+    Если файла векторов нет (удалён или перенесли одну базу), пересчитываются все."""
+    rebuild = rebuild or not os.path.exists(DB_FILE + ".vec")
+    if vector_store() is None:
+        return 0
+    done, last = 0, -2 ** 63
+    while True:
+        with _connect() as conn:
+            rows = conn.execute(f"""
+                SELECT m.telegram_id, m.genres, m.about FROM musicians m
+                LEFT JOIN musician_vectors v ON v.telegram_id = m.telegram_id
+                WHERE m.telegram_id > ? {"" if rebuild else "AND v.slot IS NULL"}
+                ORDER BY m.telegram_id LIMIT ?
+            """, (last, VECTOR_BATCH)).fetchall()
+            if not rows:
+                break
+            slots = _vector_slots(conn, [r["telegram_id"] for r in rows])
+            conn.commit()
+        _write_vectors(slots, [vectors.musician_text(r["genres"], r["about"]) for r in rows])
+        done += len(rows)
+        last = rows[-1]["telegram_id"]
+    vector_store().flush()
+    return done
+
+def rebuild_vectors():
+    return _backfill_vectors(rebuild=True)
+
+def count_vector_slots():
+    with _connect() as conn:
+        return conn.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM musician_vectors").fetchone()[0]
+
+def similar_musicians(text, k=MATCH_LIMIT, exact=False):
+    """Музыканты, чьи жанры и «о себе» ближе всего к тексту, по всей базе.
+    Использует индекс IVF, если он собран (python vectors.py build-index)."""
+    store = vector_store()
+    if store is None:
+        return []
+    slots, scores = store.top_k(vectors.embed(text), k, count_vector_slots(), exact=exact)
+    with _connect() as conn:
+        rows = conn.execute(f"""
+            SELECT m.*, v.slot FROM musician_vectors v JOIN musicians m ON m.telegram_id = v.telegram_id
+            WHERE v.slot IN ({', '.join('?' * len(slots))})
+        """, [int(s) for s in slots]).fetchall()
+    by_slot = {r["slot"]: dict(r) for r in rows}
+    result = []
+    for slot, score in zip(slots, scores):
+        m = by_slot.get(int(slot))
+        if m is not None:
+            m.pop("slot")
+            m["similarity"] = round(float(score), 3)
+            result.append(m)
+    return result
+
+# ===== OUTBOX =====
+@_timed
+def enqueue_messages(messages):
+    """messages: итерируемое из (chat_id, text, reply_markup_json). Одна транзакция на всю пачку."""
+    messages = list(messages)
+    return _write(lambda conn: conn.executemany(
+        "INSERT INTO outbox (chat_id, text, reply_markup) VALUES (?, ?, ?)", messages
+    ).rowcount)
+
+@_timed
+def fetch_due_messages(now, limit):
+    with _connect() as conn:
+        rows = conn.execute("""
+            SELECT * FROM outbox WHERE not_before <= ?
+            ORDER BY not_before, id LIMIT ?
+        """, (now, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+@_timed
+def delete_messages(ids):
+    ids = [(i,) for i in ids]
+    _write(lambda conn: conn.executemany("DELETE FROM outbox WHERE id=?", ids))
+
+@_timed
+def reschedule_messages(updates):
+    """updates: итерируемое из (not_before, attempts, id)."""
+    updates = list(updates)
+    _write(lambda conn: conn.executemany("UPDATE outbox SET not_before=?, attempts=? WHERE id=?", updates))
+
+@_timed
+def count_pending_messages():
+    with _connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+# ===== SESSIONS =====
+@_timed
+def get_session(chat_id):
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM sessions WHERE chat_id=?", (chat_id,)).fetchone()
+        return dict(row) if row else None
+
+@_timed
+def set_session(chat_id, state, data, updated_at):
+    _write(lambda conn: conn.execute("""
+        INSERT OR REPLACE INTO sessions (chat_id, state, data, updated_at)
+        VALUES (?, ?, ?, ?)
+    """, (chat_id, state, data, updated_at)))
+
+@_timed
+def delete_session(chat_id):
+    _write(lambda conn: conn.execute("DELETE FROM sessions WHERE chat_id=?", (chat_id,)))
+
+@_timed
+def purge_sessions(before):
+    return _write(lambda conn: conn.execute("DELETE FROM sessions WHERE updated_at < ?", (before,)).rowcount)
+
+# ===== UPDATE SPOOL =====
+@_timed
+def spool_updates(rows):
+    """rows: (update_id, chat_id, shard, payload). Повторно доставленные update_id пропускаются."""
+    rows = list(rows)
+    _write(lambda conn: conn.executemany(
+        "INSERT OR IGNORE INTO update_spool (update_id, chat_id, shard, payload) VALUES (?, ?, ?, ?)",
+        rows
+    ))
+
+@_timed
+def fetch_spooled(shard, limit):
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT * FROM update_spool WHERE shard=? ORDER BY update_id LIMIT ?", (shard, limit)
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+@_timed
+def mark_spooled_attempt(update_id):
+    _write(lambda conn: conn.execute(
+        "UPDATE update_spool SET attempts = attempts + 1 WHERE update_id=?", (update_id,)
+    ))
+
+@_timed
+def delete_spooled(update_id):
+    _write(lambda conn: conn.execute("DELETE FROM update_spool WHERE update_id=?", (update_id,)))
+
+def reshard_spool(shards):
+    """Перераспределяет необработанное по новому числу шардов (после смены числа процессов)."""
+    return _write(lambda conn: conn.execute("""
+        UPDATE update_spool SET shard = ((chat_id % :n) + :n) % :n
+        WHERE shard != ((chat_id % :n) + :n) % :n
+    """, {"n": shards}).rowcount)
+
+@_timed
+def count_spooled():
+    with _connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM update_spool").fetchone()[0]
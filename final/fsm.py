@@ -0,0 +1,140 @@
+"""Пошаговые диалоги (анкета музыканта, заявка, редактирование) с состоянием вне памяти процесса.
+
+Вместо bot.register_next_step_handler, который держит замыкания в памяти,
+текущий шаг и собранные данные пользователя лежат в хранилище
+(по умолчанию таблица sessions в SQLite). Поэтому состояние переживает
+перезапуск и общее для нескольких процессов бота, а брошенные анкеты
+удаляются по TTL. SESSION_STORE=memory держит сессии в памяти процесса.
+
+    flow = StateMachine(make_store())
+
+    @flow.step
+    def musician_experience(message, instrument): ...
+
+    flow.set_next(message, musician_experience, instrument="guitar")
+"""
+import json
+import os
+import threading
+import time
+
+import db
+import metrics
+
+SESSION_TTL = 24 * 3600    # секунд до удаления брошенного диалога
+PURGE_INTERVAL = 600       # как часто чистить просроченные сессии
+
+
+class SQLiteStore:
+    """Сессии в таблице sessions базы бота."""
+
+    def get(self, chat_id):
+        row = db.get_session(chat_id)
+        return (row["state"], json.loads(row["data"]), row["updated_at"]) if row else None
+
+    def set(self, chat_id, state, data):
+        db.set_session(chat_id, state, json.dumps(data, ensure_ascii=False), time.time())
+
+    def delete(self, chat_id):
+        db.delete_session(chat_id)
+
+    def purge(self, before):
+        return db.purge_sessions(before)
+
+
+class MemoryStore:
+    """Хранилище в памяти процесса — для одного процесса и отладки."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, chat_id):
+        return self.sessions.get(chat_id)
+
+    def set(self, chat_id, state, data):
+        with self.lock:
+            self.sessions[chat_id] = (state, data, time.time())
+
+    def delete(self, chat_id):
+        with self.lock:
+            self.sessions.pop(chat_id, None)
+
+    def purge(self, before):
+        with self.lock:
+            stale = [c for c, (_, _, updated) in self.sessions.items() if updated < before]
+            for c in stale:
+                del self.sessions[c]
+        return len(stale)
+
+
+def make_store():
+    """Хранилище по переменной окружения SESSION_STORE: sqlite (по умолчанию) или memory."""
+    if os.getenv("SESSION_STORE", "sqlite") == "memory":
+        return MemoryStore()
+    return SQLiteStore()
+
+
+class StateMachine:
+    def __init__(self, store, ttl=SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+        self.steps = {}
+        self.last_purge = 0.0
+
+    def step(self, handler):
+        """Декоратор: регистрирует функцию как шаг диалога. Имя функции — имя состояния.
+        Вызовы шагов через dispatch замеряются в метриках обработчиков."""
+        self.steps[handler.__name__] = metrics.handler(handler)
+        return handler
+
+    def set_next(self, message, handler, **data):
+        """Следующее сообщение из этого чата уйдёт в handler(message, **data)."""
+        if handler.__name__ not in self.steps:
+            raise ValueError(f"Step {handler.__name__} is not registered")
+        self.store.set(message.chat.id, handler.__name__, data)
+        self._maybe_purge()
+
+    def clear(self, chat_id):
+        self.store.delete(chat_id)
+
+    def current(self, chat_id):
+        """(state, data) активного диалога или None, если его нет или он просрочен."""
+        session = self.store.get(chat_id)
+        if not session:
+            return None
+        state, data, updated = session
+        if updated < time.time() - self.ttl or state not in self.steps:
+            self.store.delete(chat_id)
+            return None
+        return state, data
+
+    def is_active(self, message):
+        """Фильтр обработчика. Прочитанная сессия остаётся на сообщении,
+        и dispatch не читает её из хранилища второй раз."""
+        message.fsm_session = self.current(message.chat.id)
+        return message.fsm_session is not None
+
+    def dispatch(self, message):
+        """Передаёт сообщение текущему шагу. Шаг снимается до вызова,
+        так что обработчик продолжает диалог только явным set_next.
+        Если шаг упал (например, 429 от Bot API) и не поставил следующий,
+        шаг возвращается: следующее сообщение попадёт в него же."""
+        session = getattr(message, "fsm_session", None) or self.current(message.chat.id)
+        if not session:
+            return False
+        state, data = session
+        self.store.delete(message.chat.id)
+        try:
+            self.steps[state](message, **data)
+        except Exception:
+            if self.store.get(message.chat.id) is None:
+                self.store.set(message.chat.id, state, data)
+            raise
+        return True
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self.last_purge > PURGE_INTERVAL:
+            self.last_purge = now
+            self.store.purge(now - self.ttl)
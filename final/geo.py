@@ -0,0 +1,180 @@
+"""Локации без сети: встроенный справочник городов, нормализация текста и поиск соседних городов.
+
+Координаты — центры городов, поэтому расстояния считаются между городами.
+Для «в радиусе N км, ближайшие первыми» сначала по сеточному индексу
+находятся города вокруг, а музыканты в каждом городе — по индексу в SQLite.
+"""
+import math
+import re
+
+# Каноническое имя (в нормализованном виде) -> (широта, долгота)
+PLACES = {
+    "москва": (55.7558, 37.6173),
+    "санкт-петербург": (59.9343, 30.3351),
+    "новосибирск": (55.0084, 82.9357),
+    "екатеринбург": (56.8389, 60.6057),
+    "казань": (55.7961, 49.1064),
+    "нижний новгород": (56.2965, 43.9361),
+    "челябинск": (55.1644, 61.4368),
+    "самара": (53.1959, 50.1002),
+    "омск": (54.9885, 73.3242),
+    "ростов-на-дону": (47.2357, 39.7015),
+    "уфа": (54.7388, 55.9721),
+    "красноярск": (56.0153, 92.8932),
+    "воронеж": (51.6720, 39.1843),
+    "пермь": (58.0105, 56.2502),
+    "волгоград": (48.7080, 44.5133),
+    "краснодар": (45.0355, 38.9753),
+    "саратов": (51.5336, 46.0343),
+    "тюмень": (57.1522, 65.5272),
+    "тольятти": (53.5303, 49.3461),
+    "ижевск": (56.8526, 53.2045),
+    "барнаул": (53.3548, 83.7698),
+    "ульяновск": (54.3142, 48.4031),
+    "иркутск": (52.2870, 104.3050),
+    "хабаровск": (48.4827, 135.0838),
+    "ярославль": (57.6261, 39.8845),
+    "владивосток": (43.1155, 131.8855),
+    "махачкала": (42.9849, 47.5047),
+    "томск": (56.4846, 84.9476),
+    "оренбург": (51.7682, 55.0969),
+    "кемерово": (55.3547, 86.0873),
+    "новокузнецк": (53.7596, 87.1216),
+    "рязань": (54.6269, 39.6916),
+    "астрахань": (46.3479, 48.0336),
+    "набережные челны": (55.7436, 52.3958),
+    "пенза": (53.1959, 45.0183),
+    "липецк": (52.6031, 39.5708),
+    "киров": (58.6036, 49.6680),
+    "чебоксары": (56.1322, 47.2519),
+    "тула": (54.1931, 37.6173),
+    "калининград": (54.7104, 20.4522),
+    "курск": (51.7304, 36.1926),
+    "ставрополь": (45.0428, 41.9734),
+    "сочи": (43.5855, 39.7231),
+    "тверь": (56.8587, 35.9176),
+    "иваново": (57.0004, 40.9739),
+    "брянск": (53.2434, 34.3637),
+    "белгород": (50.5997, 36.5983),
+    "сургут": (61.2540, 73.3962),
+    "владимир": (56.1290, 40.4070),
+    "архангельск": (64.5393, 40.5170),
+    "смоленск": (54.7826, 32.0453),
+    "калуга": (54.5293, 36.2754),
+    "чита": (52.0339, 113.4994),
+    "орел": (52.9703, 36.0635),
+    "вологда": (59.2181, 39.8886),
+    "мурманск": (68.9585, 33.0827),
+    "псков": (57.8194, 28.3318),
+    "петрозаводск": (61.7849, 34.3469),
+    "великий новгород": (58.5219, 31.2755),
+    "якутск": (62.0355, 129.6755),
+    "севастополь": (44.6167, 33.5254),
+    "симферополь": (44.9521, 34.1024),
+    "подольск": (55.4312, 37.5457),
+    "химки": (55.8970, 37.4297),
+    "мытищи": (55.9116, 37.7308),
+    "балашиха": (55.7963, 37.9382),
+    "королев": (55.9142, 37.8256),
+    "зеленоград": (55.9825, 37.1814),
+    "минск": (53.9006, 27.5590),
+    "алматы": (43.2220, 76.8512),
+    "астана": (51.1694, 71.4491),
+    "ташкент": (41.2995, 69.2401),
+    "бишкек": (42.8746, 74.5698),
+    "ереван": (40.1792, 44.4991),
+    "тбилиси": (41.7151, 44.8271),
+}
+
+# Разговорные и старые названия -> каноническое имя
+ALIASES = {
+    "мск": "москва",
+    "спб": "санкт-петербург",
+    "питер": "санкт-петербург",
+    "санкт петербург": "санкт-петербург",
+    "петербург": "санкт-петербург",
+    "ленинград": "санкт-петербург",
+    "нск": "новосибирск",
+    "новосиб": "новосибирск",
+    "екб": "екатеринбург",
+    "ебург": "екатеринбург",
+    "нн": "нижний новгород",
+    "нижний": "нижний новгород",
+    "ростов": "ростов-на-дону",
+    "ростов на дону": "ростов-на-дону",
+    "челны": "набережные челны",
+    "алма-ата": "алматы",
+}
+
+_LOCATION_PREFIX = re.compile(r"^(г\.|г |город |пгт\.?|пос\.|поселок |с\.|село |д\.|деревня )\s*")
+_NON_WORD = re.compile(r"[^\w\s-]+")
+
+EARTH_RADIUS_KM = 6371.0
+GRID_STEP = 1.0   # размер ячейки сеточного индекса, градусы
+
+
+def _clean(part):
+    part = _NON_WORD.sub(" ", _LOCATION_PREFIX.sub("", part.strip()))
+    return " ".join(part.split())
+
+
+def _known(candidate):
+    key = ALIASES.get(candidate, candidate)
+    return key if key in PLACES else None
+
+
+def normalize_location(location_text):
+    """Ключ населённого пункта: «г. Москва, Арбат 10» -> «москва», «Питер» -> «санкт-петербург».
+
+    Ищет известный город в любой части через запятую и в первых словах части;
+    если города нет в справочнике, возвращает очищенную первую часть.
+    """
+    if not location_text:
+        return ""
+    parts = [_clean(p) for p in location_text.lower().replace("ё", "е").split(",")]
+    parts = [p for p in parts if p]
+    for part in parts:
+        words = part.split()
+        for candidate in (part, " ".join(words[:2]), words[0]):
+            key = _known(candidate)
+            if key:
+                return key
+    return parts[0] if parts else ""
+
+
+def distance_km(a, b):
+    lat1, lon1 = map(math.radians, a)
+    lat2, lon2 = map(math.radians, b)
+    h = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
+# ===== SPATIAL INDEX =====
+def _cell(lat, lon):
+    return int(math.floor(lat / GRID_STEP)), int(math.floor(lon / GRID_STEP))
+
+
+_GRID = {}
+for _key, _point in PLACES.items():
+    _GRID.setdefault(_cell(*_point), []).append(_key)
+
+
+def nearby(location_key, radius_km):
+    """[(расстояние, ключ города)] в радиусе radius_km, ближайшие первыми; сам город — первым."""
+    center = PLACES.get(location_key)
+    if center is None:
+        return []
+    dlat = radius_km / 111.0
+    dlon = radius_km / (111.0 * max(0.01, math.cos(math.radians(center[0]))))
+    lat_from, lon_from = _cell(center[0] - dlat, center[1] - dlon)
+    lat_to, lon_to = _cell(center[0] + dlat, center[1] + dlon)
+    found = []
+    for i in range(lat_from, lat_to + 1):
+        for j in range(lon_from, lon_to + 1):
+            for key in _GRID.get((i, j), ()):
+                d = distance_km(center, PLACES[key])
+                if d <= radius_km:
+                    found.append((d, key))
+    found.sort()
+    return found
@@ -0,0 +1,155 @@
+"""Групповая фиксация записей в SQLite (write-behind unit of work).
+
+Раньше каждая запись (регистрация, заявка, шаг диалога) шла своей транзакцией:
+сколько сообщений, столько коммитов, а потоки обработчиков ещё и ждали друг
+друга на блокировке записи SQLite. Здесь записи из всех потоков складываются
+в очередь, и один поток записи выполняет накопившееся одной транзакцией —
+каждую запись в своей точке сохранения (SAVEPOINT), так что ошибка одной
+откатывает только её, — и фиксирует всё одним COMMIT.
+
+submit() возвращает результат записи только после того, как её транзакция
+зафиксирована: обработчик отвечает пользователю, когда данные уже на диске,
+как и без группировки.
+
+Пока поток записи фиксирует одну группу, следующая копится сама, поэтому под
+нагрузкой коммитов в разы меньше, чем записей, даже без ожидания. max_delay —
+сколько после первой записи группы дополнительно ждать попутчиков: коммитов
+ещё меньше, но каждый поток пишет не чаще раза в max_delay, так что при
+немногих потоках это скорее тормозит (см. python bench.py writes).
+max_batch — предел размера группы.
+
+    group = GroupCommit(open_connection, max_delay=0.002)
+    req_id = group.submit(lambda conn: conn.execute("INSERT ...").lastrowid)
+"""
+import logging
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+MAX_DELAY = 0.0            # секунд ждать попутчиков после первой записи группы
+MAX_BATCH = 256            # записей в одной транзакции
+
+BATCH_SIZE = metrics.histogram("bandfinder_db_write_batch_size", "Записей в одной фиксации",
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+COMMIT_SECONDS = metrics.histogram("bandfinder_db_commit_seconds", "Время выполнения и фиксации группы записей")
+
+_STOP = object()
+
+
+class _Write:
+    __slots__ = ("work", "queued", "done", "result", "error")
+
+    def __init__(self, work):
+        self.work = work
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommit:
+    """Поток записи с собственным соединением; connect() открывает его в этом потоке."""
+
+    def __init__(self, connect, max_delay=MAX_DELAY, max_batch=MAX_BATCH):
+        self.connect = connect
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.queue = []
+        self.cond = threading.Condition()
+        self.writes = 0
+        self.commits = 0
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    # ===== PUBLIC =====
+    def submit(self, work):
+        """Выполняет work(conn) в общей транзакции и ждёт её фиксации.
+        Возвращает результат work или поднимает его исключение (либо ошибку COMMIT)."""
+        if threading.current_thread() is self.thread:
+            return work(self.conn)   # запись изнутри другой записи — в той же транзакции
+        write = _Write(work)
+        with self.cond:
+            if self.thread is None:
+                raise RuntimeError("GroupCommit закрыт")
+            self.queue.append(write)
+            self.cond.notify()
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def close(self):
+        """Фиксирует уже принятые записи и останавливает поток."""
+        with self.cond:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return
+            self.queue.append(_STOP)
+            self.cond.notify()
+        thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {"writes": self.writes, "commits": self.commits, "queued": len(self.queue)}
+
+    # ===== WRITER =====
+    def _take(self):
+        """Следующая группа: ждёт первую запись, затем попутчиков до max_delay или max_batch."""
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            deadline = self.queue[0].queued + self.max_delay if self.queue[0] is not _STOP else 0
+            while len(self.queue) < self.max_batch and _STOP not in self.queue:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            batch, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+        return batch
+
+    def _run(self):
+        self.conn = self.connect()
+        self.conn.isolation_level = None   # транзакцией управляем сами: BEGIN ... COMMIT
+        try:
+            while True:
+                batch = self._take()
+                stop = _STOP in batch
+                batch = [w for w in batch if w is not _STOP]
+                if batch:
+                    self._commit(batch)
+                if stop:
+                    return
+        finally:
+            self.conn.close()
+
+    def _commit(self, batch):
+        conn = self.conn
+        start = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for write in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    write.result = write.work(conn)
+                except Exception as e:
+                    write.error = e
+                    conn.execute("ROLLBACK TO write")
+                conn.execute("RELEASE write")
+            conn.execute("COMMIT")
+        except Exception as e:
+            # Не удались BEGIN или COMMIT: ни одна запись группы не сохранена
+            log.exception("Группа из %d записей не зафиксирована", len(batch))
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for write in batch:
+                write.result, write.error = None, e
+        COMMIT_SECONDS.observe(time.perf_counter() - start)
+        BATCH_SIZE.observe(len(batch))
+        with self.cond:
+            self.writes += len(batch)
+            self.commits += 1
+        for write in batch:
+            write.done.set()
@@ -0,0 +1,24 @@
+INSTRUMENTS = {
+    "vocal": "Вокал 🎤",
+    "guitar": "Гитара 🎸",
+    "bass": "Бас 🎵",
+    "drums": "Барабаны 🥁",
+    "keys": "Клавиши 🎹",
+    "other": "Другое 🎶"
+}
+
+# Все варианты написания -> ключ инструмента: кнопка, название без эмодзи, сам ключ
+_ALIASES = {}
+for _key, _label in INSTRUMENTS.items():
+    _ALIASES[_label.lower()] = _key
+    _ALIASES[_label.split()[0].lower()] = _key
+    _ALIASES[_key] = _key
+
+
+def normalize_instrument(text, default="other"):
+    """Приводит текст кнопки или ввод пользователя («гитара», «Гитара 🎸», «guitar»)
+    к ключу из INSTRUMENTS. Для неизвестного инструмента возвращает default."""
+    text = (text or "").strip().lower().replace("ё", "е")
+    if not text:
+        return default
+    return _ALIASES.get(text) or _ALIASES.get(text.split()[0], default)
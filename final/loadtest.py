@@ -0,0 +1,808 @@
+"""Нагрузочный тест: настоящий процесс бота против локального Bot API.
+
+Бот запускается отдельным процессом (final/main.py или бот заметок из
+корневого main.py), его запросы к Telegram уходят на локальный сервер.
+Сервер изображает Bot API: отдаёт обновления через getUpdates или webhook,
+принимает sendMessage, editMessageText, answerCallbackQuery, setWebhook,
+deleteWebhook и по запросу отвечает 429. N виртуальных пользователей
+одновременно проходят сценарий; задержка шага — от появления обновления
+до ответа бота в этот чат.
+
+Запуск из каталога final/:
+    python loadtest.py signup --users 50
+    python loadtest.py requests --users 20 --seed 100000
+    python loadtest.py accept --users 200 --flood-rate 0.02
+    python loadtest.py signup --users 100 --mode webhook
+    python loadtest.py notes --users 50 --out notes.json
+    python loadtest.py accept --users 200 --baseline before.json
+
+Отчёт — JSON (stdout или --out): пропускная способность, p50/p95/p99 по
+шагам и в целом, время в функциях модуля базы, CPU и пиковая память
+процесса бота. С --baseline изменения относительно прошлого отчёта
+печатаются в stderr. Бот работает на временной базе и не трогает
+bandfinder.db и notes.db.
+"""
+import argparse
+import collections
+import importlib
+import inspect
+import json
+import os
+import random
+import resource
+import runpy
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TARGETS = {
+    # бот -> (скрипт, модуль базы, время которого считаем)
+    "final": (os.path.join(HERE, "main.py"), "db"),
+    "notes": (os.path.join(os.path.dirname(HERE), "main.py"), "notes_db"),
+}
+USER_BASE = 10 ** 9        # id виртуальных пользователей не пересекаются с --seed
+STEP_TIMEOUT = 30          # сколько ждать ответа бота на шаг
+IDLE = 3.0                 # сколько музыканты ждут новых уведомлений после заявок
+READY_TIMEOUT = 30
+WEBHOOK_CONNECTIONS = 40
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadBot", "username": "load_bot"}
+SEND_METHODS = {"sendMessage", "editMessageText"}    # на них сервер может ответить 429
+RETRY_AFTER = 1                                      # retry_after в ответе 429, секунд
+
+
+# ===== FAKE BOT API =====
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not issubclass(sys.exc_info()[0], ConnectionError):   # бот оборвал соединение — не ошибка
+            super().handle_error(request, client_address)
+
+
+class FakeTelegram:
+    """Bot API на localhost. Ответы бота раскладываются по ящикам виртуальных пользователей."""
+
+    def __init__(self, latency=0.0, flood_rate=0.0, rps=0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.rps = rps
+        self.tokens, self.refilled = float(rps), time.monotonic()
+        self.rnd = random.Random(1)
+        self.cond = threading.Condition()
+        self.pending = []              # обновления для getUpdates
+        self.outgoing = None           # очередь для webhook, создаётся в setWebhook
+        self.webhook = None            # (url, secret)
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.users = {}                # chat_id -> VirtualUser
+        self.callbacks = {}            # callback_query_id -> VirtualUser
+        self.calls = collections.Counter()
+        self.sent = []                 # (perf_counter приёма, chat_id, статус) каждого sendMessage
+        self.flood = 0
+        self.unrouted = 0              # сообщения в чаты, за которыми нет пользователя (--seed)
+        self.alerts = 0
+        self.last_alert = time.monotonic()
+        self.webhook_retries = 0
+        self.ready = threading.Event()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Заголовки и тело уходят разными записями: без NODELAY keep-alive ждёт delayed ACK
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                url = urlsplit(self.path)
+                params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+                params.update({k: v[0] for k, v in parse_qs(url.query).items()})
+                status, payload = api.handle(url.path.rsplit("/", 1)[1], params)
+                body = json.dumps(payload, ensure_ascii=False).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass   # бот уже остановлен
+
+            do_GET = do_POST   # getUpdates telebot запрашивает через GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name="fake-api", daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/bot{{0}}/{{1}}"
+
+    def close(self):
+        self.server.shutdown()
+        with self.cond:
+            self.webhook = None
+            self.cond.notify_all()
+
+    # ===== METHODS =====
+    def handle(self, method, params):
+        received = time.perf_counter()
+        with self.cond:
+            self.calls[method] += 1
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method in SEND_METHODS and self._flooded():
+            self._log_send(method, params, received, 429)
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {RETRY_AFTER}",
+                         "parameters": {"retry_after": RETRY_AFTER}}
+        if method == "sendMessage" or method == "editMessageText":
+            message = self._message(method, params)
+            self._log_send(method, params, received, 200)
+            return 200, {"ok": True, "result": message}
+        if method == "answerCallbackQuery":
+            self._route(self.callbacks.pop(params.get("callback_query_id"), None), {
+                "method": method, "text": params.get("text"),
+                "callback_id": params.get("callback_query_id"),
+            })
+        elif method == "setWebhook":
+            self._set_webhook(params)
+        elif method == "deleteWebhook":
+            with self.cond:
+                self.webhook = None
+                if params.get("drop_pending_updates") in ("true", "True"):
+                    self.pending.clear()
+        elif method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        return 200, {"ok": True, "result": True}
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), 25)
+        with self.cond:
+            if self.webhook is not None:
+                return 409, {"ok": False, "error_code": 409,
+                             "description": "Conflict: can't use getUpdates method while webhook is active"}
+            if offset < 0:   # skip_pending: очередь на старте пуста
+                return 200, {"ok": True, "result": []}
+            self.ready.set()
+            self.pending = [u for u in self.pending if u["update_id"] >= offset]
+            if not self.pending:
+                self.cond.wait(timeout)
+            return 200, {"ok": True, "result": self.pending[:limit]}
+
+    def _flooded(self):
+        with self.cond:
+            if self.flood_rate and self.rnd.random() < self.flood_rate:
+                self.flood += 1
+                return True
+            if not self.rps:
+                return False
+            now = time.monotonic()
+            self.tokens = min(self.rps, self.tokens + (now - self.refilled) * self.rps)
+            self.refilled = now
+            if self.tokens < 1:
+                self.flood += 1
+                return True
+            self.tokens -= 1
+            return False
+
+    def _log_send(self, method, params, received, status):
+        if method == "sendMessage":
+            with self.cond:
+                self.sent.append((received, int(params["chat_id"]), status))
+
+    def _message(self, method, params):
+        received = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = int(params["chat_id"])
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        with self.cond:
+            if method == "sendMessage":
+                message_id = self.next_message_id
+                self.next_message_id += 1
+            else:
+                message_id = int(params.get("message_id") or 0)
+        message = {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                   "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        if markup and "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        item = {"method": method, "text": message["text"], "markup": markup,
+                "message": message, "at": received}
+        if alert_request(item):
+            with self.cond:
+                self.alerts += 1
+                self.last_alert = time.monotonic()
+        self._route(self.users.get(chat_id), item)
+        return message
+
+    def _route(self, user, item):
+        item.setdefault("at", time.perf_counter())
+        if user is None:
+            with self.cond:
+                self.unrouted += 1
+            return
+        user.deliver(item)
+
+    # ===== UPDATES =====
+    def post_update(self, update):
+        with self.cond:
+            update["update_id"] = self.next_update_id
+            self.next_update_id += 1
+            if self.webhook is not None:
+                self.outgoing.put(update)
+            else:
+                self.pending.append(update)
+                self.cond.notify_all()
+
+    def message_update(self, user, text):
+        with self.cond:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        person = {"id": user.id, "is_bot": False, "first_name": f"user{user.id}"}
+        return {"message": {"message_id": message_id, "date": int(time.time()), "from": person,
+                            "chat": {"id": user.id, "type": "private"}, "text": text}}
+
+    def callback_update(self, user, data, message):
+        with self.cond:
+            callback_id = f"{user.id}-{self.next_update_id}-{len(self.callbacks)}"
+            self.callbacks[callback_id] = user
+        person = {"id": user.id, "is_bot": False, "first_name": f"user{user.id}"}
+        return callback_id, {"callback_query": {"id": callback_id, "from": person, "data": data,
+                                                "chat_instance": str(user.id), "message": message}}
+
+    # ===== WEBHOOK =====
+    def _set_webhook(self, params):
+        url = params.get("url")
+        if not url:
+            with self.cond:
+                self.webhook = None
+            return
+        import queue
+        with self.cond:
+            start = self.outgoing is None
+            if start:
+                self.outgoing = queue.Queue()
+            self.webhook = (url, params.get("secret_token"))
+            # Уже накопленное для getUpdates теперь тоже уходит на webhook
+            for update in self.pending:
+                self.outgoing.put(update)
+            self.pending.clear()
+        if start:
+            connections = min(int(params.get("max_connections") or WEBHOOK_CONNECTIONS), WEBHOOK_CONNECTIONS)
+            for i in range(connections):
+                threading.Thread(target=self._push, name=f"fake-webhook-{i}", daemon=True).start()
+        self.ready.set()
+
+    def _push(self):
+        while True:
+            update = self.outgoing.get()
+            body = json.dumps(update, ensure_ascii=False).encode()
+            while self.webhook is not None:
+                url, secret = self.webhook
+                headers = {"Content-Type": "application/json"}
+                if secret:
+                    headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+                try:
+                    with urllib.request.urlopen(urllib.request.Request(url, body, headers), timeout=60) as resp:
+                        status = resp.status
+                except urllib.error.HTTPError as e:
+                    status = e.code
+                except OSError:
+                    status = None   # сервер бота ещё не поднялся
+                if status == 200:
+                    break
+                with self.cond:
+                    self.webhook_retries += 1
+                time.sleep(0.05)
+
+
+# ===== VIRTUAL USERS =====
+def alert_request(item):
+    """callback_data кнопки «Откликнуться», если сообщение — уведомление о заявке."""
+    for row in (item.get("markup") or {}).get("inline_keyboard", []):
+        for button in row:
+            if button.get("callback_data", "").startswith("accept_"):
+                return button["callback_data"]
+    return None
+
+
+def _is_reply(item):
+    return not alert_request(item)
+
+
+class VirtualUser:
+    """Пишет боту от своего id и ждёт ответа; каждый шаг — одна задержка в отчёте."""
+
+    def __init__(self, api, stats, uid, timeout=STEP_TIMEOUT):
+        self.api = api
+        self.stats = stats
+        self.id = uid
+        self.timeout = timeout
+        self.inbox = []
+        self.cond = threading.Condition()
+        api.users[uid] = self
+
+    def deliver(self, item):
+        with self.cond:
+            self.inbox.append(item)
+            self.cond.notify_all()
+
+    def wait(self, match=_is_reply, timeout=None):
+        """Первое подходящее сообщение из ящика; None — не дождались."""
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self.cond:
+            while True:
+                for i, item in enumerate(self.inbox):
+                    if match(item):
+                        return self.inbox.pop(i)
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self.cond.wait(left)
+
+    def send(self, text, step):
+        return self._step(step, self.api.message_update(self, text), _is_reply)
+
+    def click(self, data, step, message):
+        callback_id, update = self.api.callback_update(self, data, message)
+        return self._step(step, update, lambda item: item.get("callback_id") == callback_id)
+
+    def _step(self, step, update, match):
+        with self.cond:
+            # Лишние ответы прошлого шага не должны засчитаться этому; уведомления остаются
+            self.inbox = [item for item in self.inbox if not _is_reply(item)]
+        start = time.perf_counter()
+        self.api.post_update(update)
+        reply = self.wait(match)
+        self.stats.record(step, reply["at"] - start if reply else None)
+        return reply
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(list)   # шаг -> задержки, с
+        self.timeouts = collections.Counter()
+        self.counters = collections.Counter()
+        self.errors = []
+        self.phases = {}
+
+    def record(self, step, latency):
+        with self.lock:
+            if latency is None:
+                self.timeouts[step] += 1
+            else:
+                self.samples[step].append(latency)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def phase(self, name, scripts):
+        """Запускает сценарии одновременно, по потоку на пользователя, и ждёт всех."""
+        def guarded(script):
+            try:
+                script()
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(f"{name}: {type(e).__name__}: {e}")
+
+        threads = [threading.Thread(target=guarded, args=(s,), daemon=True) for s in scripts]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.phases[name] = round(time.perf_counter() - start, 3)
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None, "mean": None}
+
+    def at(p):
+        return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 2)
+    return {"p50": at(50), "p95": at(95), "p99": at(99),
+            "max": round(values[-1] * 1000, 2), "mean": round(sum(values) / len(values) * 1000, 2)}
+
+
+# ===== SCENARIOS =====
+CITIES = ["Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Екатеринбург"]
+GENRES = ["рок", "джаз", "поп", "метал", "блюз", "фанк", "инди", "панк"]
+INSTRUMENT_BUTTONS = ["Вокал 🎤", "Гитара 🎸", "Бас 🎵", "Барабаны 🥁", "Клавиши 🎹"]
+WORDS = ["купить", "молоко", "позвонить", "маме", "отчёт", "встреча", "ёлка", "спорт", "книга", "код"]
+
+
+def musician_signup(user, instrument, experience, city, genres):
+    user.send("/start", "start")
+    user.send("🎤 Я музыкант", "role")
+    user.send(instrument, "instrument")
+    user.send(str(experience), "experience")
+    user.send(genres, "genres")
+    user.send("Играю по выходным", "about")
+    user.send(city, "location")
+
+
+def band_request(user, instrument, min_exp, city, description):
+    user.send("/start", "start")
+    user.send("🎶 У меня есть группа", "role")
+    user.send("➕ Создать заявку", "create_request")
+    user.send(instrument, "band_instrument")
+    user.send(str(min_exp), "band_experience")
+    user.send(city, "band_location")
+    user.send(description, "band_description")
+
+
+def accept_alerts(user, stats, bands_done, idle):
+    """Откликается на каждое уведомление, пока группы не закончили и поток уведомлений не стих."""
+    while True:
+        alert = user.wait(alert_request, timeout=0.5)
+        if alert is None:
+            if bands_done.is_set() and time.monotonic() - user.api.last_alert >= idle:
+                return
+            continue
+        reply = user.click(alert_request(alert), "accept", alert["message"])
+        if reply is not None:
+            stats.count("accepted" if reply.get("text") == "Вы откликнулись!" else "already_closed")
+
+
+def _users(api, stats, args, count, offset=0):
+    return [VirtualUser(api, stats, USER_BASE + offset + i, args.timeout) for i in range(count)]
+
+
+def scenario_signup(api, stats, args, rnd):
+    stats.phase("signup", [
+        (lambda u=u: musician_signup(u, rnd.choice(INSTRUMENT_BUTTONS), rnd.randint(0, 20),
+                                     rnd.choice(CITIES), ", ".join(rnd.sample(GENRES, 2))))
+        for u in _users(api, stats, args, args.users)
+    ])
+
+
+def scenario_requests(api, stats, args, rnd):
+    stats.phase("requests", [
+        (lambda u=u: band_request(u, rnd.choice(INSTRUMENT_BUTTONS), rnd.randint(0, 10),
+                                  rnd.choice(CITIES), f"{rnd.choice(GENRES)} группа, репетиции по средам"))
+        for u in _users(api, stats, args, args.users)
+    ])
+
+
+def scenario_accept(api, stats, args, rnd):
+    """Музыканты регистрируются, потом группы создают заявки и все разом откликаются."""
+    musicians = _users(api, stats, args, args.users)
+    stats.phase("signup", [
+        (lambda u=u: musician_signup(u, "Гитара 🎸", rnd.randint(1, 10), "Москва", "рок, блюз"))
+        for u in musicians
+    ])
+    bands = _users(api, stats, args, args.bands or max(1, args.users // 10), offset=args.users)
+    left = [len(bands)]
+    lock = threading.Lock()
+    bands_done = threading.Event()
+
+    def band(user):
+        try:
+            band_request(user, "Гитара 🎸", 0, "Москва", "рок группа ищет гитариста")
+        finally:
+            with lock:
+                left[0] -= 1
+                if not left[0]:
+                    bands_done.set()
+
+    stats.phase("accept",
+                [(lambda u=u: band(u)) for u in bands]
+                + [(lambda u=u: accept_alerts(u, stats, bands_done, args.idle)) for u in musicians])
+
+
+def notes_session(user, rnd, notes):
+    user.send("/start", "start")
+    ids = []
+    for _ in range(notes):
+        reply = user.send("/note_add " + " ".join(rnd.sample(WORDS, 3)), "note_add")
+        if reply and "#" in reply["text"]:
+            ids.append(reply["text"].split("#")[1].split()[0])
+    user.send("/note_list", "note_list")
+    reply = user.send("/note_find " + rnd.choice(WORDS), "note_find")
+    if reply and reply.get("markup"):
+        button = reply["markup"]["inline_keyboard"][0][-1]
+        user.click(button["callback_data"], "note_find_page", reply["message"])
+    user.send("/note_count", "note_count")
+    user.send("/max", "max")
+    user.send("/sum", "sum")
+    if ids:
+        user.send(f"/note_edit {ids[0]} исправленный текст", "note_edit")
+        user.send(f"/note_del {ids[-1]}", "note_del")
+
+
+def scenario_notes(api, stats, args, rnd):
+    stats.phase("notes", [
+        (lambda u=u: notes_session(u, rnd, args.notes))
+        for u in _users(api, stats, args, args.users)
+    ])
+
+
+SCENARIOS = {
+    # сценарий -> (бот, функция)
+    "signup": ("final", scenario_signup),
+    "requests": ("final", scenario_requests),
+    "accept": ("final", scenario_accept),
+    "notes": ("notes", scenario_notes),
+}
+
+
+# ===== BOT PROCESS =====
+class _DbProfile:
+    """Оборачивает публичные функции модуля базы; время считается по внешним вызовам,
+    чтобы вложенные вызовы (db.get_* внутри db.*) не учитывались дважды."""
+
+    def __init__(self, module):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reset()
+        for name, fn in list(vars(module).items()):
+            if inspect.isfunction(fn) and fn.__module__ == module.__name__ and not name.startswith("_"):
+                setattr(module, name, self._wrap(name, fn))
+
+    def reset(self):
+        with self.lock:
+            self.time = collections.Counter()
+            self.calls = collections.Counter()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            self.cpu = usage.ru_utime + usage.ru_stime
+
+    def _wrap(self, name, fn):
+        def wrapper(*args, **kwargs):
+            depth = getattr(self.local, "depth", 0)
+            self.local.depth = depth + 1
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.depth = depth
+                if not depth:
+                    elapsed = time.perf_counter() - start
+                    with self.lock:
+                        self.time[name] += elapsed
+                        self.calls[name] += 1
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+
+    def report(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss в Linux — килобайты, в macOS — байты
+        peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        rss = None
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            pass
+        with self.lock:
+            top = sorted(self.time, key=self.time.get, reverse=True)[:10]
+            return {
+                "db_time_s": round(sum(self.time.values()), 4),
+                "db_calls": sum(self.calls.values()),
+                "db_top": [{"function": name, "calls": self.calls[name],
+                            "total_ms": round(self.time[name] * 1000, 2),
+                            "mean_ms": round(self.time[name] * 1000 / self.calls[name], 3)} for name in top],
+                "cpu_s": round(usage.ru_utime + usage.ru_stime - self.cpu, 3),
+                "peak_rss_mb": round(peak / 2 ** 20, 1),
+                "rss_mb": round(rss / 2 ** 20, 1) if rss else None,
+                "threads": threading.active_count(),
+            }
+
+
+def _child(target, stats_path):
+    """Процесс бота: SIGUSR1 обнуляет счётчики перед нагрузкой, SIGTERM пишет отчёт и выходит."""
+    script, db_module = TARGETS[target]
+    sys.path.insert(0, os.path.dirname(script))
+    from telebot import apihelper
+    apihelper.API_URL = os.environ["TELEGRAM_API_URL"]   # корневой main.py этой переменной не знает
+    profile = _DbProfile(importlib.import_module(db_module))
+
+    def dump(*_):
+        with open(stats_path, "w") as f:
+            json.dump(profile.report(), f)
+        os._exit(0)
+
+    signal.signal(signal.SIGUSR1, lambda *_: profile.reset())
+    signal.signal(signal.SIGTERM, dump)
+    runpy.run_path(script, run_name="__main__")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_bot(target, api, args, tmp):
+    env = dict(os.environ, TOKEN="1:load", TELEGRAM_API_URL=api.url,
+               DB_FILE=os.path.join(tmp, "bandfinder.db"), NOTES_DB=os.path.join(tmp, "notes.db"),
+               GENRE_BACKEND="local", LOG_LEVEL=args.log_level, LOG_FILE="", METRICS_PORT="",
+               UPDATE_WORKERS=str(args.workers), PYTHONUNBUFFERED="1")
+    if args.mode == "webhook":
+        port = _free_port()
+        env.update(BOT_MODE="webhook", WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(port),
+                   WEBHOOK_PATH="/hook", WEBHOOK_URL=f"http://127.0.0.1:{port}/hook",
+                   WEBHOOK_SECRET="load-secret")
+    else:
+        env["BOT_MODE"] = "polling"
+    log = open(os.path.join(tmp, "bot.out"), "w")
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--child", target, "--stats", os.path.join(tmp, "stats.json")],
+        cwd=tmp, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + READY_TIMEOUT
+    while not api.ready.wait(0.2):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            with open(log.name) as f:
+                tail = f.read()[-3000:]
+            raise RuntimeError(f"Бот не запустился (код {proc.returncode}):\n{tail}")
+    return proc
+
+
+def _stop_bot(proc, tmp):
+    proc.terminate()
+    try:
+        proc.wait(15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        return None
+    try:
+        with open(os.path.join(tmp, "stats.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _seed(tmp, rows):
+    """Заранее заполняет базу final musicians, чтобы заявкам было кого подбирать."""
+    import bench
+    import db
+    db.DB_FILE = os.path.join(tmp, "bandfinder.db")
+    db.init_db()
+    bench._seed_musicians(rows)
+    db.close_all()
+
+
+def _git_rev():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=HERE).returncode != 0
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ===== RUN =====
+def run(args):
+    target, scenario = SCENARIOS[args.scenario]
+    tmp = tempfile.mkdtemp(prefix="bandfinder-load-")
+    if args.seed and target == "final":
+        _seed(tmp, args.seed)
+    api = FakeTelegram(args.api_ms / 1000, args.flood_rate, args.api_rps)
+    stats = Stats()
+    proc = _start_bot(target, api, args, tmp)
+    try:
+        os.kill(proc.pid, signal.SIGUSR1)   # старт бота в отчёт не входит
+        time.sleep(0.2)
+        start = time.perf_counter()
+        scenario(api, stats, args, random.Random(args.random_seed))
+        elapsed = time.perf_counter() - start
+    finally:
+        bot = _stop_bot(proc, tmp)
+        api.close()
+
+    samples = [x for values in stats.samples.values() for x in values]
+    return {
+        "scenario": args.scenario,
+        "target": target,
+        "mode": args.mode,
+        "git_rev": _git_rev(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("scenario", "out", "baseline", "child", "stats")},
+        "elapsed_s": round(elapsed, 3),
+        "phases_s": stats.phases,
+        "steps": len(samples),
+        "timeouts": sum(stats.timeouts.values()),
+        "errors": stats.errors[:20],
+        "throughput_steps_s": round(len(samples) / elapsed, 2) if elapsed else None,
+        "latency_ms": _percentiles(samples),
+        "by_step": {
+            step: {"count": len(values), "timeouts": stats.timeouts[step], **_percentiles(values)}
+            for step, values in sorted(stats.samples.items())
+        } | {step: {"count": 0, "timeouts": n, **_percentiles([])}
+             for step, n in stats.timeouts.items() if step not in stats.samples},
+        "counters": dict(stats.counters),
+        "api": {
+            "calls": dict(api.calls),
+            "flood_429": api.flood,
+            "alerts": api.alerts,
+            "unrouted": api.unrouted,
+            "webhook_retries": api.webhook_retries,
+        },
+        "bot": bot,
+    }
+
+
+COMPARED = [("throughput_steps_s",), ("latency_ms", "p50"), ("latency_ms", "p95"), ("latency_ms", "p99"),
+            ("bot", "db_time_s"), ("bot", "cpu_s"), ("bot", "peak_rss_mb")]
+
+
+def compare(report, baseline):
+    """Строки «метрика: было -> стало (±%)» для отчёта и прошлого прогона."""
+    lines = []
+    for path in COMPARED:
+        old, new = baseline, report
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        lines.append(f"{'.'.join(path)}: {old} -> {new} ({change})")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", nargs="?", choices=sorted(SCENARIOS))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--bands", type=int, default=0, help="групп в сценарии accept (по умолчанию users/10)")
+    parser.add_argument("--notes", type=int, default=5, help="заметок на пользователя в сценарии notes")
+    parser.add_argument("--seed", type=int, default=0, help="музыкантов в базе до старта (бот final)")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--workers", type=int, default=8, help="UPDATE_WORKERS бота final")
+    parser.add_argument("--api-ms", type=float, default=0.0, help="задержка ответа Bot API")
+    parser.add_argument("--api-rps", type=int, default=0, help="лимит sendMessage в секунду, сверх — 429")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля sendMessage, получающих 429")
+    parser.add_argument("--timeout", type=float, default=STEP_TIMEOUT)
+    parser.add_argument("--idle", type=float, default=IDLE)
+    parser.add_argument("--random-seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--out", help="записать отчёт в файл")
+    parser.add_argument("--baseline", help="прошлый отчёт для сравнения")
+    parser.add_argument("--child", choices=sorted(TARGETS), help=argparse.SUPPRESS)
+    parser.add_argument("--stats", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return _child(args.child, args.stats)
+    if not args.scenario:
+        parser.error("не указан сценарий")
+    if args.mode == "webhook" and SCENARIOS[args.scenario][0] != "final":
+        parser.error("webhook поддерживает только бот final")
+
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            for line in compare(report, json.load(f)):
+                print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
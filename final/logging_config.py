@@ -1,8 +1,216 @@
+"""Логирование: JSON-записи через очередь, ротация со сжатием, выборка шумных логгеров.
+
+Потоки обработчиков только кладут запись в очередь (QueueHandler), а пишет
+на консоль и в файл отдельный поток QueueListener — обработчик не ждёт диска.
+К каждой записи добавляется контекст: update_id и chat_id текущего
+обновления, имя обработчика (см. update_context, metrics.handler).
+
+Настраивается переменными окружения:
+    LOG_LEVEL=INFO
+    LOG_FORMAT=json            # или text
+    LOG_FILE=bot.log           # без него — только консоль
+    LOG_MAX_BYTES=10485760     # ротация по размеру...
+    LOG_ROTATE_HOURS=24        # ...и по времени; старые файлы сжимаются в .gz
+    LOG_BACKUPS=7
+    LOG_SAMPLING=TeleBot=0.1   # доля записей, которые оставляем, по логгерам
+"""
+import atexit
+import contextvars
+import gzip
+import json
 import logging
+import os
+import queue
+import random
+import shutil
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+QUEUE_SIZE = 10000
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 7
+ROTATE_HOURS = 24
+DEFAULT_SAMPLING = "TeleBot=0.1"   # ошибки polling telebot повторяются каждые несколько секунд
+CONTEXT_FIELDS = ("update_id", "chat_id", "handler", "duration_ms")
+
+_context = contextvars.ContextVar("log_context", default={})
+_listener = None
+
+
+# ===== CONTEXT =====
+def push_context(**fields):
+    """Добавляет поля ко всем записям текущего потока; вернуть токен в pop_context."""
+    return _context.set({**_context.get(), **fields})
+
+
+def pop_context(token):
+    _context.reset(token)
+
+
+def update_context(process):
+    """Обёртка над bot.process_new_updates: записи при обработке обновления
+    получают его update_id и chat_id."""
+    from updates import chat_key
+
+    def process_new_updates(updates):
+        for update in updates:
+            token = push_context(update_id=update.update_id, chat_id=chat_key(update))
+            try:
+                process([update])
+            finally:
+                pop_context(token)
+    return process_new_updates
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей от логгера (и его потомков); CRITICAL — всегда."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                record.sample_rate = rate
+                return random.random() < rate
+            name = name.rpartition(".")[0]
+        return True
+
+
+def parse_sampling(spec):
+    """«TeleBot=0.1,bandfinder.handlers=0.5» -> {"TeleBot": 0.1, ...}"""
+    rates = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+        name, _, rate = part.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+# ===== FORMAT =====
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS + ("sample_rate",):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
 
+
+TEXT_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | %(message)s"
+
+
+class _QueueHandler(QueueHandler):
+    """Не блокирует поток: при переполненной очереди запись отбрасывается и считается."""
+
+    dropped = 0
+    dropped_lock = threading.Lock()   # += из многих потоков не атомарен
+
+    def prepare(self, record):
+        # Сообщение и трассировку готовим здесь, но оставляем полями, а не склеиваем в текст
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _QueueHandler.dropped_lock:
+                _QueueHandler.dropped += 1
+
+
+def dropped_records():
+    """Сколько записей отброшено из-за переполненной очереди с начала работы процесса."""
+    return _QueueHandler.dropped
+
+
+# ===== FILES =====
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """Ротация по размеру или по возрасту файла; старые части сжимаются в gzip."""
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backups=BACKUPS, max_age=ROTATE_HOURS * 3600):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self.max_age = max_age
+        self.opened_at = time.time()
+
+    def shouldRollover(self, record):
+        if self.max_age and time.time() - self.opened_at >= self.max_age:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+    def rotation_filename(self, default_name):
+        return default_name + ".gz"
+
+    def rotate(self, source, dest):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+# ===== SETUP =====
 def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
+    """Настраивает корневой логгер; повторный вызов в том же процессе ничего не делает."""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    formatter = (logging.Formatter(TEXT_FORMAT, datefmt="%Y-%m-%d %H:%M:%S")
+                 if os.getenv("LOG_FORMAT", "json") == "text" else JsonFormatter())
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if os.getenv("LOG_FILE"):
+        outputs.append(CompressingRotatingFileHandler(
+            os.getenv("LOG_FILE"),
+            max_bytes=int(os.getenv("LOG_MAX_BYTES", MAX_BYTES)),
+            backups=int(os.getenv("LOG_BACKUPS", BACKUPS)),
+            max_age=float(os.getenv("LOG_ROTATE_HOURS", ROTATE_HOURS)) * 3600,
+        ))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    handler = _QueueHandler(queue.Queue(QUEUE_SIZE))
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(parse_sampling(os.getenv("LOG_SAMPLING", DEFAULT_SAMPLING))))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    # telebot вешает на свой логгер синхронный вывод в stderr — пусть идёт через очередь
+    logging.getLogger("TeleBot").handlers.clear()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = QueueListener(handler.queue, *outputs, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -1,12 +1,18 @@
 import os
 import logging
 import telebot
-from telebot import types
+from telebot import apihelper, types
 from dotenv import load_dotenv
 
+import broadcast
 import db
+import fsm
+import maintenance
+import metrics
 import openrouter
-from logging_config import setup_logging
+import updates
+from instruments import INSTRUMENTS, normalize_instrument
+from logging_config import setup_logging, update_context
 
 load_dotenv()
 setup_logging()
@@ -16,54 +22,69 @@ TOKEN = os.getenv("TOKEN")
 if not TOKEN:
     raise RuntimeError("Нет TOKEN в .env")
 
+# Адрес Bot API можно подменить, например на локальный тестовый сервер:
+# TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1}
+if os.getenv("TELEGRAM_API_URL"):
+    apihelper.API_URL = os.getenv("TELEGRAM_API_URL")
+
 bot = telebot.TeleBot(TOKEN)
-db.init_db()
-
-INSTRUMENTS = {
-    "vocal": "Вокал 🎤",
-    "guitar": "Гитара 🎸",
-    "bass": "Бас 🎵",
-    "drums": "Барабаны 🥁",
-    "keys": "Клавиши 🎹",
-    "other": "Другое 🎶"
-}
+bot.process_new_updates = update_context(bot.process_new_updates)
+metrics.instrument_telegram()
+if os.getenv("BANDFINDER_ROLE") != "worker":   # рабочим cluster.py схему готовит приёмник
+    db.init_db()
+flow = fsm.StateMachine(fsm.make_store())
 
 # ===== KEYBOARDS =====
-def kb_start():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("🎤 Я музыкант", "🎶 У меня есть группа")
-    return kb
+# Клавиатуры одинаковы для всех: собираются один раз при запуске, и их JSON
+# для Bot API тоже считается один раз, а не на каждую отправку
+class _Prebuilt(types.JsonSerializable):
+    def __init__(self, markup):
+        self.json = markup.to_json()
 
-def kb_main_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("👤 Профиль", "✏️ Редактировать профиль")
-    kb.row("📋 Мои заявки", "❌ Отменить заявку")
-    kb.row("➕ Создать заявку", "🔍 Найти музыкантов")
-    kb.row("ℹ️ О боте")
-    return kb
+    def to_json(self):
+        return self.json
 
-def kb_instruments():
+def _reply_keyboard(*rows):
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    items = list(INSTRUMENTS.keys())
-    for i in range(0, len(items), 2):
-        kb.row(*[INSTRUMENTS[k] for k in items[i:i+2]])
-    return kb
+    for row in rows:
+        kb.row(*row)
+    return _Prebuilt(kb)
+
+KB_START = _reply_keyboard(["🎤 Я музыкант", "🎶 У меня есть группа"])
+KB_MAIN_MENU = _reply_keyboard(
+    ["👤 Профиль", "✏️ Редактировать профиль"],
+    ["📋 Мои заявки", "❌ Отменить заявку"],
+    ["➕ Создать заявку", "🔍 Найти музыкантов"],
+    ["ℹ️ О боте"],
+)
+_instrument_names = list(INSTRUMENTS.values())
+KB_INSTRUMENTS = _reply_keyboard(*(_instrument_names[i:i + 2] for i in range(0, len(_instrument_names), 2)))
+KB_REMOVE = _Prebuilt(types.ReplyKeyboardRemove())
+
+# ===== DIALOG STEPS =====
+# Регистрируется первым: пока у пользователя открыт диалог, его сообщения идут в текущий шаг
+@bot.message_handler(func=flow.is_active)
+def continue_dialog(message):
+    flow.dispatch(message)
 
 # ===== START =====
 @bot.message_handler(commands=["start"])
+@metrics.handler
 def start(message):
     bot.send_message(
         message.chat.id,
         "🎸 BandFinderBot\n\nКто вы?",
-        reply_markup=kb_start()
+        reply_markup=KB_START
     )
 
 @bot.message_handler(commands=["menu"])
+@metrics.handler
 def menu(message):
-    bot.send_message(message.chat.id, "Выберите действие:", reply_markup=kb_main_menu())
+    bot.send_message(message.chat.id, "Выберите действие:", reply_markup=KB_MAIN_MENU)
 
 # ===== BUTTON HANDLERS =====
 @bot.message_handler(func=lambda m: m.text in ["🎤 Я музыкант", "🎶 У меня есть группа"])
+@metrics.handler
 def handle_start_buttons(message):
     if message.text == "🎤 Я музыкант":
         musician_start(message)
@@ -74,13 +95,14 @@ def band_owner_start(message):
     bot.send_message(
         message.chat.id,
         "🎼 Отлично! Вы можете создавать заявки для поиска музыкантов или смотреть свои заявки.",
-        reply_markup=kb_main_menu()
+        reply_markup=KB_MAIN_MENU
     )
 
 @bot.message_handler(func=lambda m: m.text in ["👤 Профиль", "✏️ Редактировать профиль", 
                                                "📋 Мои заявки", "❌ Отменить заявку",
                                                "➕ Создать заявку", "🔍 Найти музыкантов",
                                                "ℹ️ О боте"])
+@metrics.handler
 def handle_menu_buttons(message):
     text = message.text
     if text == "👤 Профиль":
@@ -105,14 +127,16 @@ def ask_location(chat_id):
 
 # ===== MUSICIAN FLOW =====
 def musician_start(message):
-    msg = bot.send_message(message.chat.id, "Ваш инструмент:", reply_markup=kb_instruments())
-    bot.register_next_step_handler(msg, musician_instrument)
+    msg = bot.send_message(message.chat.id, "Ваш инструмент:", reply_markup=KB_INSTRUMENTS)
+    flow.set_next(msg, musician_instrument)
 
+@flow.step
 def musician_instrument(message):
-    instrument = next((k for k, v in INSTRUMENTS.items() if v == message.text), "other")
+    instrument = normalize_instrument(message.text)
     msg = bot.send_message(message.chat.id, "Сколько лет вы играете?")
-    bot.register_next_step_handler(msg, musician_experience, instrument)
+    flow.set_next(msg, musician_experience, instrument=instrument)
 
+@flow.step
 def musician_experience(message, instrument):
     try:
         exp = int(message.text)
@@ -120,23 +144,26 @@ def musician_experience(message, instrument):
         bot.send_message(message.chat.id, "Введите число.")
         return
     msg = bot.send_message(message.chat.id, "Укажите жанры (через запятую):")
-    bot.register_next_step_handler(msg, musician_genres, instrument, exp)
+    flow.set_next(msg, musician_genres, instrument=instrument, exp=exp)
 
+@flow.step
 def musician_genres(message, instrument, exp):
     genres = message.text
     msg = bot.send_message(message.chat.id, "Напишите немного о себе:")
-    bot.register_next_step_handler(msg, musician_about, instrument, exp, genres)
+    flow.set_next(msg, musician_about, instrument=instrument, exp=exp, genres=genres)
 
+@flow.step
 def musician_about(message, instrument, exp, genres):
     about = message.text
     msg = ask_location(message.chat.id)
-    bot.register_next_step_handler(msg, musician_location, instrument, exp, genres, about)
+    flow.set_next(msg, musician_location, instrument=instrument, exp=exp, genres=genres, about=about)
 
+@flow.step
 def musician_location(message, instrument, exp, genres, about):
     location_text = message.text.strip()
     if not location_text:
         msg = ask_location(message.chat.id)
-        bot.register_next_step_handler(msg, musician_location, instrument, exp, genres, about)
+        flow.set_next(msg, musician_location, instrument=instrument, exp=exp, genres=genres, about=about)
         return
 
     db.register_musician(
@@ -151,19 +178,22 @@ def musician_location(message, instrument, exp, genres, about):
     bot.send_message(
         message.chat.id,
         "✅ Профиль музыканта сохранён!",
-        reply_markup=kb_main_menu()
+        reply_markup=KB_MAIN_MENU
     )
+    alert_open_requests(message.from_user.id)
 
 # ===== BAND / CREATE REQUEST FLOW =====
 def create_request_btn(message):
-    msg = bot.send_message(message.chat.id, "Кого ищете? Выберите инструмент:", reply_markup=kb_instruments())
-    bot.register_next_step_handler(msg, band_instrument)
+    msg = bot.send_message(message.chat.id, "Кого ищете? Выберите инструмент:", reply_markup=KB_INSTRUMENTS)
+    flow.set_next(msg, band_instrument)
 
+@flow.step
 def band_instrument(message):
-    instrument = next((k for k, v in INSTRUMENTS.items() if v == message.text), "other")
+    instrument = normalize_instrument(message.text)
     msg = bot.send_message(message.chat.id, "Минимальный стаж музыканта (лет):")
-    bot.register_next_step_handler(msg, band_experience, instrument)
+    flow.set_next(msg, band_experience, instrument=instrument)
 
+@flow.step
 def band_experience(message, instrument):
     try:
         min_exp = int(message.text)
@@ -171,20 +201,28 @@ def band_experience(message, instrument):
         bot.send_message(message.chat.id, "Введите число лет стажа.")
         return
     msg = ask_location(message.chat.id)
-    bot.register_next_step_handler(msg, band_location, instrument, min_exp)
+    flow.set_next(msg, band_location, instrument=instrument, min_exp=min_exp)
 
+@flow.step
 def band_location(message, instrument, min_exp):
     location_text = message.text.strip()
     if not location_text:
         msg = ask_location(message.chat.id)
-        bot.register_next_step_handler(msg, band_location, instrument, min_exp)
+        flow.set_next(msg, band_location, instrument=instrument, min_exp=min_exp)
         return
-    msg = bot.send_message(message.chat.id, "Опишите группу (жанр, опыт, цели):", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, band_description, instrument, min_exp, location_text)
+    msg = bot.send_message(message.chat.id, "Опишите группу (жанр, опыт, цели):", reply_markup=KB_REMOVE)
+    flow.set_next(msg, band_description, instrument=instrument, min_exp=min_exp, location_text=location_text)
 
+@flow.step
 def band_description(message, instrument, min_exp, location_text):
     description = message.text or "Без описания"
-    genre = openrouter.analyze_band_description(description)["genre"]
+    # Заявка создаётся в потоке чата: следующее сообщение чата её уже увидит, а обновление
+    # считается обработанным только после записи. Удалённую модель ждём не дольше GENRE_TIMEOUT
+    try:
+        genre = openrouter.analyze_band_description_async(description).result(openrouter.REMOTE_TIMEOUT)["genre"]
+    except Exception as e:
+        log.warning("Жанр не определён моделью: %r, используется локальный словарь", e)
+        genre = openrouter.local_genre(description)
 
     req_id = db.create_band_request(
         message.from_user.id,
@@ -195,34 +233,46 @@ def band_description(message, instrument, min_exp, location_text):
         min_exp
     )
 
-    # Поиск музыкантов с фильтром по стажу
-    musicians = db.find_musicians_by_text_location(instrument, location_text, min_exp)
+    # Подбор музыкантов: инструмент, город и стаж, ранжирование по сходству с описанием
+    musicians = db.find_musicians_by_text_location(instrument, location_text, min_exp, genre,
+                                                   description=description)
 
     bot.send_message(
         message.chat.id,
         f"🎼 Заявка создана\n🎧 Жанр: {genre}\n👥 Найдено: {len(musicians)}",
-        reply_markup=kb_main_menu()
+        reply_markup=KB_MAIN_MENU
     )
 
-    for m in musicians:
-        send_musician_alert(m, req_id, genre)
+    # Уведомления уходят через очередь рассылки, обработчик не ждёт отправки
+    db.record_alerts((req_id, m["telegram_id"]) for m in musicians)
+    broadcast.enqueue(musician_alert(m, req_id, genre) for m in musicians)
+
+def alert_open_requests(tid):
+    # Обратный подбор: новый или изменённый профиль получает подходящие открытые заявки
+    m = db.get_musician_profile(tid)
+    if not m:
+        return
+    requests = {r["id"]: r for r in db.find_open_requests_for_musician(m)}
+    new = db.record_alerts((req_id, tid) for req_id in requests)
+    broadcast.enqueue(musician_alert(m, req_id, requests[req_id]["genre"]) for req_id, _ in new)
 
-def send_musician_alert(m, req_id, genre):
+def musician_alert(m, req_id, genre):
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🤝 Откликнуться", callback_data=f"accept_{req_id}"))
-    bot.send_message(
+    return (
         m["telegram_id"],
         f"🎸 Группа ищет музыканта\n🎧 Жанр: {genre}\n📍 {m['location_text']}\n🎼 Опыт: {m['experience']} лет\n💬 О себе: {m['about']}",
-        reply_markup=kb
+        kb
     )
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("accept_"))
+@metrics.handler
 def accept(call):
     req_id = int(call.data.split("_")[1])
-    if not db.assign_musician(req_id, call.from_user.id):
+    req = db.assign_musician(req_id, call.from_user.id)
+    if not req:
         bot.answer_callback_query(call.id, "Заявка уже закрыта", show_alert=True)
         return
-    req = db.get_band_request(req_id)
     bot.send_message(req["band_id"], f"🎉 Музыкант найден!\nВы откликнулись!")
     bot.answer_callback_query(call.id, "Вы откликнулись!")
 
@@ -240,57 +290,56 @@ def profile(message):
 # ===== EDIT PROFILE =====
 def edit_profile(message):
     msg = bot.send_message(message.chat.id, "Что хотите изменить? (инструмент/опыт/жанры/о себе)")
-    bot.register_next_step_handler(msg, edit_choice)
+    flow.set_next(msg, edit_choice)
 
+@flow.step
 def edit_choice(message):
-    choice = message.text.lower()
-    if choice == "инструмент":
-        msg = bot.send_message(message.chat.id, "Выберите новый инструмент:", reply_markup=kb_instruments())
-        bot.register_next_step_handler(msg, edit_instrument)
-    elif choice == "опыт":
-        msg = bot.send_message(message.chat.id, "Введите новый опыт (лет):")
-        bot.register_next_step_handler(msg, edit_experience)
-    elif choice == "жанры":
-        msg = bot.send_message(message.chat.id, "Введите новые жанры через запятую:")
-        bot.register_next_step_handler(msg, edit_genres)
-    elif choice == "о себе":
-        msg = bot.send_message(message.chat.id, "Напишите о себе:")
-        bot.register_next_step_handler(msg, edit_about)
-    else:
+    # Переход выбирается по таблице EDIT_CHOICES, а не цепочкой if
+    choice = EDIT_CHOICES.get((message.text or "").strip().lower())
+    if not choice:
         bot.send_message(message.chat.id, "Неверный выбор.")
+        return
+    prompt, keyboard, step = choice
+    msg = bot.send_message(message.chat.id, prompt, reply_markup=keyboard)
+    flow.set_next(msg, step)
 
+@flow.step
 def edit_instrument(message):
-    instrument = next((k for k, v in INSTRUMENTS.items() if v == message.text), "other")
-    with db._connect() as conn:
-        conn.execute("UPDATE musicians SET instrument=? WHERE telegram_id=?", (instrument, message.from_user.id))
-        conn.commit()
+    instrument = normalize_instrument(message.text)
+    db.update_musician(message.from_user.id, "instrument", instrument)
     bot.send_message(message.chat.id, f"Инструмент обновлён на {message.text}")
+    alert_open_requests(message.from_user.id)
 
+@flow.step
 def edit_experience(message):
     try:
         exp = int(message.text)
     except ValueError:
         bot.send_message(message.chat.id, "Введите число.")
         return
-    with db._connect() as conn:
-        conn.execute("UPDATE musicians SET experience=? WHERE telegram_id=?", (exp, message.from_user.id))
-        conn.commit()
+    db.update_musician(message.from_user.id, "experience", exp)
     bot.send_message(message.chat.id, f"Опыт обновлён на {exp} лет")
+    alert_open_requests(message.from_user.id)
 
+@flow.step
 def edit_genres(message):
     genres = message.text
-    with db._connect() as conn:
-        conn.execute("UPDATE musicians SET genres=? WHERE telegram_id=?", (genres, message.from_user.id))
-        conn.commit()
+    db.update_musician(message.from_user.id, "genres", genres)
     bot.send_message(message.chat.id, f"Жанры обновлены: {genres}")
 
+@flow.step
 def edit_about(message):
     about = message.text
-    with db._connect() as conn:
-        conn.execute("UPDATE musicians SET about=? WHERE telegram_id=?", (about, message.from_user.id))
-        conn.commit()
+    db.update_musician(message.from_user.id, "about", about)
     bot.send_message(message.chat.id, f"О себе обновлено!")
 
+EDIT_CHOICES = {
+    "инструмент": ("Выберите новый инструмент:", KB_INSTRUMENTS, edit_instrument),
+    "опыт": ("Введите новый опыт (лет):", None, edit_experience),
+    "жанры": ("Введите новые жанры через запятую:", None, edit_genres),
+    "о себе": ("Напишите о себе:", None, edit_about),
+}
+
 # ===== MY REQUESTS =====
 def my_requests(message):
     requests = db.get_band_requests(message.from_user.id)
@@ -306,18 +355,16 @@ def my_requests(message):
 # ===== CANCEL =====
 def cancel_request(message):
     msg = bot.send_message(message.chat.id, "Введите ID заявки для отмены:")
-    bot.register_next_step_handler(msg, cancel_confirm)
+    flow.set_next(msg, cancel_confirm)
 
+@flow.step
 def cancel_confirm(message):
     try:
         req_id = int(message.text)
     except ValueError:
         bot.send_message(message.chat.id, "Неверный ID.")
         return
-    with db._connect() as conn:
-        cur = conn.execute("DELETE FROM band_requests WHERE id=? AND band_id=?", (req_id, message.from_user.id))
-        conn.commit()
-    if cur.rowcount:
+    if db.cancel_band_request(req_id, message.from_user.id):
         bot.send_message(message.chat.id, f"Заявка #{req_id} отменена.")
     else:
         bot.send_message(message.chat.id, "Не удалось отменить заявку.")
@@ -325,8 +372,9 @@ def cancel_confirm(message):
 # ===== SEARCH MUSICIANS =====
 def search_musicians_btn(message):
     msg = bot.send_message(message.chat.id, "Введите инструмент и минимальный стаж (через пробел), например: Гитара 5")
-    bot.register_next_step_handler(msg, search_musicians_by_instrument)
+    flow.set_next(msg, search_musicians_by_instrument)
 
+@flow.step
 def search_musicians_by_instrument(message):
     try:
         parts = message.text.strip().split()
@@ -336,14 +384,56 @@ def search_musicians_by_instrument(message):
         bot.send_message(message.chat.id, "Неверный формат. Пример: Гитара 5")
         return
 
-    musicians = db.find_musicians_by_text_location(instrument_text, "%", min_exp)
-    if not musicians:
+    instrument = normalize_instrument(instrument_text, default=None)
+    text, kb = search_page(instrument, min_exp, 0) if instrument else (None, None)
+    if not text:
         bot.send_message(message.chat.id, "Музыкантов не найдено.")
         return
-    text = "Найденные музыканты:\n"
+    bot.send_message(message.chat.id, text, reply_markup=kb)
+
+def search_page(instrument, min_exp, page_no, after=None, before=None):
+    """Текст и клавиатура одной страницы поиска. Курсор листания — в callback_data кнопок."""
+    musicians, more = db.search_musicians_page(instrument, min_exp, after=after, before=before)
+    if not musicians:
+        return None, None
+    text = f"Найденные музыканты (стр. {page_no + 1}):\n"
     for m in musicians:
-        text += f"🎸 {m['instrument']} | {m['experience']} лет | 💬 {m['about']} | 📍 {m['location_text']}\n"
-    bot.send_message(message.chat.id, text)
+        text += f"🎸 {INSTRUMENTS.get(m['instrument'], m['instrument'])} | {m['experience']} лет | 💬 {m['about']} | 📍 {m['location_text']}\n"
+
+    # При листании назад more означает «есть ещё раньше», а следующая страница есть всегда
+    has_prev = page_no > 0
+    has_next = more if before is None else True
+    first, last = musicians[0], musicians[-1]
+    buttons = []
+    if has_prev:
+        buttons.append(types.InlineKeyboardButton(
+            "◀️ Назад",
+            callback_data=f"srch:{instrument}:{min_exp}:{page_no - 1}:b:{first['experience']}:{first['telegram_id']}"
+        ))
+    if has_next:
+        buttons.append(types.InlineKeyboardButton(
+            "Далее ▶️",
+            callback_data=f"srch:{instrument}:{min_exp}:{page_no + 1}:a:{last['experience']}:{last['telegram_id']}"
+        ))
+    kb = None
+    if buttons:
+        kb = types.InlineKeyboardMarkup()
+        kb.row(*buttons)
+    return text, kb
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("srch:"))
+@metrics.handler
+def search_page_callback(call):
+    _, instrument, min_exp, page_no, direction, exp, tid = call.data.split(":")
+    cursor = (int(exp), int(tid))
+    text, kb = search_page(
+        instrument, int(min_exp), int(page_no),
+        after=cursor if direction == "a" else None,
+        before=cursor if direction == "b" else None,
+    )
+    if text:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
+    bot.answer_callback_query(call.id)
 
 # ===== ABOUT BOT =====
 def about_bot(message):
@@ -366,4 +456,23 @@ def about_bot(message):
 # ===== RUN =====
 if __name__ == "__main__":
     print("🎸 BandFinderBot запущен")
-    bot.infinity_polling(skip_pending=True)
+    broadcast.start(bot)
+    maintenance.start()   # срок жизни заявок, архив, VACUUM/ANALYZE
+    if os.getenv("METRICS_PORT"):
+        metrics.serve(int(os.getenv("METRICS_PORT")), os.getenv("METRICS_HOST", "127.0.0.1"))
+    # Обновления одного чата — строго по порядку, разных чатов — параллельно
+    workers = int(os.getenv("UPDATE_WORKERS", os.getenv("WEBHOOK_WORKERS", updates.WORKERS)))
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        import webhook
+        webhook.run(
+            bot,
+            url=os.environ["WEBHOOK_URL"],
+            host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            path=os.getenv("WEBHOOK_PATH", "/"),
+            secret=os.getenv("WEBHOOK_SECRET"),
+            workers=workers,
+        )
+    else:
+        updates.install(bot, workers=workers)
+        bot.infinity_polling(skip_pending=True)
@@ -0,0 +1,181 @@
+"""Фоновое обслуживание базы: срок жизни заявок, архив, VACUUM и ANALYZE.
+
+Без него band_requests только растёт: «Мои заявки» показывают всё, что
+группа когда-либо создавала, а закрытые и брошенные заявки раздувают таблицу
+и индексы. Раз в INTERVAL секунд фоновый поток:
+
+- переносит в архив (band_requests_archive) открытые заявки старше
+  REQUEST_TTL_DAYS и ставит владельцу уведомление в очередь рассылки;
+- переносит в архив заявки, закрытые больше CLOSED_KEEP_DAYS назад
+  (до этого владелец видит их в «Моих заявках» как закрытые);
+- возвращает файлу освободившиеся страницы (PRAGMA incremental_vacuum) и
+  обновляет статистику планировщика (PRAGMA optimize с analysis_limit).
+
+Всё делается пачками по BATCH строк через общий поток записи (db._write):
+каждая пачка — короткая транзакция, между пачками проходят записи
+обработчиков. Несколько процессов бота могут обслуживать одну базу: заявку
+удаляет из рабочей таблицы ровно одна транзакция, поэтому уведомление одно.
+
+Инкрементальный VACUUM работает на базах, созданных с auto_vacuum=INCREMENTAL
+(db._open включает его на новой базе). Старую базу можно перевести один раз,
+остановив бота: python maintenance.py vacuum. Без этого освободившиеся
+страницы не возвращаются файлу, но заново занимаются новыми строками —
+файл перестаёт расти.
+
+    python maintenance.py run       # один проход обслуживания сейчас
+    python maintenance.py vacuum    # полный VACUUM с переводом на auto_vacuum=INCREMENTAL
+"""
+import logging
+import os
+import threading
+import time
+
+import broadcast
+import db
+import metrics
+
+log = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+REQUEST_TTL = float(os.getenv("REQUEST_TTL_DAYS", "30")) * DAY     # срок открытой заявки
+CLOSED_KEEP = float(os.getenv("CLOSED_KEEP_DAYS", "7")) * DAY      # сколько показывать закрытую
+INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))        # секунд между проходами
+START_DELAY = 60.0        # первый проход — после фоновых миграций (migrations.ONLINE_DELAY)
+BATCH = 500               # заявок в одной транзакции
+VACUUM_PAGES = 1000       # страниц (4 МБ) за шаг инкрементального VACUUM
+PAUSE = 0.01              # секунд между пачками
+
+ARCHIVED = metrics.counter("bandfinder_requests_archived_total", "Заявки, перенесённые в архив", ["status"])
+metrics.gauge("bandfinder_band_requests", "Заявок в рабочей таблице",
+              lambda: {(k,): v for k, v in db.count_band_requests().items() if k != "archived"},
+              ["state"])
+
+
+def expired_notice(req):
+    days = round(REQUEST_TTL / DAY)
+    return (
+        req["band_id"],
+        f"⌛ Заявка #{req['id']} ({req['instrument']}, {req['genre']}) закрыта: "
+        f"за {days} дн. никто не откликнулся.\nЕсли музыкант ещё нужен, создайте новую заявку в /menu.",
+        None
+    )
+
+
+class Maintenance:
+    def __init__(self, request_ttl=REQUEST_TTL, closed_keep=CLOSED_KEEP, interval=INTERVAL, batch=BATCH):
+        self.request_ttl = request_ttl
+        self.closed_keep = closed_keep
+        self.interval = interval
+        self.batch = batch
+        self.stopping = threading.Event()
+        self.thread = None
+
+    # ===== PUBLIC =====
+    def start(self, delay=START_DELAY):
+        self.thread = threading.Thread(target=self._run, args=(delay,), name="maintenance", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def run_once(self, now=None):
+        """Один проход обслуживания. Возвращает, сколько заявок истекло и сколько
+        закрытых ушло в архив, и сколько страниц возвращено файлу."""
+        now = now or time.time()
+        if not db.schema_ready():
+            # Без индексов миграции 4 выборка старых заявок просматривала бы всю таблицу
+            log.info("Обслуживание отложено: не все миграции применены")
+            return None
+        expired = self._drain(db.expire_band_requests, now - self.request_ttl, notify=True)
+        closed = self._drain(db.archive_closed_requests, now - self.closed_keep)
+        ARCHIVED.labels("expired").inc(expired)
+        ARCHIVED.labels("closed").inc(closed)
+        freed = self._vacuum()
+        db.optimize()
+        if expired or closed or freed:
+            log.info("Обслуживание: истекло заявок %s, в архив закрытых %s, возвращено страниц %s",
+                     expired, closed, freed)
+        return {"expired": expired, "closed": closed, "freed_pages": freed}
+
+    # ===== LOOP =====
+    def _run(self, delay):
+        if self.stopping.wait(delay):
+            return
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                log.exception("Ошибка обслуживания базы")
+            if self.stopping.wait(self.interval):
+                return
+
+    def _drain(self, archive, before, notify=False):
+        total = 0
+        while not self.stopping.is_set():
+            rows = archive(before, self.batch)
+            if notify and rows:
+                broadcast.enqueue(expired_notice(r) for r in rows)
+            total += len(rows)
+            if len(rows) < self.batch:
+                break
+            time.sleep(PAUSE)
+        return total
+
+    def _vacuum(self):
+        free, incremental = db.free_pages()
+        if not incremental:
+            return 0
+        freed = 0
+        while free > 0 and not self.stopping.is_set():
+            db.incremental_vacuum(VACUUM_PAGES)
+            freed += min(free, VACUUM_PAGES)
+            free = db.free_pages()[0]
+            time.sleep(PAUSE)
+        return freed
+
+
+_maintenance = None
+
+
+def start(delay=START_DELAY):
+    global _maintenance
+    _maintenance = Maintenance().start(delay)
+    return _maintenance
+
+
+def vacuum_full():
+    """Полный VACUUM с переводом базы на auto_vacuum=INCREMENTAL. Блокирует базу
+    на всё время (секунды на сотни мегабайт) — только при остановленном боте."""
+    conn = db._open()   # с PRAGMA auto_vacuum=INCREMENTAL, который VACUUM и применит
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+# ===== CLI =====
+def main():
+    import argparse
+
+    from logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["run", "vacuum"])
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.action == "vacuum":
+        vacuum_full()
+        print(f"свободных страниц: {db.free_pages()[0]}")
+    else:
+        db.init_db()
+        db.SCHEMA.migrate(db._connect(), online=True)
+        print(Maintenance().run_once(), db.count_band_requests())
+    db.close_all()
+
+
+if __name__ == "__main__":
+    main()
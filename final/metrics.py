@@ -0,0 +1,407 @@
+"""Метрики в формате Prometheus и выборочный профилировщик.
+
+Счётчики и гистограммы живут в памяти процесса; GET /metrics отдаёт их
+текстом, который понимает Prometheus. Запись одного события — это
+bisect по границам корзин и несколько сложений под lock, порядка микросекунды
+(см. python bench.py metrics).
+
+    REQUESTS = counter("bandfinder_x_total", "Описание", ["kind"])
+    REQUESTS.labels("a").inc()
+
+    @timed(DB_QUERY_SECONDS)
+    def get_musician_profile(tid): ...
+
+Сервер метрик включается переменной METRICS_PORT (см. main.py, cluster.py).
+Там же ручки профилировщика: /debug/profile/start, /debug/profile/stop, /debug/profile.
+"""
+import bisect
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import logging_config
+
+log = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = 0.005   # период выборки стеков профилировщиком, секунды
+PROFILE_DEPTH = 40         # сколько кадров стека сохранять
+
+
+# ===== METRICS =====
+class _CounterChild:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # последняя — +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """Дочерняя метрика для набора значений меток; её стоит держать в переменной на горячем пути."""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name}: ожидались метки {self.label_names}, получено {values}")
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_text(values)} {_number(child.value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts, total = list(child.counts), child.sum
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _number(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(values, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {_number(total)}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение снимается в момент запроса /metrics: collect() -> {(значения меток): число}."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.collect() or {}
+        except Exception as e:
+            log.warning("Метрика %s не собрана: %s", self.name, e)
+            values = {}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{self._label_text(labels)} {_number(value)}")
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing   # повторный импорт модуля не плодит дублей
+        _registry[metric.name] = metric
+    return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def gauge(name, help, collect, labels=()):
+    return _register(Gauge(name, help, labels, collect))
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def timed(histogram, label=None, errors=None):
+    """Декоратор: время вызова в histogram с меткой label (по умолчанию — имя функции).
+
+    errors — необязательный счётчик с той же меткой для вызовов, упавших с исключением.
+    """
+    def decorator(fn):
+        name = label or fn.__name__
+        child = histogram.labels(name)
+        failed = errors.labels(name) if errors is not None else None
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if failed is not None:
+                    failed.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# ===== COMMON METRICS =====
+HANDLER_SECONDS = histogram("bandfinder_handler_seconds", "Время обработчика обновления", ["handler"])
+HANDLER_ERRORS = counter("bandfinder_handler_errors_total", "Обработчики, завершившиеся исключением", ["handler"])
+DB_QUERY_SECONDS = histogram("bandfinder_db_query_seconds", "Время запроса к базе (функции db.py)", ["query"])
+TELEGRAM_SECONDS = histogram("bandfinder_telegram_request_seconds", "Время запроса к Bot API", ["method"])
+TELEGRAM_ERRORS = counter("bandfinder_telegram_errors_total", "Неудачные запросы к Bot API", ["method"])
+
+
+gauge("bandfinder_log_dropped_records", "Записи лога, отброшенные при переполненной очереди",
+      lambda: {(): logging_config.dropped_records()})
+
+_handler_log = logging.getLogger("bandfinder.handlers")
+
+
+def handler(fn):
+    """Декоратор для обработчиков бота: время и ошибки по имени функции.
+
+    Пока обработчик работает, его имя попадает во все записи лога, а по
+    завершении пишется запись с длительностью (логгер bandfinder.handlers):
+    ошибка — ERROR, успех — DEBUG, чтобы под нагрузкой не забивать очередь лога
+    (время всех вызовов и так есть в bandfinder_handler_seconds).
+    """
+    name = fn.__name__
+    measured = timed(HANDLER_SECONDS, errors=HANDLER_ERRORS)(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = logging_config.push_context(handler=name)
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = measured(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            duration_ms = round((time.perf_counter() - start) * 1000, 3)
+            _handler_log.log(logging.ERROR if failed else logging.DEBUG,
+                             "%s %s", name, "failed" if failed else "done",
+                             extra={"duration_ms": duration_ms})
+            logging_config.pop_context(token)
+    return wrapper
+
+
+def instrument_telegram():
+    """Замеряет каждый исходящий запрос telebot к Bot API по имени метода."""
+    from telebot import apihelper
+
+    original = apihelper._make_request
+    if getattr(original, "instrumented", False):
+        return
+
+    def make_request(token, method_name, method="get", params=None, files=None):
+        start = time.perf_counter()
+        try:
+            return original(token, method_name, method, params, files)
+        except Exception:
+            TELEGRAM_ERRORS.labels(method_name).inc()
+            raise
+        finally:
+            TELEGRAM_SECONDS.labels(method_name).observe(time.perf_counter() - start)
+
+    make_request.instrumented = True
+    apihelper._make_request = make_request
+
+
+# ===== SAMPLING PROFILER =====
+class Profiler:
+    """Выборочный профилировщик: фоновый поток раз в interval снимает стеки
+    всех потоков и считает одинаковые. Отчёт — в формате collapsed stacks
+    (строка «f1;f2;f3 N»), его понимают flamegraph.pl и speedscope."""
+
+    def __init__(self):
+        self.stacks = _Tally()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=PROFILE_INTERVAL):
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks.clear()
+            self.samples = 0
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, args=(interval,),
+                                           name="profiler", daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return False
+            self.stopping.set()
+            self.thread.join()
+        return True
+
+    def report(self, limit=200):
+        with self.lock:
+            top = self.stacks.most_common(limit)
+        return "".join(f"{stack} {count}\n" for stack, count in top)
+
+    def _run(self, interval):
+        me = threading.get_ident()
+        while not self.stopping.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+profiler = Profiler()
+
+
+# ===== HTTP =====
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/metrics":
+            self._reply(200, render(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/debug/profile/start":
+            started = profiler.start(float(query.get("interval", PROFILE_INTERVAL)))
+            self._reply(200, "started\n" if started else "already running\n")
+        elif url.path == "/debug/profile/stop":
+            self._reply(200, "stopped\n" if profiler.stop() else "not running\n")
+        elif url.path == "/debug/profile":
+            self._reply(200, profiler.report(int(query.get("limit", 200))))
+        else:
+            self._reply(404, "not found\n")
+
+    def _reply(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """Запускает HTTP-сервер метрик в фоновом потоке и возвращает его."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Метрики: http://%s:%s/metrics", host, server.server_port)
+    return server
@@ -0,0 +1,251 @@
+"""Версионированные миграции схемы SQLite и проверка планов горячих запросов.
+
+Миграция — функция apply(conn) со своим номером; применённые записываются в
+таблицу schema_migrations. Недостающие применяются по возрастанию номера,
+каждая в своей транзакции (BEGIN IMMEDIATE ... COMMIT): упавшая откатывается
+целиком, и следующие за ней не применяются. Несколько процессов бота могут
+стартовать одновременно — номер перепроверяется внутри транзакции.
+
+Миграции с online=True только строят индексы: от них зависит скорость
+запросов, но не их результат. Поэтому запуск бота их не ждёт — их строит
+фоновый поток после старта. CREATE INDEX держит блокировку записи, пока
+строится (около 0,4 с на миллион строк): записи бота ждут её (busy_timeout
+5 с), чтения в режиме WAL идут как обычно. На новой пустой базе индексы
+строятся сразу. Если фоновую сборку запустили несколько процессов, индекс
+строит один: остальные не ждут блокировку, а повторяют попытку позже.
+Рабочие процессы cluster.py миграций не запускают вовсе. Миграция, которой
+нужен индекс из online-миграции, сама должна быть online.
+
+    python migrations.py status    # применённые и ожидающие миграции
+    python migrations.py apply     # все ожидающие, включая индексы (при выкладке)
+    python migrations.py check     # EXPLAIN QUERY PLAN горячих запросов; полный просмотр таблицы — код 1
+"""
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+ONLINE_DELAY = 5.0   # секунд после запуска до фоновой сборки индексов
+
+_FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)(\w+)")
+
+
+class Migration:
+    __slots__ = ("version", "name", "apply", "online")
+
+    def __init__(self, version, name, apply, online):
+        self.version = version
+        self.name = name
+        self.apply = apply
+        self.online = online
+
+
+class Migrations:
+    """Упорядоченный список миграций одной базы.
+
+        SCHEMA = Migrations()
+
+        @SCHEMA.register(2, online=True)
+        def _requests_by_band(conn):
+            conn.execute("CREATE INDEX IF NOT EXISTS ...")
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def register(self, version, online=False):
+        def decorator(apply):
+            if self.steps and version <= self.steps[-1].version:
+                raise ValueError(f"Миграция {version} после {self.steps[-1].version}: номера должны возрастать")
+            self.steps.append(Migration(version, apply.__name__.lstrip("_"), apply, online))
+            return apply
+        return decorator
+
+    def applied(self, conn):
+        try:
+            return {r[0] for r in conn.execute("SELECT version FROM schema_migrations")}
+        except sqlite3.OperationalError:   # таблицы ещё нет — база до миграций
+            return set()
+
+    def pending(self, conn, online=None):
+        """Неприменённые миграции по порядку; online=False/True — только обычные или только индексы."""
+        done = self.applied(conn)
+        return [m for m in self.steps if m.version not in done and (online is None or m.online == online)]
+
+    def migrate(self, conn, online=False):
+        """Применяет ожидающие миграции (online=True — и индексы). Возвращает номера применённых."""
+        return [m.version for m in self.pending(conn, None if online else False) if self._apply(conn, m)]
+
+    def migrate_in_background(self, connect, delay=ONLINE_DELAY):
+        """Строит индексы online-миграций в фоновом потоке через delay секунд после запуска.
+
+        На одной базе так могут стартовать несколько процессов. Блокировку записи поток
+        берёт без ожидания (busy_timeout=0): если она занята — индекс уже строит другой
+        процесс или идёт обычная запись, — попытка повторяется через delay, а уже
+        применённое к тому времени пропускается. Строит один процесс, остальные не ждут
+        блокировку в очереди вместе с записями обработчиков."""
+        def run():
+            conn = connect()
+            conn.execute("PRAGMA busy_timeout=0")
+            try:
+                while True:
+                    time.sleep(delay)
+                    try:
+                        self.migrate(conn, online=True)
+                        return
+                    except sqlite3.OperationalError as e:
+                        if "locked" not in str(e):
+                            raise
+                        log.info("База занята, фоновая миграция повторится через %s с", delay)
+            except Exception:
+                log.exception("Фоновая миграция не удалась, повтор при следующем запуске")
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=run, name="migrations", daemon=True)
+        thread.start()
+        return thread
+
+    def _apply(self, conn, migration):
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at REAL NOT NULL,
+                    seconds REAL NOT NULL
+                )
+            """)
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version=?", (migration.version,)).fetchone():
+                conn.rollback()   # применил другой процесс, пока мы ждали блокировку
+                return False
+            migration.apply(conn)
+            seconds = time.perf_counter() - start
+            conn.execute("INSERT INTO schema_migrations VALUES (?, ?, ?, ?)",
+                         (migration.version, migration.name, time.time(), round(seconds, 3)))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        log.info("Миграция %s %s применена за %.3f с", migration.version, migration.name, seconds)
+        return True
+
+
+# ===== QUERY PLANS =====
+def full_scans(conn, statements):
+    """[(sql, строка плана)] для запросов, план которых просматривает таблицу целиком."""
+    found = []
+    for sql in statements:
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+            if _FULL_SCAN.match(row[-1]):
+                found.append((sql, row[-1]))
+    return found
+
+
+def _exercise(db):
+    """Вызывает функции db, которые работают на каждом обновлении, с небольшими данными."""
+    db.register_musician(1, "guitar", 5, "рок", "Москва", "о себе")
+    db.register_musician(2, "guitar", 7, "джаз", "Химки", "о себе")
+    db.update_musician(1, "genres", "рок, блюз")
+    db.update_musician(1, "location_text", "Москва")
+    db.get_musician_profile(1)
+    db.find_musicians_by_text_location("guitar", "Москва", 0, "Рок")
+    db.find_musicians_by_text_location("guitar", "Москва", 0, "Рок", description="блюз")
+    db.search_musicians_page("guitar", 0)
+    db.search_musicians_page("guitar", 0, after=(5, 1))
+    db.search_musicians_page("guitar", 0, before=(7, 2))
+    req_id = db.create_band_request(10, "guitar", "Рок", "описание", "Москва", 0)
+    db.get_band_requests(10)
+    db.get_band_request(req_id)
+    db.find_open_requests_for_musician(db.get_musician_profile(2))
+    db.record_alerts([(req_id, 2)])
+    db.assign_musician(req_id, 2)
+    db.cancel_band_request(req_id, 10)
+    db.create_band_request(10, "drums", "Рок", "описание", "Москва", 0)
+    db.expire_band_requests(time.time() + 1, 10)
+    db.archive_closed_requests(time.time() + 1, 10)
+    db.enqueue_messages([(1, "текст", None)])
+    due = db.fetch_due_messages(time.time(), 10)
+    db.reschedule_messages([(0, 1, m["id"]) for m in due])
+    db.delete_messages([m["id"] for m in due])
+    db.set_session(1, "musician_genres", "{}", time.time())
+    db.get_session(1)
+    db.delete_session(1)
+    db.purge_sessions(time.time() - 3600)
+    db.spool_updates([(1, 1, 0, "{}")])
+    db.fetch_spooled(0, 10)
+    db.mark_spooled_attempt(1)
+    db.delete_spooled(1)
+
+
+def check_plans():
+    """Прогоняет горячие запросы db на временной базе со всеми миграциями и
+    возвращает (число запросов, [(sql, план)] с полным просмотром таблицы)."""
+    import os
+    import tempfile
+
+    import db
+
+    saved = db.DB_FILE, db.WRITE_COALESCE
+    statements = []
+    try:
+        db.close_all()
+        db.DB_FILE = os.path.join(tempfile.mkdtemp(prefix="bandfinder-plans-"), "plans.db")
+        db.WRITE_COALESCE = False   # записи в соединении этого потока, чтобы их было видно трассировке
+        db.clear_cache()
+        db.init_db()
+        with db._connect() as conn:   # без ANALYZE: на двух строках планировщик выбрал бы просмотр
+            conn.set_trace_callback(statements.append)
+            _exercise(db)
+            conn.set_trace_callback(None)
+            queries = list(dict.fromkeys(
+                s for s in statements if s.lstrip().split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE", "INSERT")
+            ))
+            return len(queries), full_scans(conn, queries)
+    finally:
+        db.close_all()
+        db.DB_FILE, db.WRITE_COALESCE = saved
+        db.clear_cache()
+
+
+# ===== CLI =====
+def main():
+    import argparse
+
+    import db
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["status", "apply", "check"])
+    args = parser.parse_args()
+
+    if args.action == "check":
+        total, scans = check_plans()
+        for sql, plan in scans:
+            print(f"ПОЛНЫЙ ПРОСМОТР: {plan}\n    {' '.join(sql.split())}")
+        print(f"запросов: {total}, с полным просмотром таблицы: {len(scans)}")
+        return 1 if scans else 0
+
+    conn = db._open()
+    try:
+        if args.action == "apply":
+            applied = db.SCHEMA.migrate(conn, online=True)
+            print(f"применено миграций: {len(applied)} {applied or ''}")
+        done = {r[0]: r for r in conn.execute("SELECT * FROM schema_migrations")} if db.SCHEMA.applied(conn) else {}
+        for m in db.SCHEMA.steps:
+            row = done.get(m.version)
+            state = f"применена {time.strftime('%Y-%m-%d %H:%M', time.localtime(row[2]))}, {row[3]} с" if row \
+                else "ожидает"
+            print(f"{m.version:>4} {m.name:<32} {'индекс' if m.online else '':<7} {state}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
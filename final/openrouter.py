@@ -1,24 +1,153 @@
-# Заглушка для анализа описаний группы / музыкантов
+# Анализ описаний группы / музыкантов
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+# Жанры в порядке приоритета: побеждает первый, чьё слово есть в описании
+GENRES = (
+    ("Рок", ("рок",)),
+    ("Джаз", ("джаз",)),
+    ("Поп", ("поп",)),
+    ("Метал", ("метал",)),
+)
+DEFAULT_GENRE = "Разное"
+
+CACHE_SIZE = 4096
+CACHE_TTL = 3600
+REMOTE_TIMEOUT = float(os.getenv("GENRE_TIMEOUT", "3"))
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "openai/gpt-4o-mini")
+
+
+def normalize_description(description):
+    return " ".join((description or "").lower().replace("ё", "е").split())
+
+
+class KeywordClassifier:
+    """Локальный классификатор по словарям жанров.
+
+    Слова проверяются подстрокой в порядке приоритета жанров, первое найденное
+    решает — как прежняя цепочка in. Дешевле обращения к кэшу, поэтому
+    analyze_band_description его результаты не кэширует.
+    """
+
+    def __init__(self, genres=GENRES, default=DEFAULT_GENRE):
+        self.names = [name for name, _ in genres]
+        self.default = default
+        self.words = tuple((word, name) for name, words in genres for word in words)
+
+    def classify(self, text):
+        for word, genre in self.words:
+            if word in text:
+                return genre
+        return self.default
+
+
+class RemoteClassifier:
+    """Жанр через LLM на OpenRouter (OpenAI-совместимый API).
+
+    Ответ ограничен REMOTE_TIMEOUT; при ошибке, таймауте или ответе не из
+    списка жанров используется локальный fallback.
+    """
+
+    def __init__(self, api_key, fallback, base_url=OPENROUTER_BASE_URL,
+                 model=OPENROUTER_MODEL, timeout=REMOTE_TIMEOUT):
+        from openai import OpenAI  # тяжёлый импорт — только если включён удалённый режим
+
+        self.client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+        self.model = model
+        self.fallback = fallback
+        self.names = {name.lower(): name for name, _ in GENRES}
+        self.names[DEFAULT_GENRE.lower()] = DEFAULT_GENRE
+        self.prompt = (
+            "Определи музыкальный жанр группы по описанию. Ответь одним словом из списка: "
+            + ", ".join(list(self.names.values())) + "."
+        )
+
+    def classify(self, text):
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "system", "content": self.prompt},
+                          {"role": "user", "content": text}],
+                max_tokens=5,
+                temperature=0,
+            )
+            answer = response.choices[0].message.content.strip().strip(".").lower()
+            if answer in self.names:
+                return self.names[answer]
+            log.warning("Неожиданный ответ классификатора: %r", answer)
+        except Exception as e:
+            log.warning("Удалённый классификатор недоступен: %s", e)
+        return self.fallback.classify(text)
+
+
+_local = KeywordClassifier()
+
+
+def _make_classifier():
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if os.getenv("GENRE_BACKEND", "local") == "remote" and api_key:
+        return RemoteClassifier(api_key, fallback=_local)
+    return _local
+
+
+def local_genre(description):
+    """Жанр по локальному словарю — когда ответа модели не дождались."""
+    return _local.classify((description or "").lower())
+
+
+classifier = None
+_cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+GENRE_SECONDS = metrics.histogram("bandfinder_genre_classify_seconds",
+                                  "Время определения жанра (промахи кэша)", ["backend"])
+GENRE_CACHE = metrics.counter("bandfinder_genre_cache_total", "Обращения к кэшу жанров", ["result"])
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="genre")
+
 
 def analyze_band_description(description):
     """
-    Простая функция-заглушка, которая "определяет жанр" по тексту.
-    Можно использовать реальные AI сервисы.
+    Определяет жанр группы по тексту описания.
+    Ответ удалённой модели кэшируется по нормализованному описанию.
     """
-    description = description.lower()
-    if "рок" in description:
-        genre = "Рок"
-    elif "джаз" in description:
-        genre = "Джаз"
-    elif "поп" in description:
-        genre = "Поп"
-    elif "метал" in description:
-        genre = "Метал"
+    global classifier
+    if classifier is None:
+        classifier = _make_classifier()
+    if not isinstance(classifier, RemoteClassifier):
+        return {"genre": classifier.classify((description or "").lower())}
+    key = normalize_description(description)
+    genre = _cache.get(key)
+    if genre is None:
+        GENRE_CACHE.labels("miss").inc()
+        with GENRE_SECONDS.labels(type(classifier).__name__).time():
+            genre = classifier.classify(key)
+        _cache.set(key, genre)
     else:
-        genre = "Разное"
-
+        GENRE_CACHE.labels("hit").inc()
     return {"genre": genre}
 
+
+def analyze_band_description_async(description):
+    """То же, но возвращает Future: вызывающий сам решает, сколько ждать ответа.
+
+    В фоновый поток уходит только запрос к удалённой модели (до REMOTE_TIMEOUT);
+    попадание в кэш и локальный словарь считаются сразу и возвращают готовый Future.
+    """
+    global classifier
+    if classifier is None:
+        classifier = _make_classifier()
+    if isinstance(classifier, RemoteClassifier) and _cache.get(normalize_description(description)) is None:
+        return _executor.submit(analyze_band_description, description)
+    future = Future()
+    future.set_result(analyze_band_description(description))
+    return future
+
+
 def analyze_image_issue(file_bytes, caption=""):
     """
     Заглушка для анализа изображений.
@@ -0,0 +1,177 @@
+"""Параллельная обработка входящих обновлений со строгим порядком внутри чата.
+
+Обновление попадает в шард по chat_id: у каждого шарда своя очередь и свой
+поток, поэтому обновления одного чата обрабатываются строго по очереди,
+а разные чаты — параллельно, и медленный обработчик задерживает только
+свой шард. Очереди ограничены: если шард переполнен, submit ждёт (в режиме
+polling это притормаживает getUpdates) или возвращает False (webhook
+отвечает 503).
+"""
+import logging
+import queue
+import threading
+import time
+import weakref
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+WORKERS = 8
+QUEUE_SIZE = 100          # обновлений в очереди одного шарда
+
+_STOP = object()
+_dispatchers = weakref.WeakSet()
+
+
+def _queue_depths():
+    return {(str(i), str(s.index)): s.queue.qsize()
+            for i, d in enumerate(list(_dispatchers)) for s in d.shards}
+
+
+metrics.gauge("bandfinder_update_queue_depth", "Обновлений в очереди шарда",
+              _queue_depths, ["dispatcher", "shard"])
+
+
+def chat_key(update):
+    """Ключ упорядочивания: чат, а если его нет — пользователь или само обновление."""
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, name, None)
+        if message is not None:
+            return message.chat.id
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    for name in ("inline_query", "chosen_inline_result", "shipping_query",
+                 "pre_checkout_query", "my_chat_member", "chat_member", "chat_join_request"):
+        event = getattr(update, name, None)
+        if event is not None:
+            chat = getattr(event, "chat", None)
+            return chat.id if chat is not None else event.from_user.id
+    return update.update_id
+
+
+class _Shard:
+    def __init__(self, index, size):
+        self.index = index
+        self.queue = queue.Queue(maxsize=size)
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.blocked = 0.0     # сколько секунд отправители ждали места в очереди
+        self.thread = None
+
+
+class ShardedDispatcher:
+    """handle(update) вызывается в потоке шарда; один чат — всегда один шард."""
+
+    def __init__(self, handle, workers=WORKERS, queue_size=QUEUE_SIZE, key=chat_key):
+        self.handle = handle
+        self.key = key
+        self.shards = [_Shard(i, queue_size) for i in range(workers)]
+        self.lock = threading.Lock()
+        _dispatchers.add(self)
+
+    # ===== PUBLIC =====
+    def start(self):
+        for shard in self.shards:
+            if shard.thread is None:
+                shard.thread = threading.Thread(target=self._run, args=(shard,),
+                                                name=f"updates-{shard.index}", daemon=True)
+                shard.thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """Дорабатывает уже принятые обновления и останавливает потоки."""
+        for shard in self.shards:
+            if shard.thread is not None:
+                shard.queue.put(_STOP)
+        if wait:
+            for shard in self.shards:
+                if shard.thread is not None:
+                    shard.thread.join()
+                    shard.thread = None
+
+    def shard_of(self, update):
+        return self.shards[hash(self.key(update)) % len(self.shards)]
+
+    def submit(self, update, block=True, timeout=None):
+        """Кладёт обновление в очередь его шарда. False — шард переполнен."""
+        shard = self.shard_of(update)
+        try:
+            shard.queue.put_nowait(update)
+        except queue.Full:
+            if not block:
+                return False
+            start = time.monotonic()
+            try:
+                shard.queue.put(update, timeout=timeout)
+            except queue.Full:
+                return False
+            finally:
+                with self.lock:
+                    shard.blocked += time.monotonic() - start
+        depth = shard.queue.qsize()
+        if depth > shard.max_depth:
+            with self.lock:
+                shard.max_depth = max(shard.max_depth, depth)
+        return True
+
+    def process_new_updates(self, updates):
+        """Замена bot.process_new_updates: раскладывает пачку по шардам, ждёт места в очередях."""
+        for update in updates:
+            self.submit(update)
+
+    def join(self):
+        """Ждёт, пока все принятые обновления будут обработаны."""
+        for shard in self.shards:
+            shard.queue.join()
+
+    def stats(self):
+        """Метрики по шардам: глубина очереди сейчас и максимум, обработано, ошибок, ожидание."""
+        with self.lock:
+            return [{
+                "shard": s.index,
+                "depth": s.queue.qsize(),
+                "max_depth": s.max_depth,
+                "processed": s.processed,
+                "errors": s.errors,
+                "blocked_s": round(s.blocked, 3),
+            } for s in self.shards]
+
+    # ===== WORKER =====
+    def _run(self, shard):
+        while True:
+            update = shard.queue.get()
+            try:
+                if update is _STOP:
+                    return
+                try:
+                    self.handle(update)
+                except Exception:
+                    shard.errors += 1
+                    log.exception("Ошибка обработки обновления %s", getattr(update, "update_id", "?"))
+                shard.processed += 1
+            finally:
+                shard.queue.task_done()
+
+
+def install(bot, workers=WORKERS, queue_size=QUEUE_SIZE):
+    """Подключает шардированную обработку к боту для режима polling.
+
+    Собственный пул telebot отключается, а bot.process_new_updates, который
+    вызывает цикл polling, начинает раскладывать обновления по шардам.
+    """
+    handle_one = bot.process_new_updates
+    dispatcher = ShardedDispatcher(lambda update: handle_one([update]), workers, queue_size).start()
+
+    def process_new_updates(batch):
+        # Смещение getUpdates сдвигаем сразу, иначе следующий опрос вернёт
+        # обновления, которые ещё ждут в очередях шардов
+        for update in batch:
+            bot.last_update_id = max(bot.last_update_id, update.update_id)
+        dispatcher.process_new_updates(batch)
+
+    bot.threaded = False
+    bot.process_new_updates = process_new_updates
+    return dispatcher
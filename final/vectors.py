@@ -0,0 +1,280 @@
+"""Векторы текстов профилей для подбора по описанию группы, без сети и GPU.
+
+Текст (жанры и «о себе» музыканта, жанр и описание заявки) превращается в
+вектор хэшированием признаков: слова и символьные триграммы слов, чтобы
+«гитарист» и «гитара» или «блюзовый» и «блюз» оказывались рядом. Вектор
+нормируется и хранится как int8 (DIM байт на профиль) в файле, отображённом
+в память (numpy.memmap): строка файла — слот музыканта из таблицы
+musician_vectors. Сходство — скалярное произведение, то есть косинус.
+
+Подбор ранжирует уже отфильтрованных по инструменту, городу и стажу
+кандидатов одним умножением матрицы на вектор запроса. Для поиска по всей
+базе есть приближённый индекс IVF: векторы разбиты k-means на кластеры,
+запрос сравнивается только с nprobe ближайшими. Индекс строится командой
+    python vectors.py build-index
+и не обновляется на лету: векторы, добавленные после сборки, просматриваются
+полным перебором, изменённые остаются в старом кластере до пересборки.
+    python vectors.py rebuild        # пересчитать все векторы из базы
+
+numpy нужен только здесь и импортируется при первом обращении к векторам;
+без него подбор ранжирует по совпадению жанров.
+"""
+import os
+import re
+import threading
+import zlib
+
+DIM = 256                  # байт на профиль: 1 млн профилей — 256 МБ
+SCALE = 127                # float [-1, 1] -> int8
+WORD_WEIGHT = 1.0
+TRIGRAM_WEIGHT = 0.5
+GROW_ROWS = 4096           # на сколько строк минимум растёт файл
+CHUNK_ROWS = 65536         # строк за одно умножение при полном переборе
+NPROBE = 16
+
+np = None   # numpy импортируется при первом обращении: это ~30 мс к запуску каждого процесса
+_numpy_missing = False
+
+_WORD = re.compile(r"\w+")
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def available():
+    """Установлен ли numpy; при первом вызове импортирует его."""
+    global np, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:   # без numpy подбор ранжирует только по жанрам
+            _numpy_missing = True
+    return np is not None
+
+
+# ===== EMBEDDING =====
+def _features(text):
+    for word in _WORD.findall((text or "").lower().replace("ё", "е")):
+        yield word, WORD_WEIGHT
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3], TRIGRAM_WEIGHT
+
+
+def embed(text):
+    """Нормированный float32-вектор длины DIM (нулевой для пустого текста)."""
+    if np is None and not available():
+        raise RuntimeError("нужен numpy: pip install numpy")
+    buckets, weights = [], []
+    for feature, weight in _features(text):
+        h = zlib.crc32(feature.encode())   # hash() в Python свой у каждого процесса
+        buckets.append(h % DIM)
+        weights.append(-weight if h & 0x80000000 else weight)
+    vec = np.bincount(buckets, weights, minlength=DIM).astype(np.float32) if buckets \
+        else np.zeros(DIM, np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def quantize(vec):
+    return np.clip(np.rint(vec * SCALE), -SCALE, SCALE).astype(np.int8)
+
+
+def musician_text(genres, about):
+    # Жанры дважды: они важнее свободного текста о себе
+    return f"{genres or ''} {genres or ''} {about or ''}"
+
+
+def request_text(genre, description):
+    return f"{genre or ''} {description or ''}"
+
+
+# ===== STORE =====
+class VectorStore:
+    """Матрица int8 [слот, DIM] в файле. Файл растёт при записи за его концом;
+    другой процесс, увидевший слот за концом своей проекции, перечитывает размер."""
+
+    def __init__(self, path, dim=DIM):
+        self.path = path
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.index = None
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(GROW_ROWS * dim)
+        self._map()
+        self._load_index()
+
+    def _map(self):
+        rows = os.path.getsize(self.path) // self.dim
+        self.matrix = np.memmap(self.path, dtype=np.int8, mode="r+", shape=(rows, self.dim))
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def ensure(self, rows):
+        if rows <= len(self.matrix):
+            return
+        with self.lock:
+            if os.path.getsize(self.path) // self.dim < rows:
+                with open(self.path, "r+b") as f:
+                    f.truncate(max(rows, 2 * len(self.matrix), GROW_ROWS) * self.dim)
+            self.matrix.flush()
+            self._map()
+
+    def write(self, slots, vectors):
+        """slots: список слотов, vectors: float-векторы (строки) той же длины."""
+        slots = np.asarray(slots, dtype=np.int64)
+        if not len(slots):
+            return
+        self.ensure(int(slots.max()) + 1)
+        self.matrix[slots] = quantize(np.asarray(vectors, dtype=np.float32))
+
+    def flush(self):
+        self.matrix.flush()
+
+    def score(self, slots, query):
+        """Косинус запроса с векторами слотов одним умножением; None в slots — 0."""
+        scores = np.zeros(len(slots), np.float32)
+        known = np.array([i for i, s in enumerate(slots) if s is not None], dtype=np.int64)
+        if len(known):
+            rows = np.array([slots[i] for i in known], dtype=np.int64)
+            self.ensure(int(rows.max()) + 1)
+            scores[known] = self.matrix[rows].astype(np.float32) @ query / SCALE
+        return scores
+
+    def top_k(self, query, k, rows, exact=False, nprobe=NPROBE):
+        """(слоты, сходство) k ближайших среди первых rows строк (занятых слотов,
+        файл обычно длиннее); индекс IVF, если он собран."""
+        self.ensure(rows)
+        if self.index is not None and not exact:
+            return self.index.search(self.matrix, query, k, rows, nprobe)
+        return _exact_top_k(self.matrix, query, k, 0, rows)
+
+    # ===== INDEX =====
+    def build_index(self, rows, lists=None, **kwargs):
+        self.index = IVFIndex.build(self.matrix, rows, lists, **kwargs)
+        self.index.save(self.path + ".ivf.npz")
+        return self.index
+
+    def _load_index(self):
+        path = self.path + ".ivf.npz"
+        if os.path.exists(path):
+            self.index = IVFIndex.load(path)
+
+
+def _exact_top_k(matrix, query, k, start, stop):
+    best_slots = np.empty(0, np.int64)
+    best_scores = np.empty(0, np.float32)
+    for lo in range(start, stop, CHUNK_ROWS):
+        hi = min(stop, lo + CHUNK_ROWS)
+        scores = matrix[lo:hi].astype(np.float32) @ query / SCALE
+        take = min(k, len(scores))
+        part = np.argpartition(-scores, take - 1)[:take]
+        best_slots = np.concatenate([best_slots, part + lo])
+        best_scores = np.concatenate([best_scores, scores[part]])
+    order = np.argsort(-best_scores, kind="stable")[:k]
+    return best_slots[order], best_scores[order]
+
+
+class IVFIndex:
+    """Приближённый поиск: слоты сгруппированы по кластерам k-means,
+    запрос просматривает только nprobe кластеров с ближайшими центрами."""
+
+    def __init__(self, centroids, slots, offsets, rows):
+        self.centroids = centroids     # [lists, DIM] float32
+        self.slots = slots             # слоты, упорядоченные по кластеру
+        self.offsets = offsets         # кластер i — slots[offsets[i]:offsets[i + 1]]
+        self.rows = rows               # сколько строк было в матрице при сборке
+
+    @classmethod
+    def build(cls, matrix, rows, lists=None, iters=8, sample=50000, seed=0):
+        lists = lists or max(1, int(rows ** 0.5))
+        rnd = np.random.default_rng(seed)
+        train = matrix[np.sort(rnd.choice(rows, min(rows, sample), replace=False))].astype(np.float32)
+        centroids = train[rnd.choice(len(train), lists, replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(train @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=lists)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-6)
+        assign = np.concatenate([
+            np.argmax(matrix[lo:min(rows, lo + CHUNK_ROWS)].astype(np.float32) @ centroids.T, axis=1)
+            for lo in range(0, rows, CHUNK_ROWS)
+        ])
+        slots = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=lists))])
+        return cls(centroids, slots, offsets, rows)
+
+    def search(self, matrix, query, k, rows, nprobe=NPROBE):
+        nearest = np.argpartition(-(self.centroids @ query), min(nprobe, len(self.centroids)) - 1)[:nprobe]
+        slots = np.concatenate([self.slots[self.offsets[i]:self.offsets[i + 1]] for i in nearest])
+        slots.sort()   # чтение памяти по порядку
+        scores = matrix[slots].astype(np.float32) @ query / SCALE
+        if rows > self.rows:
+            # Добавленные после сборки — полным перебором
+            tail_slots, tail_scores = _exact_top_k(matrix, query, k, self.rows, rows)
+            slots = np.concatenate([slots, tail_slots])
+            scores = np.concatenate([scores, tail_scores])
+        order = np.argsort(-scores, kind="stable")[:k]
+        return slots[order], scores[order]
+
+    def save(self, path):
+        with open(path, "wb") as f:   # np.savez сам дописал бы .npz к имени
+            np.savez(f, centroids=self.centroids, slots=self.slots,
+                     offsets=self.offsets, rows=np.array(self.rows))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["centroids"], data["slots"], data["offsets"], int(data["rows"]))
+
+
+def open_store(path):
+    """Общее хранилище для файла path; None, если numpy не установлен."""
+    if not available():
+        return None
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = VectorStore(path)
+        return store
+
+
+def close_all():
+    with _stores_lock:
+        for store in _stores.values():
+            store.flush()
+        _stores.clear()
+
+
+# ===== CLI =====
+def main():
+    import argparse
+    import time
+
+    import db
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["rebuild", "build-index"])
+    parser.add_argument("--lists", type=int, help="кластеров в индексе (по умолчанию sqrt(N))")
+    args = parser.parse_args()
+    if not available():
+        parser.error("нужен numpy: pip install numpy")
+
+    db.init_db()
+    start = time.perf_counter()
+    if args.action == "rebuild":
+        print(f"пересчитано векторов: {db.rebuild_vectors():,}")
+    else:
+        rows = db.count_vector_slots()
+        index = db.vector_store().build_index(rows, args.lists)
+        print(f"индекс: {rows:,} векторов, {len(index.centroids)} кластеров")
+    print(f"за {time.perf_counter() - start:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Приём обновлений через webhook вместо long polling.
+
+Небольшой HTTP-сервер на asyncio принимает POST от Telegram, проверяет
+секрет из заголовка X-Telegram-Bot-Api-Secret-Token, разбирает Update и
+отдаёт его обработчикам бота через updates.ShardedDispatcher: один чат —
+строго по порядку, разные чаты — параллельно. Если очередь шарда занята
+дольше ACQUIRE_TIMEOUT, сервер отвечает 503 — Telegram повторит доставку
+позже, а бот не копит обновления в памяти.
+
+Включается переменными окружения (см. main.py):
+    BOT_MODE=webhook
+    WEBHOOK_URL=https://example.org/bot
+    WEBHOOK_SECRET=...
+"""
+import asyncio
+import hmac
+import json
+import logging
+
+from telebot import types
+
+import updates
+
+log = logging.getLogger(__name__)
+
+WORKERS = updates.WORKERS
+QUEUE_SIZE = 8            # обновлений в очереди одного шарда
+MAX_CONNECTIONS = 64      # одновременных соединений от Telegram (setWebhook)
+ACQUIRE_TIMEOUT = 2.0     # сколько ждать свободного места, прежде чем ответить 503
+RETRY_INTERVAL = 0.01
+MAX_BODY = 1024 * 1024
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class WebhookServer:
+    def __init__(self, bot, path="/", secret=None, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        # workers=0 — обновления обрабатывает подкласс (см. cluster.SpoolWebhookServer)
+        self.dispatcher = updates.ShardedDispatcher(self._process, workers, queue_size) if workers else None
+        self.server = None
+
+    async def start(self, host, port):
+        if self.dispatcher:
+            self.dispatcher.start()
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self, host, port):
+        await self.start(host, port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.dispatcher:
+            self.dispatcher.stop(wait=True)
+
+    # ===== HTTP =====
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status = await self._handle_request(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY:
+            raise ValueError("body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, path, headers, body
+
+    async def _handle_request(self, method, path, headers, body):
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret and not hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret):
+            return 403
+        try:
+            update = types.Update.de_json(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            return 400
+        return await self.deliver(update, body)
+
+    async def deliver(self, update, body):
+        """Передаёт обновление обработчикам; возвращает HTTP-статус ответа Telegram."""
+        # Backpressure: ждём места в очереди шарда ограниченное время, иначе 503.
+        # Цикл событий не блокируется — очередь проверяется без ожидания.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ACQUIRE_TIMEOUT
+        while not self.dispatcher.submit(update, block=False):
+            if loop.time() >= deadline:
+                log.warning("Webhook перегружен, обновление %s отклонено", update.update_id)
+                return 503
+            await asyncio.sleep(RETRY_INTERVAL)
+        return 200
+
+    def _process(self, update):
+        self.bot.process_new_updates([update])
+
+
+def run(bot, url, host="0.0.0.0", port=8443, path="/", secret=None,
+        workers=WORKERS, queue_size=QUEUE_SIZE, max_connections=MAX_CONNECTIONS):
+    """Регистрирует webhook в Telegram и обслуживает его до остановки процесса."""
+    # Обработчики выполняются в шардах сервера, собственный пул telebot не нужен
+    bot.threaded = False
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=secret, max_connections=max_connections)
+    log.info("Webhook %s, слушаю %s:%s%s", url, host, port, path)
+    server = WebhookServer(bot, path, secret, workers, queue_size)
+    try:
+        asyncio.run(server.serve_forever(host, port))
+    finally:
+        if server.dispatcher:
+            server.dispatcher.stop(wait=False)
@@ -1,15 +1,16 @@
 import telebot
-import json
 import os
 from dotenv import load_dotenv
 from telebot import types
 
+import notes_db
+
 
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 bot = telebot.TeleBot(TOKEN)
 
-NOTES_FILE = "notes.json"
+notes_db.init_db()
 
 
 def model_1(question: str) -> str:
@@ -32,27 +33,8 @@ MODELS = {
 }
 
 
-def load_all_notes():
-    if not os.path.exists(NOTES_FILE):
-        return {}
-    with open(NOTES_FILE, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-
-def save_all_notes(data):
-    with open(NOTES_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
 def get_user_notes(user_id):
-    data = load_all_notes()
-    return data.get(str(user_id), [])
-
-def save_user_notes(user_id, notes):
-    data = load_all_notes()
-    data[str(user_id)] = notes
-    save_all_notes(data)
+    return notes_db.get_notes(user_id)
 
 
 def main_keyboard():
@@ -126,11 +108,7 @@ def note_add(message):
         bot.reply_to(message, "❗ Используй: /note_add <текст>")
         return
 
-    user_id = message.from_user.id
-    notes = get_user_notes(user_id)
-    note_id = len(notes) + 1
-    notes.append({"id": note_id, "text": text})
-    save_user_notes(user_id, notes)
+    note_id = notes_db.add_note(message.from_user.id, text)
 
     bot.reply_to(message, f"✅ Заметка #{note_id} добавлена")
 
@@ -144,16 +122,42 @@ def note_list(message):
     result = "\n".join(f"{n['id']}. {n['text']}" for n in notes)
     bot.reply_to(message, result)
 
+def find_page(user_id, query, page):
+    total, found = notes_db.find_notes(user_id, query, page)
+    if not found:
+        return "Ничего не найдено", None
+
+    pages = (total + notes_db.FIND_PAGE_SIZE - 1) // notes_db.FIND_PAGE_SIZE
+    text = f"Найдено: {total} (стр. {page + 1}/{pages})\n\n"
+    text += "\n".join(f"{n['id']}. {n['text']}" for n in found)
+
+    # Запрос едет в callback_data, а она ограничена 64 байтами — длинный запрос без кнопок
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"nf:{page - 1}:{query}"))
+    if page + 1 < pages:
+        buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"nf:{page + 1}:{query}"))
+    if not buttons or any(len(b.callback_data.encode()) > 64 for b in buttons):
+        return text, None
+    kb = types.InlineKeyboardMarkup()
+    kb.row(*buttons)
+    return text, kb
+
 @bot.message_handler(commands=["note_find"])
 def note_find(message):
-    query = message.text.replace("/note_find", "").strip().lower()
-    notes = get_user_notes(message.from_user.id)
-    found = [n for n in notes if query in n["text"].lower()]
+    query = message.text.replace("/note_find", "").strip()
+    if not notes_db.search_query(query):   # пусто или одни знаки препинания — искать нечего
+        bot.reply_to(message, "Используй: /note_find <слово>")
+        return
+    text, kb = find_page(message.from_user.id, query, 0)
+    bot.reply_to(message, text, reply_markup=kb)
 
-    if not found:
-        bot.reply_to(message, "Ничего не найдено")
-    else:
-        bot.reply_to(message, "\n".join(f"{n['id']}. {n['text']}" for n in found))
+@bot.callback_query_handler(func=lambda c: c.data.startswith("nf:"))
+def note_find_page(call):
+    _, page, query = call.data.split(":", 2)
+    text, kb = find_page(call.from_user.id, query, int(page))
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
+    bot.answer_callback_query(call.id)
 
 @bot.message_handler(commands=["note_edit"])
 def note_edit(message):
@@ -168,15 +172,10 @@ def note_edit(message):
         bot.reply_to(message, "ID должен быть числом")
         return
 
-    notes = get_user_notes(message.from_user.id)
-    for n in notes:
-        if n["id"] == note_id:
-            n["text"] = parts[2]
-            save_user_notes(message.from_user.id, notes)
-            bot.reply_to(message, "✏️ Заметка обновлена")
-            return
-
-    bot.reply_to(message, "Заметка не найдена")
+    if notes_db.edit_note(message.from_user.id, note_id, parts[2]):
+        bot.reply_to(message, "✏️ Заметка обновлена")
+    else:
+        bot.reply_to(message, "Заметка не найдена")
 
 @bot.message_handler(commands=["note_del"])
 def note_del(message):
@@ -186,33 +185,27 @@ def note_del(message):
         bot.reply_to(message, "Используй: /note_del <id>")
         return
 
-    notes = get_user_notes(message.from_user.id)
-    new_notes = [n for n in notes if n["id"] != note_id]
-
-    if len(new_notes) == len(notes):
-        bot.reply_to(message, "Заметка не найдена")
-    else:
-        save_user_notes(message.from_user.id, new_notes)
+    if notes_db.delete_note(message.from_user.id, note_id):
         bot.reply_to(message, "🗑 Заметка удалена")
+    else:
+        bot.reply_to(message, "Заметка не найдена")
 
 @bot.message_handler(commands=["note_count"])
 def note_count(message):
-    notes = get_user_notes(message.from_user.id)
-    bot.reply_to(message, f"Всего заметок: {len(notes)}")
+    count, _ = notes_db.get_stats(message.from_user.id)
+    bot.reply_to(message, f"Всего заметок: {count}")
 
 @bot.message_handler(commands=["max"])
 def max_note(message):
-    notes = get_user_notes(message.from_user.id)
-    if not notes:
+    m = notes_db.longest_note(message.from_user.id)
+    if not m:
         bot.reply_to(message, "Нет заметок")
         return
-    m = max(notes, key=lambda n: len(n["text"]))
     bot.reply_to(message, f"Самая длинная заметка:\n{m['text']}")
 
 @bot.message_handler(commands=["sum"])
 def sum_notes(message):
-    notes = get_user_notes(message.from_user.id)
-    total = sum(len(n["text"]) for n in notes)
+    _, total = notes_db.get_stats(message.from_user.id)
     bot.reply_to(message, f"Суммарная длина: {total} символов")
 
 
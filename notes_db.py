@@ -0,0 +1,229 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+
+DB_FILE = os.getenv("NOTES_DB", "notes.db")
+NOTES_FILE = "notes.json"   # старое хранилище, переносится в базу один раз
+
+_local = threading.local()
+
+def _connect():
+    # Одно долгоживущее соединение на поток обработчиков
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_FILE:
+        conn = sqlite3.connect(DB_FILE, timeout=5.0)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Чтобы INSERT OR REPLACE запускал DELETE-триггеры полнотекстового индекса
+        conn.execute("PRAGMA recursive_triggers=ON")
+        conn.create_function("_yo", 1, _yo, deterministic=True)
+        _local.conn, _local.path = conn, DB_FILE
+    return conn
+
+def _yo(text):
+    return text.replace("ё", "е").replace("Ё", "Е") if text else text
+
+def init_db():
+    with _connect() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS notes (
+                user_id INTEGER NOT NULL,
+                id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (user_id, id)
+            )
+        """)
+        _init_search(conn)
+        _init_stats(conn)
+    migrate_from_json()
+
+def _init_stats(conn):
+    # Агрегаты для /note_count, /sum и /max поддерживаются при каждой записи,
+    # а не пересчитываются по всем заметкам на каждый запрос
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='note_stats'"
+    ).fetchone()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS note_stats (
+            user_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL,
+            total_len INTEGER NOT NULL
+        )
+    """)
+    # Самая длинная заметка — первая запись этого индекса для пользователя
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notes_len ON notes (user_id, length(text) DESC, id)
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS note_stats_ai AFTER INSERT ON notes BEGIN
+            INSERT INTO note_stats (user_id, count, total_len) VALUES (new.user_id, 1, length(new.text))
+            ON CONFLICT (user_id) DO UPDATE SET
+                count = count + 1, total_len = total_len + excluded.total_len;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS note_stats_ad AFTER DELETE ON notes BEGIN
+            UPDATE note_stats SET count = count - 1, total_len = total_len - length(old.text)
+            WHERE user_id = old.user_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS note_stats_au AFTER UPDATE OF text ON notes BEGIN
+            UPDATE note_stats SET total_len = total_len - length(old.text) + length(new.text)
+            WHERE user_id = new.user_id;
+        END
+    """)
+    if not exists:
+        conn.execute("""
+            INSERT INTO note_stats (user_id, count, total_len)
+            SELECT user_id, COUNT(*), SUM(length(text)) FROM notes GROUP BY user_id
+        """)
+
+def _init_search(conn):
+    # Полнотекстовый индекс по заметкам. user_id тоже колонка индекса,
+    # поэтому поиск сразу ограничивается заметками одного пользователя.
+    # В индекс текст попадает через _yo(): unicode61 не приравнивает «ё» к «е».
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='notes_fts'"
+    ).fetchone()
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            text, user_id,
+            content='notes', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+    # Индекс обновляется триггерами при каждом добавлении, правке и удалении
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_ai AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, text, user_id) VALUES (new.rowid, _yo(new.text), new.user_id);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_ad AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, text, user_id)
+            VALUES ('delete', old.rowid, _yo(old.text), old.user_id);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_au AFTER UPDATE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, text, user_id)
+            VALUES ('delete', old.rowid, _yo(old.text), old.user_id);
+            INSERT INTO notes_fts (rowid, text, user_id) VALUES (new.rowid, _yo(new.text), new.user_id);
+        END
+    """)
+    if not exists:
+        conn.execute("INSERT INTO notes_fts (rowid, text, user_id) SELECT rowid, _yo(text), user_id FROM notes")
+
+def migrate_from_json(path=NOTES_FILE):
+    """Переносит notes.json в базу и переименовывает файл в notes.json.migrated.
+    Выполняется одной транзакцией: при ошибке база и файл остаются как были."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError:
+            data = {}
+    rows = [
+        (int(user_id), note["id"], note["text"])
+        for user_id, notes in data.items()
+        for note in notes
+    ]
+    with _connect() as conn:
+        # INSERT OR REPLACE: в старом файле id могли повторяться, побеждает последняя запись
+        conn.executemany("INSERT OR REPLACE INTO notes (user_id, id, text) VALUES (?, ?, ?)", rows)
+    os.replace(path, path + ".migrated")
+    return len(rows)
+
+# ===== NOTES =====
+def add_note(user_id, text):
+    # Номер и вставка в одном выражении — параллельные /note_add не получат одинаковый id
+    with _connect() as conn:
+        row = conn.execute("""
+            INSERT INTO notes (user_id, id, text)
+            SELECT ?, COALESCE(MAX(id), 0) + 1, ? FROM notes WHERE user_id = ?
+            RETURNING id
+        """, (user_id, text, user_id)).fetchall()[0]
+        return row["id"]
+
+def get_notes(user_id):
+    with _connect() as conn:
+        rows = conn.execute("SELECT id, text FROM notes WHERE user_id=? ORDER BY id", (user_id,)).fetchall()
+        return [dict(r) for r in rows]
+
+def edit_note(user_id, note_id, text):
+    with _connect() as conn:
+        cur = conn.execute("UPDATE notes SET text=? WHERE user_id=? AND id=?", (text, user_id, note_id))
+        return cur.rowcount > 0
+
+def delete_note(user_id, note_id):
+    with _connect() as conn:
+        cur = conn.execute("DELETE FROM notes WHERE user_id=? AND id=?", (user_id, note_id))
+        return cur.rowcount > 0
+
+def get_stats(user_id):
+    """(число заметок, суммарная длина) — одна строка из note_stats."""
+    with _connect() as conn:
+        row = conn.execute("SELECT count, total_len FROM note_stats WHERE user_id=?", (user_id,)).fetchone()
+        return (row["count"], row["total_len"]) if row else (0, 0)
+
+def longest_note(user_id):
+    with _connect() as conn:
+        row = conn.execute("""
+            SELECT id, text FROM notes WHERE user_id=?
+            ORDER BY length(text) DESC, id LIMIT 1
+        """, (user_id,)).fetchone()
+        return dict(row) if row else None
+
+# ===== SEARCH =====
+FIND_PAGE_SIZE = 10
+RANK_LIMIT = 2000
+
+# Частые окончания русских слов: «заметками» ищется как «заметк*»
+_RU_ENDINGS = sorted("""
+    ами ями ого его ому ему ыми ими ией иям иях ах ях ов ев ей ой ий ый ая яя ое ее ые ие
+    ую юю ом ем ам ям ью а я о е ы и у ю ь
+""".split(), key=len, reverse=True)
+_WORD = re.compile(r"\w+")
+
+def _stem(word):
+    if len(word) >= 4:
+        for ending in _RU_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                return word[:-len(ending)]
+    return word
+
+def search_query(text):
+    """Строка запроса FTS5: все слова обязательны, каждое ищется по префиксу основы."""
+    words = [_stem(w) for w in _WORD.findall(text.lower().replace("ё", "е"))]
+    return " AND ".join(f'text:"{w}"*' for w in words)
+
+def find_notes(user_id, text, page=0, page_size=FIND_PAGE_SIZE):
+    """Возвращает (всего найдено, заметки страницы page).
+
+    Результаты упорядочены по релевантности (bm25). Если совпадений больше
+    RANK_LIMIT, ранжирование стоило бы дороже самого поиска — тогда новые первыми.
+    """
+    query = search_query(text)
+    if not query:
+        return 0, []
+    match = f'user_id:"{int(user_id)}" AND ({query})'
+    with _connect() as conn:
+        total = conn.execute(
+            "SELECT COUNT(*) FROM notes_fts WHERE notes_fts MATCH ?", (match,)
+        ).fetchone()[0]
+        select, order = ("rowid, rank", "rank") if total <= RANK_LIMIT else ("rowid", "rowid DESC")
+        rows = conn.execute(f"""
+            SELECT n.id, n.text FROM (
+                SELECT {select} FROM notes_fts WHERE notes_fts MATCH ?
+                ORDER BY {order} LIMIT ? OFFSET ?
+            ) AS hit
+            JOIN notes n ON n.rowid = hit.rowid
+            ORDER BY hit.{order}
+        """, (match, page_size, page * page_size)).fetchall()
+        return total, [dict(r) for r in rows]